@@ -0,0 +1,116 @@
+import utime
+from array import array
+
+# the series exported for every aggregated metric. these mustn't clash
+# with what sensors report themselves, e.g. the sds011 has its own _min and
+# _max over the frames since the last readout.
+SUFFIXES = ("_agg_min", "_agg_max", "_agg_avg", "_agg_samples")
+
+class MetricAggregator:
+    """ Keeps the minimum, maximum, sum and number of samples of every
+        metric of every sensor, so that short spikes between two scrapes
+        aren't lost.
+
+        Without a window, the statistics cover everything since the last
+        call to collect(). With a window, they cover (roughly) the last
+        window_s seconds instead, in num_buckets steps.
+    """
+
+    def __init__(self, sensors, window_s=None, num_buckets=6):
+        """ sensors maps sensor labels to the names of their metrics (for
+            boot.py, the aggregates of the sensor: counters and statistics
+            that the sensor keeps itself make no sense here) """
+
+        # sensor label -> metric name -> slot. this is nested instead of
+        # keyed by tuples so that looking up a slot doesn't allocate.
+        self._slots = {}
+        self._metrics = []
+        for sensor_label, names in sensors.items():
+            self._slots[sensor_label] = {}
+            for name in names:
+                self._slots[sensor_label][name] = len(self._metrics)
+                self._metrics.append((sensor_label, name))
+
+        if window_s is None:
+            self._num_buckets = 1
+            self._bucket_ms = 0
+        else:
+            self._num_buckets = num_buckets
+            self._bucket_ms = int(window_s * 1000 / num_buckets)
+
+        size = len(self._metrics) * self._num_buckets
+        self._min = array("f", [0] * size)
+        self._max = array("f", [0] * size)
+        self._sum = array("f", [0] * size)
+        self._count = array("I", [0] * size)
+
+        self._bucket = 0
+        self._bucket_start = utime.ticks_ms()
+
+    def _clear_bucket(self, bucket):
+        for i in range(bucket, len(self._count), self._num_buckets):
+            self._count[i] = 0
+
+    def _advance(self):
+        if self._bucket_ms == 0:
+            return
+
+        now = utime.ticks_ms()
+        # if nothing was added for a while, we might have to skip some buckets
+        for _ in range(self._num_buckets):
+            if utime.ticks_diff(now, self._bucket_start) < self._bucket_ms:
+                return
+            self._bucket = (self._bucket + 1) % self._num_buckets
+            self._bucket_start = utime.ticks_add(self._bucket_start, self._bucket_ms)
+            self._clear_bucket(self._bucket)
+
+        # everything is outdated
+        self._bucket_start = now
+
+    def add(self, sensor_label, values):
+        self._advance()
+
+        slots = self._slots[sensor_label]
+        for name, value in values.items():
+            slot = slots.get(name)
+            if slot is None:
+                continue
+
+            i = slot * self._num_buckets + self._bucket
+            if self._count[i] == 0:
+                self._min[i] = value
+                self._max[i] = value
+                self._sum[i] = value
+            else:
+                if value < self._min[i]:
+                    self._min[i] = value
+                if value > self._max[i]:
+                    self._max[i] = value
+                self._sum[i] += value
+            self._count[i] += 1
+
+    def collect(self):
+        """ Yields (sensor label, metric name, min, max, mean, samples) for
+            every metric that has samples. Without a window, this starts a
+            new aggregation period. """
+
+        self._advance()
+
+        num_buckets = self._num_buckets
+        for slot, (sensor_label, name) in enumerate(self._metrics):
+            count = 0
+            for i in range(slot * num_buckets, (slot + 1) * num_buckets):
+                if self._count[i] == 0:
+                    continue
+                if count == 0 or self._min[i] < minimum:
+                    minimum = self._min[i]
+                if count == 0 or self._max[i] > maximum:
+                    maximum = self._max[i]
+                total = self._sum[i] if count == 0 else total + self._sum[i]
+                count += self._count[i]
+
+            if count > 0:
+                yield sensor_label, name, minimum, maximum, total / count, count
+
+        if self._bucket_ms == 0:
+            self._clear_bucket(0)
@@ -0,0 +1,79 @@
+# compares the size and encoding time of the text and binary /metrics
+# formats for a typical device (a bme280, an mh-z19 and an sds011, with
+# aggregates). the timings are for this machine, not for the device, but
+# the ratio is what matters.
+#
+# usage: python bench_binmetrics.py [number of scrapes]
+
+import sys
+import time
+
+import hostsim
+hostsim.install()
+
+from aggregator import SUFFIXES
+from binmetrics import BinaryMetrics
+from exposition import render_text
+from bme280_sensor import BME280Sensor
+from mhz19_sensor import MHZ19Sensor
+from sds011_sensor import SDS011Sensor
+
+sensors = {
+    "kitchen": ("bme", "next to the fridge", {"temperature": 21.53, "humidity": 40.12, "pressure": 1013.25}),
+    "co2": ("mhz", "living room", {"co2_concentration": 812, "temperature": 23, "status": 0, "read_errors": 0}),
+    "particles": ("sds", "balcony", {"pm2_5_ug_m3": 3.4, "pm10_ug_m3": 7.8, "pm2_5_ug_m3_min": 2.1,
+                                     "pm2_5_ug_m3_max": 5.5, "pm10_ug_m3_min": 6.0, "pm10_ug_m3_max": 9.1,
+                                     "frames": 60, "frame_errors": 0, "command_errors": 0, "sleeping": 0}),
+}
+aggregates = {"bme": BME280Sensor.aggregates, "mhz": MHZ19Sensor.aggregates, "sds": SDS011Sensor.aggregates}
+device_vars = {"wifi_rssi": -61, "memory_used": 61440, "memory_free": 49152, "last_connection_duration_ms": 85}
+
+
+def main():
+
+    scrapes = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+
+    sensor_configs = {label: {"type": sensor_type, "description": description}
+                      for label, (sensor_type, description, _) in sensors.items()}
+
+    metrics = []
+    index = []
+    for label, (sensor_type, description, values) in sensors.items():
+        labels = {"label": label, "description": description, "type": sensor_type}
+        for name, value in values.items():
+            metrics.append((name, label, value))
+            index.append((name, label, labels))
+        for name in aggregates[sensor_type]:
+            for suffix in SUFFIXES:
+                metrics.append((name + suffix, label, values[name]))
+                index.append((name + suffix, label, labels))
+    for name, value in device_vars.items():
+        metrics.append((name, None, value))
+        index.append((name, None, {}))
+
+    metric_names = []
+    for name, _, _ in index:
+        if name not in metric_names:
+            metric_names.append(name)
+
+    binary_metrics = BinaryMetrics(index)
+
+    start = time.perf_counter()
+    for _ in range(scrapes):
+        text = render_text(metric_names, metrics, sensor_configs).encode("ascii")
+    text_time = (time.perf_counter() - start) / scrapes
+
+    start = time.perf_counter()
+    for _ in range(scrapes):
+        data = binary_metrics.pack(metrics)
+    binary_time = (time.perf_counter() - start) / scrapes
+
+    print(f"{len(metrics)} values per scrape")
+    print(f"  text:   {len(text):6} bytes, {text_time * 1e6:7.1f} us per scrape")
+    print(f"  binary: {len(data):6} bytes, {binary_time * 1e6:7.1f} us per scrape "
+          f"(plus a one-time schema of {len(binary_metrics.schema)} bytes)")
+    print(f"  {len(text) / len(data):.1f}x fewer bytes, {text_time / binary_time:.1f}x less cpu time")
+
+
+if __name__ == "__main__":
+    main()
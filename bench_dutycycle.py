@@ -0,0 +1,89 @@
+# runs a week of the duty cycle mode for a few configurations, and reports
+# how long the device is awake per cycle, and roughly how long a battery
+# would last. the current draws are ballpark figures for a bare esp32
+# module, dev boards with a usb-serial chip and a linear regulator draw a
+# lot more while asleep.
+#
+# usage: python bench_dutycycle.py [sleep current in mA] [battery capacity in mAh]
+
+import sys
+import tempfile
+
+import hostsim
+clock = hostsim.install()
+
+import machine
+from dutycycle import DutyCycle
+from test_dutycycle import MockSensor, Environment
+
+DAYS = 7
+
+# from the reset to dutycycle.main(), which DutyCycle doesn't see
+BOOT_MS = 300
+AWAKE_MA = 40
+WIFI_MA = 120
+
+CONFIGURATIONS = [
+    ("every 5 min, push every hour", {}),
+    ("every 5 min, push every time", {"push_every": 1}),
+    ("every 5 min, 3 samples, push every hour", {"samples_per_wake": 3}),
+    ("every 5 min, push every hour, no dht", {"settle_ms": 0}),
+    ("every 5 min, push every hour, ota every 12 h", {"stay_awake_every": 144}),
+    ("every 15 min, push every 4 h", {"period_s": 900, "push_every": 16}),
+]
+
+
+def run(settings):
+    """ returns the total awake, wifi and sleep times in ms, and the number
+        of cycles """
+
+    settings = dict(settings)
+    settle_ms = settings.pop("settle_ms", 2000)
+    period_s = settings.get("period_s", 300)
+
+    clock.now_us = 0
+    clock.rtc_offset_s = 0
+    machine.last_reset_cause = machine.PWRON_RESET
+    sensors = {"outside": MockSensor(readout_ms=30), "pressure": MockSensor(readout_ms=12)}
+    environment = Environment(connect_ms=1800)
+
+    awake_ms = wifi_ms = sleep_ms = 0
+    cycles = DAYS * 86400 // period_s
+    with tempfile.TemporaryDirectory() as directory:
+        for _ in range(cycles):
+            start = clock.now_us
+            # make_sensors() lets the sensors settle before anything else
+            clock.advance_ms(settle_ms)
+            duty_cycle = DutyCycle(sensors, {"outside": {"type": "dht"}, "pressure": {"type": "bme"}}, "bench",
+                                   woke_at=start // 1000, state_file=directory + "/state",
+                                   buffer_file=directory + "/buffer", **settings)
+            try:
+                duty_cycle.run(environment.connect_wifi, environment.make_transport, environment.serve_ota)
+            except hostsim.Reset:
+                pass
+            awake_ms += (clock.now_us - start) // 1000 - machine.slept_ms + BOOT_MS
+            wifi_ms += duty_cycle.wifi_ms
+            sleep_ms += machine.slept_ms - BOOT_MS
+
+    return awake_ms, wifi_ms, sleep_ms, cycles
+
+
+def main():
+
+    sleep_ma = float(sys.argv[1]) if len(sys.argv) > 1 else 0.01
+    capacity_mah = float(sys.argv[2]) if len(sys.argv) > 2 else 2000
+
+    print(f"{DAYS} days each, {sleep_ma} mA asleep, {AWAKE_MA} mA awake, {WIFI_MA} mA with wifi, {capacity_mah:.0f} mAh")
+    for name, settings in CONFIGURATIONS:
+        awake_ms, wifi_ms, sleep_ms, cycles = run(settings)
+        total_ms = awake_ms + sleep_ms
+        charge_mah = (awake_ms * AWAKE_MA + wifi_ms * (WIFI_MA - AWAKE_MA) + sleep_ms * sleep_ma) / 3600000
+        mean_ma = charge_mah * 3600000 / total_ms
+        print(f"{name}:")
+        print(f"  {awake_ms / cycles:.0f} ms awake per cycle ({wifi_ms / cycles:.0f} ms of it with wifi), "
+              f"awake {100 * awake_ms / total_ms:.2f}% of the time")
+        print(f"  {mean_ma:.3f} mA on average, {capacity_mah / mean_ma / 24:.0f} days on a battery")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+# simulates an exception storm in the main loop and compares the gelf
+# logger with sending one datagram per message, as the old logger did.
+#
+# usage: python bench_gelf.py [number of messages]
+
+import socket
+import sys
+import time
+import traceback
+
+import hostsim
+clock = hostsim.install()
+
+from gelf import GelfLogger
+
+
+def make_traceback(i):
+    try:
+        raise OSError(110 + i % 3)
+    except OSError:
+        return traceback.format_exc()
+
+
+def receive_all(listener):
+    datagrams = 0
+    received_bytes = 0
+    while True:
+        try:
+            received_bytes += len(listener.recv(65536))
+            datagrams += 1
+        except BlockingIOError:
+            return datagrams, received_bytes
+
+
+def main():
+
+    num_messages = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    tracebacks = [make_traceback(i) for i in range(3)]
+
+    listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 22)
+    listener.bind(("127.0.0.1", 0))
+    listener.setblocking(False)
+
+    # the old way: one unstructured datagram per message
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sender.connect(listener.getsockname())
+    start = time.perf_counter()
+    for i in range(num_messages):
+        sender.send(tracebacks[i % 3].encode("ascii"))
+    naive_time = time.perf_counter() - start
+    naive_datagrams, naive_bytes = receive_all(listener)
+
+    # the gelf logger, with the main loop polling it. the storm lasts a
+    # minute of virtual time.
+    logger = GelfLogger(listener.getsockname())
+    start = time.perf_counter()
+    for i in range(num_messages):
+        clock.advance_us(60000000 // num_messages)
+        logger.error("exception in main loop", full_message=tracebacks[i % 3])
+        logger.poll()
+    logger.flush()
+    gelf_time = time.perf_counter() - start
+    gelf_datagrams, gelf_bytes = receive_all(listener)
+
+    print(f"{num_messages} messages in one minute")
+    print(f"  one datagram each: {num_messages / naive_time:10.0f} messages/s, {naive_datagrams:6} datagrams, {naive_bytes:9} bytes")
+    print(f"  gelf logger:       {num_messages / gelf_time:10.0f} messages/s, {gelf_datagrams:6} datagrams, {gelf_bytes:9} bytes")
+    print(f"  ({logger.deduplicated} deduplicated, {logger.suppressed} suppressed, {logger.dropped} dropped)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+# drives the IRQCounter interrupt handler through a fake pin at high event
+# rates and reports how long the handler takes on this machine.
+#
+# usage: python bench_irq_counter.py [rate in Hz] [duration in s]
+
+import sys
+import time
+import tracemalloc
+
+import hostsim
+clock = hostsim.install()
+
+from irq_counter import IRQCounter
+
+
+def main():
+
+    rate = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    duration = int(sys.argv[2]) if len(sys.argv) > 2 else 60
+
+    pin = hostsim.FakePin(4)
+    counter = IRQCounter(pin, hostsim.FakePin.IRQ_RISING, cooldown=0)
+    counter.poll()
+
+    handler = pin.handler
+    period_us = 1000000 / rate
+    events = 0
+    handler_time = 0.
+
+    tracemalloc.start()
+    memory_before = tracemalloc.get_traced_memory()[0]
+
+    for second in range(duration):
+        start = time.perf_counter()
+        for i in range(rate):
+            clock.now_us = int((second * rate + i) * period_us)
+            handler(pin)
+        handler_time += time.perf_counter() - start
+        events += rate
+        counter.poll()
+
+    memory_growth = tracemalloc.get_traced_memory()[0] - memory_before
+    tracemalloc.stop()
+
+    start = time.perf_counter()
+    data = counter.readout()
+    readout_time = time.perf_counter() - start
+
+    print(f"events:          {events} at {rate} Hz over {duration} s (virtual time)")
+    print(f"handler:         {handler_time / events * 1e9:.0f} ns/event (including the fake clock)")
+    print(f"memory growth:   {memory_growth} bytes")
+    print(f"readout:         {readout_time * 1e6:.0f} us")
+    for name, value in data.items():
+        print(f"  {name}: {value}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+# pushes a day's worth of readings (three sensors sampled every 10 s,
+# pushed every minute) through lossy links to a local collector, and
+# reports throughput and loss.
+#
+# usage: python bench_push_exporter.py [drop probability]
+
+import random
+import socket
+import sys
+import time
+
+import hostsim
+clock = hostsim.install()
+
+from push_exporter import PushExporter, UDPTransport, HTTPTransport
+from test_push_exporter import Collector
+
+SAMPLES = 24 * 60 * 6
+
+
+class LossyUDPTransport(UDPTransport):
+    """ drops datagrams silently, like a bad link would """
+
+    def __init__(self, host, port, drop_probability):
+        super().__init__(host, port)
+        self.drop_probability = drop_probability
+
+    def send(self, payload):
+        if random.random() >= self.drop_probability:
+            super().send(payload)
+
+
+def run(exporter):
+    start = time.perf_counter()
+    for i in range(SAMPLES):
+        exporter.add("kitchen", "bme", {"temperature": 21.5, "humidity": 40.25, "pressure": 1013.25})
+        exporter.add("co2", "mhz", {"co2_concentration": 400 + i % 100, "temperature": 23, "status": 0})
+        exporter.add("particles", "sds", {"pm2_5_ug_m3": 3.4, "pm10_ug_m3": 7.8})
+        clock.advance_ms(10000)
+        exporter.poll()
+    exporter.push()
+    return time.perf_counter() - start
+
+
+def report(name, exporter, delivered, elapsed):
+    total = 3 * SAMPLES
+    print(f"{name}:")
+    print(f"  {total / elapsed:.0f} lines/s, {exporter.bytes_sent} bytes sent")
+    print(f"  {delivered} of {total} lines delivered ({100 * (total - delivered) / total:.1f}% lost), "
+          f"{exporter.push_errors} failed pushes, {exporter.lines_dropped} lines dropped from the buffer")
+
+
+def main():
+
+    drop_probability = float(sys.argv[1]) if len(sys.argv) > 1 else 0.1
+    random.seed(1)
+
+    listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 22)
+    listener.bind(("127.0.0.1", 0))
+    listener.setblocking(False)
+
+    exporter = PushExporter(LossyUDPTransport(*listener.getsockname(), drop_probability), "bench")
+    elapsed = run(exporter)
+    delivered = 0
+    while True:
+        try:
+            delivered += len(listener.recv(65536).splitlines())
+        except BlockingIOError:
+            break
+    report(f"udp, {drop_probability:.0%} of datagrams dropped", exporter, delivered, elapsed)
+
+    collector = Collector(fail=lambda: random.random() < drop_probability)
+    exporter = PushExporter(HTTPTransport("127.0.0.1", collector.server_address[1], "/write"), "bench")
+    elapsed = run(exporter)
+    report(f"http, {drop_probability:.0%} of requests failing", exporter, len(collector.lines), elapsed)
+    collector.shutdown()
+
+
+if __name__ == "__main__":
+    main()
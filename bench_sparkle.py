@@ -0,0 +1,64 @@
+# compares making a new Sparkle from the glitter for every request (as
+# boot.py used to) with a SparkleKey that's created once, for short
+# messages (deletes) and for whole files, fed in chunks as they arrive.
+#
+# usage: python bench_sparkle.py [file size in KiB]
+
+import sys
+import time
+
+from sparkle import Sparkle, SparkleKey
+
+glitter = bytes(range(32))
+
+
+def measure(function, repetitions):
+    start = time.perf_counter()
+    for _ in range(repetitions):
+        function()
+    return (time.perf_counter() - start) / repetitions
+
+
+def main():
+
+    file_size = (int(sys.argv[1]) if len(sys.argv) > 1 else 64) * 1024
+    content = bytes(i % 251 for i in range(file_size))
+    chunks = [content[i:i + 4096] for i in range(0, file_size, 4096)]
+    prefix = b"@1760000000000 boot.py "
+
+    key = SparkleKey(glitter)
+    expected = key.sign(prefix + content)
+
+    def old_short():
+        Sparkle(glitter, b"@1760000000000 boot.py").make_sparkle() == expected
+
+    def new_short():
+        key.verify(key.start(b"@1760000000000 boot.py"), expected)
+
+    def old_file():
+        # the whole file has to be in memory, and is copied once more
+        Sparkle(glitter, prefix + content).make_sparkle() == expected
+
+    def new_file():
+        sparkle = key.start(prefix)
+        for chunk in chunks:
+            sparkle.update(chunk)
+        key.verify(sparkle, expected)
+
+    repetitions = 20000
+    old = measure(old_short, repetitions)
+    new = measure(new_short, repetitions)
+    print("short messages (delete):")
+    print(f"  Sparkle per request: {1 / old:9.0f} verifications/s")
+    print(f"  SparkleKey:          {1 / new:9.0f} verifications/s ({old / new:.1f}x)")
+
+    repetitions = max(1, 20000000 // file_size)
+    old = measure(old_file, repetitions)
+    new = measure(new_file, repetitions)
+    print(f"{file_size // 1024} KiB files (put):")
+    print(f"  Sparkle per request: {file_size / old / 1e6:9.1f} MB/s")
+    print(f"  SparkleKey, chunked: {file_size / new / 1e6:9.1f} MB/s ({old / new:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
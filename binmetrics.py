@@ -0,0 +1,91 @@
+# compact binary encoding of the metrics that boot.py collects.
+#
+# the schema (a json list of metric names and labels) is served separately,
+# and only changes when the device configuration changes. each scrape then
+# only transfers a fixed-layout block of 4 byte values:
+#
+#   magic "HT", format version (u8), reserved (u8), schema id (u32),
+#   sequence number (u32), number of values (u16), int flags (one bit per
+#   value, (n + 7) // 8 bytes), values (i32 if the value's flag is set,
+#   f32 otherwise)
+#
+# ints (counters, mostly) are sent as i32, since f32 only holds them
+# exactly up to 2^24. everything is little-endian. metrics without a
+# value are nan. the schema
+# id is the start of the sha1 of the schema, so collectors know when they
+# have to fetch it again.
+
+import struct
+import json
+import hashlib
+
+MAGIC = b"HT"
+FORMAT_VERSION = 2
+HEADER_FORMAT = "<2sBBIIH"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+
+NAN = float("nan")
+
+INT32_MIN = -0x80000000
+INT32_MAX = 0x7fffffff
+
+def flags_size(num_values):
+    return (num_values + 7) // 8
+
+
+class BinaryMetrics:
+
+    def __init__(self, metrics):
+        """ metrics is a list of (name, sensor label, labels) for every
+            metric that might be reported, where labels is a dict. the
+            sensor label is None for device-wide metrics. the same name
+            twice for one sensor label raises a ValueError. """
+
+        # sensor label -> metric name -> slot
+        self._slots = {}
+        entries = []
+        for slot, (name, sensor_label, labels) in enumerate(metrics):
+            if sensor_label not in self._slots:
+                self._slots[sensor_label] = {}
+            # one of the two slots would never get a value
+            if name in self._slots[sensor_label]:
+                raise ValueError("{} is in the metrics of {} twice".format(name, sensor_label))
+            self._slots[sensor_label][name] = slot
+            entries.append([name, labels])
+
+        metrics_json = json.dumps(entries)
+        self.schema_id = struct.unpack("<I", hashlib.sha1(metrics_json.encode("utf-8")).digest()[:4])[0]
+        self.schema = '{{"format": {}, "schema_id": {}, "metrics": {}}}'.format(
+                FORMAT_VERSION, self.schema_id, metrics_json)
+
+        self._num_values = len(entries)
+        self._values_offset = HEADER_SIZE + flags_size(self._num_values)
+        self._buf = bytearray(self._values_offset + 4 * self._num_values)
+        self.sequence = 0
+
+    def pack(self, metrics):
+        """ metrics is a list of (name, sensor label, value). returns the
+            encoded values (in a buffer that is reused for the next call). """
+
+        self.sequence = (self.sequence + 1) & 0xffffffff
+        struct.pack_into(HEADER_FORMAT, self._buf, 0,
+                MAGIC, FORMAT_VERSION, 0, self.schema_id, self.sequence, self._num_values)
+
+        buf = self._buf
+        values_offset = self._values_offset
+        for i in range(HEADER_SIZE, values_offset):
+            buf[i] = 0
+        for slot in range(self._num_values):
+            struct.pack_into("<f", buf, values_offset + 4 * slot, NAN)
+
+        for name, sensor_label, value in metrics:
+            slot = self._slots.get(sensor_label, {}).get(name)
+            if slot is None:
+                continue
+            if type(value) == int and INT32_MIN <= value <= INT32_MAX:
+                struct.pack_into("<i", buf, values_offset + 4 * slot, value)
+                buf[HEADER_SIZE + slot // 8] |= 1 << (slot % 8)
+            else:
+                struct.pack_into("<f", buf, values_offset + 4 * slot, value)
+
+        return self._buf
@@ -0,0 +1,129 @@
+import argparse
+import json
+import math
+import struct
+import sys
+import urllib.request
+
+from binmetrics import MAGIC, FORMAT_VERSION, HEADER_FORMAT, HEADER_SIZE, flags_size
+
+
+def make_argument_parser():
+
+    parser = argparse.ArgumentParser(description="fetch binary metrics from a device and print them in prometheus text format")
+    parser.add_argument("device", type=str,
+                        help="device name; it has to resolve to the IP of the device.")
+    parser.add_argument("--schema-cache", type=str, default=None,
+                        help="file to cache the device's schema in (default: .<device>.schema.json)")
+
+    return parser
+
+
+def decode(schema, data):
+    """ returns the sequence number and a list of (name, labels, value),
+        leaving out metrics without a value """
+
+    magic, version, _, schema_id, sequence, num_values = struct.unpack_from(HEADER_FORMAT, data)
+
+    if magic != MAGIC or version != FORMAT_VERSION:
+        raise RuntimeError("not a binary metrics response, or an unsupported version")
+
+    if schema_id != schema["schema_id"]:
+        raise RuntimeError("schema has changed")
+
+    values_offset = HEADER_SIZE + flags_size(num_values)
+    if len(data) != values_offset + 4 * num_values or num_values != len(schema["metrics"]):
+        raise RuntimeError("binary metrics response has the wrong length")
+
+    metrics = []
+    for slot, (name, labels) in enumerate(schema["metrics"]):
+        if data[HEADER_SIZE + slot // 8] & (1 << (slot % 8)):
+            value, = struct.unpack_from("<i", data, values_offset + 4 * slot)
+        else:
+            value, = struct.unpack_from("<f", data, values_offset + 4 * slot)
+            if math.isnan(value):
+                continue
+        metrics.append((name, labels, value))
+
+    return sequence, metrics
+
+
+def format_float32(value):
+    """ the shortest text that is the same float32, like the device would
+        print it """
+
+    for precision in range(1, 10):
+        text = f"{value:.{precision}g}"
+        if struct.pack("<f", float(text)) == struct.pack("<f", value):
+            return text
+    return repr(value)
+
+
+def to_prometheus_text(metrics):
+    """ the same text as the device's /metrics """
+
+    names = []
+    for name, _, _ in metrics:
+        if name not in names:
+            names.append(name)
+
+    lines = [f"# TYPE {name} gauge" for name in names]
+    for name, labels, value in metrics:
+        if type(value) == int:
+            text = str(value)
+        elif labels:
+            text = f"{value:.3f}"
+        else:
+            text = format_float32(value)
+
+        if labels:
+            label_string = ", ".join(f'{key}="{label_value}"' for key, label_value in labels.items())
+            lines.append(f"{name}{{{label_string}}} {text}")
+        else:
+            lines.append(f"{name} {text}")
+
+    return "\n".join(lines) + "\n"
+
+
+def get_schema(device, cache_filename, refresh=False):
+
+    if not refresh:
+        try:
+            with open(cache_filename) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            pass
+
+    with urllib.request.urlopen(f"http://{device}:5000/metrics.schema") as response:
+        schema = json.load(response)
+
+    with open(cache_filename, "w") as f:
+        json.dump(schema, f)
+
+    return schema
+
+
+def fetch_metrics(device, cache_filename):
+
+    schema = get_schema(device, cache_filename)
+
+    with urllib.request.urlopen(f"http://{device}:5000/metrics.bin") as response:
+        data = response.read()
+
+    try:
+        return decode(schema, data)
+
+    except RuntimeError:
+        # probably a new configuration, try again with the current schema
+        schema = get_schema(device, cache_filename, refresh=True)
+        return decode(schema, data)
+
+
+if __name__ == "__main__":
+
+    parser = make_argument_parser()
+    args = parser.parse_args()
+
+    cache_filename = args.schema_cache or f".{args.device}.schema.json"
+    sequence, metrics = fetch_metrics(args.device, cache_filename)
+    sys.stdout.write(to_prometheus_text(metrics))
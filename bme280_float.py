@@ -80,7 +80,28 @@ MODE_SLEEP = const(0)
 MODE_FORCED = const(1)
 MODE_NORMAL = const(3)
 
-BME280_TIMEOUT = const(100)  # about 1 second timeout
+
+def measurement_time_us(temperature_oversampling, pressure_oversampling,
+                        humidity_oversampling):
+    """ Maximum duration of a forced-mode measurement in microseconds,
+        following the formula in appendix B of the datasheet.
+
+        Args:
+            temperature_oversampling, pressure_oversampling,
+            humidity_oversampling: BME280_OSAMPLE_* values, or 0 if the
+            measurement is skipped
+    """
+    t_os = 1 << temperature_oversampling >> 1
+    p_os = 1 << pressure_oversampling >> 1
+    h_os = 1 << humidity_oversampling >> 1
+
+    time_us = 1250 + 2300 * t_os
+    if p_os:
+        time_us += 2300 * p_os + 575
+    if h_os:
+        time_us += 2300 * h_os + 575
+
+    return time_us
 
 class BME280Config:
 
@@ -120,6 +141,9 @@ class BME280:
         self._temperature_oversampling = temperature_oversampling
         self._humidity_oversampling = humidity_oversampling
         self._filter = filter_value
+        self.measurement_time_us = measurement_time_us(
+            temperature_oversampling, pressure_oversampling,
+            humidity_oversampling)
         self.address = address
         if i2c is None:
             raise ValueError('An I2C object is required.')
@@ -148,22 +172,19 @@ class BME280:
 
         self.t_fine = 0
 
-    def read_raw_data(self, result):
-        """ Reads the raw (uncompensated) data from the sensor.
+    def start_measurement(self):
+        """ Triggers a single forced-mode measurement and returns
+            immediately. The result can be collected with
+            collect_raw_data() once measurement_time_us has passed.
 
-            Args:
-                result: array of length 3 or alike where the result will be
-                stored, in temperature, pressure, humidity order
             Returns:
-                None
+                the maximum measurement time in microseconds
         """
 
         # set filter constant
         # (the other two fields default to zero, and we don't need them,
         # so we're leaving them there.)
         self._l1_barray[0] = self._filter << 2
-        print("self._filter:", self._filter)
-        print("writing value:", self._l1_barray)
         self.i2c.writeto_mem(self.address, BME280_REGISTER_CONFIG,
                              self._l1_barray)
 
@@ -177,13 +198,25 @@ class BME280:
         self.i2c.writeto_mem(self.address, BME280_REGISTER_CONTROL,
                              self._l1_barray)
 
-        # Wait for conversion to complete
-        for _ in range(BME280_TIMEOUT):
-            if self.i2c.readfrom_mem(self.address, BME280_REGISTER_STATUS, 1)[0] & 0x08:
-                time.sleep_ms(10)  # still busy
-            else:
-                break  # Sensor ready
-        else:
+        return self.measurement_time_us
+
+    def collect_raw_data(self, result):
+        """ Reads the raw (uncompensated) data of a measurement started
+            with start_measurement(). The caller has to make sure that
+            at least measurement_time_us have passed since then.
+
+            Args:
+                result: array of length 3 or alike where the result will be
+                stored, in temperature, pressure, humidity order
+            Returns:
+                None
+        """
+
+        # the measurement time is the datasheet maximum, so a single
+        # check is enough here
+        self.i2c.readfrom_mem_into(self.address, BME280_REGISTER_STATUS,
+                                   self._l1_barray)
+        if self._l1_barray[0] & 0x08:
             raise RuntimeError("Sensor BME280 not ready")
 
         # burst readout from 0xF7 to 0xFE, recommended by datasheet
@@ -200,6 +233,19 @@ class BME280:
         result[1] = raw_press
         result[2] = raw_hum
 
+    def read_raw_data(self, result):
+        """ Reads the raw (uncompensated) data from the sensor.
+
+            Args:
+                result: array of length 3 or alike where the result will be
+                stored, in temperature, pressure, humidity order
+            Returns:
+                None
+        """
+
+        time.sleep_us(self.start_measurement())
+        self.collect_raw_data(result)
+
     def read_compensated_data(self, result=None):
         """ Reads the data from the sensor and returns the compensated data.
 
@@ -213,7 +259,21 @@ class BME280:
                 from the result parameter if not None
         """
         self.read_raw_data(self._l3_resultarray)
-        raw_temp, raw_press, raw_hum = self._l3_resultarray
+        return self.compensate(self._l3_resultarray, result)
+
+    def compensate(self, raw, result=None):
+        """ Computes the compensated data from raw sensor data, e.g. as
+            returned by collect_raw_data().
+
+            Args:
+                raw: array of length 3 or alike with the raw temperature,
+                pressure and humidity values
+                result: see read_compensated_data()
+
+            Returns:
+                see read_compensated_data()
+        """
+        raw_temp, raw_press, raw_hum = raw
         # temperature
         var1 = (raw_temp/16384.0 - self.dig_T1/1024.0) * self.dig_T2
         var2 = raw_temp/131072.0 - self.dig_T1/8192.0
@@ -1,19 +1,41 @@
 import bme280_float
+from array import array
+import time
 
 class BME280Sensor:
 
     provides = ["temperature", "humidity", "pressure"]
+    # what boot.py keeps min/max/mean of between scrapes
+    aggregates = ["temperature", "humidity", "pressure"]
 
-    def __init__(self, port):
+    def __init__(self, port, address=bme280_float.BME280_I2CADDR):
 
         self._sensor = bme280_float.BME280(
             i2c=port,
+            address=address,
             filter_value=bme280_float.BME280_FILTER_OFF,
             pressure_oversampling=bme280_float.BME280_OSAMPLE_8,
             temperature_oversampling=bme280_float.BME280_OSAMPLE_1,
             humidity_oversampling=bme280_float.BME280_OSAMPLE_1
         )
 
-    def readout(self):
-        temperature, pressure, humidity = self._sensor.read_compensated_data()
+        # expected duration of a conversion, for schedulers that want to
+        # do something else while the sensor is busy
+        self.conversion_time_us = self._sensor.measurement_time_us
+
+        self._raw = array("i", [0, 0, 0])
+        self._compensated = array("f", [0, 0, 0])
+
+    def start(self):
+        """ Starts a conversion and returns the time in microseconds after
+            which the result can be fetched with collect(). """
+        return self._sensor.start_measurement()
+
+    def collect(self):
+        self._sensor.collect_raw_data(self._raw)
+        temperature, pressure, humidity = self._sensor.compensate(self._raw, self._compensated)
         return {"temperature": temperature, "humidity": humidity, "pressure": pressure/100.}
+
+    def readout(self):
+        time.sleep_us(self.start())
+        return self.collect()
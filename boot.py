@@ -6,369 +6,457 @@ import uos
 import usys
 import gc
 import utime
-import ure
-import hashlib
-from sparkle import Sparkle
 import ubinascii
 import uio
-from irq_counter import IRQCounter
-from bme280_sensor import BME280Sensor
-from dht22_sensor import DHT22Sensor
-from mhz19_sensor import MHZ19Sensor
-from sds011_sensor import SDS011Sensor
-
+from gelf import GelfLogger
+from watchdog import Watchdog
+from ota import OTAHandler, remove_stale_uploads
+from wifi_manager import WifiManager, CONNECTED
+
+import config
+# this is only read once. deploy.py reboots when it changes, see
+# hot_reload.BOOT_SETTINGS
 from config import sensor_configs, hostname
 
-class GrayLogger:
-
-    def __init__(self, ingest_location=("10.23.40.2", 5555)):
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.socket.connect(ingest_location)
-
-    def send(self, data):
-        print("sending data to graylog")
-        if type(data) == "str":
-            data = data.encode("ascii")
-
-        self.socket.send(data)
-
-
-def make_response_section(name, label, description, sensor_type, value):
+# reported in addition to the sensor metrics
+device_vars = ["wifi_rssi", "memory_used", "memory_free", "last_connection_duration_ms"]
 
-    if type(value) == float:
-        fmt = ".3f"
+# for the request statistics. anything that can't be parsed counts as
+# invalid, so that has to be last.
+endpoints = ["metrics", "metrics.bin", "metrics.schema", "config", "ota-listing", "ota", "reboot", "reload", "log", "webroot", "invalid"]
 
-    elif type(value) == int:
-        fmt = "d"
 
-    return """
-{0}{{label="{1}", description="{2}", type="{3}"}} {4:{fmt}}""".format(name, label, description, sensor_type, value, fmt=fmt)
+watchdog = Watchdog()
 
+# boards on a battery sample, push every now and then, and go back to deep
+# sleep, see dutycycle.py. after too many crashes, they stay awake in
+# fallback mode like everyone else.
+if getattr(config, "run_mode", "server") == "duty_cycle" and not watchdog.fallback:
+    import dutycycle
+    dutycycle.main(config, watchdog)
 
 wlan = network.WLAN(network.STA_IF)
 wlan.active(True)
 wlan.config(dhcp_hostname=hostname)
-if not wlan.isconnected():
-    print('connecting to network...')
-    wlan.connect(wifi_secrets.wifi_ssid, wifi_secrets.wifi_passphrase)
-    while not wlan.isconnected():
-        pass
-print('network config:', wlan.ifconfig())
-print('signal strength:', wlan.status("rssi"))
-
-logger = GrayLogger()
-logger.send("hi!")
+wifi = WifiManager(wlan, wifi_secrets.wifi_ssid, wifi_secrets.wifi_passphrase)
+print('connecting to network...')
+# without wifi, we still log readings to flash, and keep trying to connect
+# in the main loop
+if wifi.connect(getattr(config, "wifi_boot_timeout_s", 120) * 1000):
+    print('network config:', wlan.ifconfig())
+    print('signal strength:', wlan.status("rssi"))
+else:
+    print("no network, going on without it")
+
+def set_time():
+    """ pushed readings and log messages need the correct time """
+    try:
+        import ntptime
+        ntptime.settime()
+        return True
+    except Exception as e:
+        print("couldn't set the time:", e)
+        return False
+
+time_set = set_time()
+
+logger = GelfLogger(host=hostname)
+logger.info("hi!")
+
+if watchdog.last_stall:
+    logger.warning("the watchdog reset the device, it was stuck in stage {}".format(watchdog.last_stall))
+if watchdog.fallback:
+    logger.error("crashed {} times in a row, starting in fallback mode".format(watchdog.crash_count))
+logger.flush()
 
 listener = None
 
 try:
 
+    watchdog.start()
+    watchdog.stage(b"setup", 30000)
+
     with open("glitter", "r") as f:
         hex_glitter = f.read()
         glitter = ubinascii.unhexlify(hex_glitter)
 
-    # extra 3.3v pin (for connecting two sensors at once)
-    machine.Pin(13, machine.Pin.OUT).on()
-
-    print("before sleep")
+    # resumable uploads don't survive a reset, so that nobody can fill the
+    # flash with .part files that are never committed
+    remove_stale_uploads()
 
-    # wait for dht sensor to stabilize
-    utime.sleep(2)
-
-    # initialize sensor objects
-    sensors = {}
-    provided_vars = set()
-    for sensor_label, config in sensor_configs.items():
-        if config["type"] == "dht":
-            sensors[sensor_label] = DHT22Sensor(config["port"], **config.get("settings", {}))
-        
-        elif config["type"] == "bme":
-            sensors[sensor_label] = BME280Sensor(config["port"], **config.get("settings", {}))
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(("0.0.0.0", 5000))
+    listener.listen(1)
+    # don't block in accept() forever, so that we get to poll the sensors
+    listener.settimeout(1)
 
-        elif config["type"] == "mhz":
-            sensors[sensor_label] = MHZ19Sensor(config["port"], **config.get("settings", {}))
+    # for updating from an old deploy.py, which doesn't add timestamps to
+    # its sparkles (and so doesn't protect against replays)
+    allow_unstamped_sparkle = getattr(config, "ota_allow_unstamped_sparkle", False)
 
-        elif config["type"] == "sds":
-            sensors[sensor_label] = SDS011Sensor(config["port"], **config.get("settings", {}))
+    if watchdog.fallback:
+        import fallback
+        fallback.serve(listener, OTAHandler(glitter, allow_unstamped=allow_unstamped_sparkle), watchdog, logger, wifi)
 
-        elif config["type"] == "counter":
-            sensors[sensor_label] = IRQCounter(config["port"], **config.get("settings", {}))
+    def send(connection, data):
+        stats.sent(connection.send(data))
 
-        provided_vars.update(set(sensors[sensor_label].provides))
+    def recv(connection, size):
+        data = connection.recv(size)
+        stats.received(len(data))
+        return data
 
-    provided_vars = list(provided_vars)
+    def collect_garbage():
+        stats.collect_garbage()
 
-    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    listener.bind(("0.0.0.0", 5000))
-    listener.listen(1)
+    # this (like wifi, the listener, the watchdog and the logger) is kept
+    # across reloads
+    ota_handler = OTAHandler(glitter, send=send, recv=recv, collect_garbage=collect_garbage,
+                             allow_unstamped=allow_unstamped_sparkle)
 
-    last_connection_duration = 0
+    # everything from here on depends on config.py and the sensor modules,
+    # and is set up again after /reload, see hot_reload.py
+    reload_requested = False
+    settle_ms = 2000
 
     while True:
-        connection = None
-        try:
-            connection, peer = listener.accept()
-            connection_start = utime.ticks_ms()
-            request = connection.recv(400)
-
-            print(request)
-            method, url, protocol = request.split(b"\r\n", 1)[0].split(b" ")
-            path = url.split(b"/", 1)[1]
-            print("incoming request: method {}, url {}, path {}, protocol {}".format(method, url, path, protocol))
-            respond_404 = False
-
-            if path == b"metrics":
-
-                response_body = "".join("# TYPE {} gauge\n".format(var)
-                        for var in provided_vars)
-
-                for sensor_label in sensors.keys():
-                    sensor = sensors[sensor_label]
-                    sensor_config = sensor_configs[sensor_label]
-
-                    data = sensor.readout()
-
-                    for name, value in data.items():
-                        response_body += make_response_section(
-                                name,
-                                sensor_label,
-                                sensor_config["description"],
-                                sensor_config["type"],
-                                value)
-
-                response_body += """
-
-# TYPE wifi_rssi gauge
-# TYPE memory_used gauge
-# TYPE memory_free gauge
-# TYPE last_connection_duration_ms gauge
-wifi_rssi {}
-memory_used {}
-memory_free {}
-last_connection_duration_ms {}
-                """.format(wlan.status("rssi"), gc.mem_alloc(), gc.mem_free(), last_connection_duration)
-
-                connection.send("HTTP/1.1 200 OK\r\nContent-Length: {}\r\nContent-Type: text/plain; version=0.0.4\r\n\r\n".format(len(response_body)) + response_body)
-
-            elif path == b"config":
-                with open("config.py", "rb") as f:
-                    data = f.read()
-                    connection.send("HTTP/1.1 200 OK\r\nContent-Length: {}\r\n\r\n".format(len(data)).encode("ascii") + data)
-
-            elif path == b"ota-listing":
-
-                files = []
-
-                for entry_info in uos.ilistdir("/"):
-                    name = entry_info[0]
-                    entry_type = entry_info[1]
-
-                    if name == "glitter":
-                        continue
-
-                    if entry_type & 0x8000:
-                        # compute a git-compatible hash
-                        hasher = hashlib.sha1(b"blob ")
-                        with open(name, "rb") as f:
-                            length = f.seek(0, 2)
-                            f.seek(0)
-
-                            hasher.update(str(length).encode("ascii") + bytes([0]))
-
-                            while True:
-                                chunk = f.read(10000)
-                                if len(chunk) == 0:
-                                    break
-                                hasher.update(chunk)
-                                del chunk
-                                gc.collect()
-
-                        checksum = ubinascii.hexlify(hasher.digest())
-
-                        files.append(name.encode("ascii") + b" " + checksum)
-
-                response = b"\n".join(files)
-                connection.send("HTTP/1.1 200 OK\r\nContent-Length: {}\r\n\r\n".format(len(response)).encode("ascii") + response)
-
-            elif path.startswith(b"ota/"):
-
-                path = path.decode("ascii")
-                path = path.split("?")[0]
-                path_parts = path.split("/")[1:]
-                if len(path_parts) > 1:
-                    body = b"ota is currently not supported for files in directories other than /"
-                    connection.send("HTTP/1.1 404 not found\r\nContent-Length: {}\r\n\r\n".format(len(body)).encode("ascii") + body)
-                    continue
 
-                filename = path_parts[0]
-                if not ure.match(r"[0-9a-zA-Z_.]+$", filename):
-                    body = b"invalid filename: may only contain digits, letters, or underscore"
-                    connection.send("HTTP/1.1 400 bad request\r\nContent-Length: {}\r\n\r\n".format(len(body)).encode("ascii") + body)
+        import config
+        from config import sensor_configs
+        if getattr(config, "run_mode", "server") != "server":
+            # switching modes takes a reboot
+            machine.reset()
+
+        # these are imported only now, so that a broken module can't keep
+        # the fallback mode from starting
+        import hot_reload
+        from sensor_setup import make_sensors
+        from circuit_breaker import CircuitBreaker, render_text as render_breaker_text
+        from aggregator import MetricAggregator, SUFFIXES
+        from exposition import render_text
+        from binmetrics import BinaryMetrics
+        from i2c_bus import render_text as render_bus_text
+        from instrumentation import Instrumentation
+        from push_exporter import PushExporter, make_transport
+        from tslog import TimeSeriesLog
+
+        sensors, i2c_buses = make_sensors(sensor_configs, settle_ms)
+
+        # a broken sensor is left alone for a while, with its last good
+        # values served instead, rather than being retried at full cost on
+        # every scrape
+        sensors = {sensor_label: CircuitBreaker(sensor,
+                                                failure_threshold=getattr(config, "breaker_failures", 3),
+                                                min_open_ms=getattr(config, "breaker_min_open_s", 10) * 1000,
+                                                max_open_ms=getattr(config, "breaker_max_open_s", 600) * 1000)
+                   for sensor_label, sensor in sensors.items()}
+
+        provided_vars = set()
+        for sensor in sensors.values():
+            provided_vars.update(set(sensor.provides))
+        provided_vars = list(provided_vars)
+
+        stats = Instrumentation(endpoints, sensors.keys())
+
+        # the watchdog stage of every sensor readout, as bytes for rtc memory
+        sensor_stages = {sensor_label: b"readout " + sensor_label.encode("ascii") for sensor_label in sensors}
+
+        def read_sensor(sensor_label, sensor):
+            watchdog.nested_stage(sensor_stages[sensor_label], 5000)
+            try:
+                return stats.readout(sensor_label, sensor)
+            finally:
+                watchdog.end_nested_stage()
+
+        def sample_sensor(sensor_label, sensor):
+            watchdog.nested_stage(sensor_stages[sensor_label], 5000)
+            try:
+                return stats.sample(sensor_label, sensor)
+            finally:
+                watchdog.end_nested_stage()
+
+        # sensors are sampled every sample_interval_s in between scrapes, and
+        # the min/max/mean of their aggregates are exported next to the
+        # current values. sampling goes through sensor.sample(), which
+        # (unlike the readout) doesn't reset anything the scrapes report.
+        sample_interval = int(getattr(config, "sample_interval_s", 10) * 1000)
+        aggregator = MetricAggregator(
+                {sensor_label: sensor.aggregates for sensor_label, sensor in sensors.items()},
+                window_s=getattr(config, "aggregation_window_s", None))
+        last_sample = utime.ticks_ms()
+
+        aggregated_vars = set()
+        for sensor in sensors.values():
+            aggregated_vars.update(set(sensor.aggregates))
+        metric_names = provided_vars + [var + suffix for var in aggregated_vars for suffix in SUFFIXES] + device_vars
+        del aggregated_vars
+
+        # everything that might show up in /metrics, for the binary format
+        metric_index = []
+        # the raw readings, for the on-flash log
+        log_index = []
+        for sensor_label, sensor in sensors.items():
+            sensor_config = sensor_configs[sensor_label]
+            labels = {"label": sensor_label, "description": sensor_config["description"], "type": sensor_config["type"]}
+            metric_index += [(var, sensor_label, labels) for var in sensor.provides]
+            metric_index += [(var + suffix, sensor_label, labels) for var in sensor.aggregates for suffix in SUFFIXES]
+            log_index += [(var, sensor_label, labels) for var in sensor.provides]
+        metric_index += [(var, None, {}) for var in device_vars]
+        binary_metrics = BinaryMetrics(metric_index)
+        del metric_index
+
+        def read_metrics():
+            """ reads out all sensors, and returns a list of
+                (name, sensor label, value), where the sensor label is None for
+                device-wide metrics """
+
+            metrics = []
+
+            for sensor_label, sensor in sensors.items():
+                try:
+                    data = read_sensor(sensor_label, sensor)
+                except Exception:
+                    # no good values yet. the other sensors are still worth
+                    # reporting, and the error is counted.
                     continue
-
-                if filename == "wifi_secrets.py" or filename == "glitter":
-                    body = b"the glitter is secret!"
-                    connection.send("HTTP/1.1 403 forbidden\r\nContent-Length: {}\r\n\r\n".format(len(body)).encode("ascii") + body)
+                # old values would skew the statistics
+                if not sensor.stale:
+                    aggregator.add(sensor_label, data)
+                for name, value in data.items():
+                    metrics.append((name, sensor_label, value))
+
+            for sensor_label, name, minimum, maximum, mean, samples in aggregator.collect():
+                for suffix, value in zip(SUFFIXES, (minimum, maximum, mean, samples)):
+                    metrics.append((name + suffix, sensor_label, value))
+
+            metrics.append(("wifi_rssi", None, wlan.status("rssi") if wifi.state == CONNECTED else float("nan")))
+            metrics.append(("memory_used", None, gc.mem_alloc()))
+            metrics.append(("memory_free", None, gc.mem_free()))
+            metrics.append(("last_connection_duration_ms", None, last_connection_duration))
+
+            return metrics
+
+        # optionally, readings are also pushed to a collector, e.g.
+        # push_target = "udp://10.23.40.2:8089"
+        exporter = None
+        if getattr(config, "push_target", None):
+            exporter = PushExporter(
+                    make_transport(config.push_target),
+                    hostname,
+                    interval_s=getattr(config, "push_interval_s", 60))
+
+        # the samples are also logged to flash, so that they aren't lost while
+        # wifi or prometheus are down. log_budget_kb = 0 turns that off.
+        tslog = None
+        if sample_interval > 0 and getattr(config, "log_budget_kb", 256) > 0:
+            tslog = TimeSeriesLog(log_index,
+                                  segment_size=getattr(config, "log_segment_kb", 32) * 1024,
+                                  budget=getattr(config, "log_budget_kb", 256) * 1024,
+                                  send=send)
+        del log_index
+
+        # some sensors need to be looked after between requests
+        polled_sensors = [sensor for sensor in sensors.values() if hasattr(sensor, "poll")]
+
+        last_connection_duration = 0
+
+        if settle_ms == 0:
+            logger.info("reloaded in {} ms".format(utime.ticks_diff(utime.ticks_ms(), reload_start)))
+
+        while not reload_requested:
+            connection = None
+            try:
+                watchdog.stage(b"loop", 10000)
+                watchdog.poll()
+
+                for sensor in polled_sensors:
+                    sensor.poll()
+
+                if wifi.poll():
+                    logger.info("wifi reconnected ({} reconnects so far)".format(wifi.reconnects))
+                    if not time_set:
+                        time_set = set_time()
+
+                logger.poll()
+
+                if sample_interval > 0 and utime.ticks_diff(utime.ticks_ms(), last_sample) >= sample_interval:
+                    last_sample = utime.ticks_ms()
+                    for sensor_label, sensor in sensors.items():
+                        try:
+                            data = sample_sensor(sensor_label, sensor)
+                        except Exception:
+                            # counted in sensor_sample_errors_total, and by
+                            # the breaker
+                            continue
+                        if data is None:
+                            # nothing new, or the breaker is open
+                            continue
+
+                        aggregator.add(sensor_label, data)
+                        if exporter:
+                            exporter.add(sensor_label, sensor_configs[sensor_label]["type"], data)
+                        if tslog:
+                            tslog.add(sensor_label, data)
+
+                    if tslog:
+                        tslog.write_record()
+
+                if exporter:
+                    exporter.poll()
+
+                watchdog.stage(b"accept", 5000)
+                try:
+                    connection, peer = listener.accept()
+                except OSError:
+                    # timed out, nobody wants anything from us right now
                     continue
 
-
-                if method == b"GET":
-                    try:
-                        is_file = uos.stat(filename)[0] & 0x8000
-                    except:
-                        is_file = False
-
-                    if is_file:
-                        with open(filename, "rb") as f:
-                            data = f.read()
-                            connection.send("HTTP/1.1 200 OK\r\nContent-Length: {}\r\n\r\n".format(len(data)).encode("ascii") + data)
-
-                    else:
+                watchdog.stage(b"recv", 10000)
+                stats.start_request()
+                connection.settimeout(None)
+                request = recv(connection, 400)
+
+                print(request)
+                method, url, protocol = request.split(b"\r\n", 1)[0].split(b" ")
+                path = url.split(b"/", 1)[1]
+                print("incoming request: method {}, url {}, path {}, protocol {}".format(method, url, path, protocol))
+                respond_404 = False
+
+                # everything from here on is handling the request, which can take
+                # a while for ota
+                watchdog.stage(b"send", 60000)
+
+                if path == b"metrics":
+                    stats.set_endpoint("metrics")
+
+                    response_body = render_text(metric_names, read_metrics(), sensor_configs) + stats.render_text(sensor_configs) + render_breaker_text(sensors, sensor_configs) + wifi.render_text() + render_bus_text(i2c_buses.values()) + (tslog.render_text() if tslog else "") + watchdog.render_text()
+                    send(connection, "HTTP/1.1 200 OK\r\nContent-Length: {}\r\nContent-Type: text/plain; version=0.0.4\r\n\r\n".format(len(response_body)) + response_body)
+
+                elif path == b"metrics.bin":
+                    stats.set_endpoint("metrics.bin")
+
+                    response_body = binary_metrics.pack(read_metrics())
+                    send(connection, "HTTP/1.1 200 OK\r\nContent-Length: {}\r\nContent-Type: application/octet-stream\r\n\r\n".format(len(response_body)).encode("ascii"))
+                    send(connection, response_body)
+
+                elif path == b"metrics.schema":
+                    stats.set_endpoint("metrics.schema")
+
+                    response_body = binary_metrics.schema
+                    send(connection, "HTTP/1.1 200 OK\r\nContent-Length: {}\r\nContent-Type: application/json\r\n\r\n".format(len(response_body)) + response_body)
+
+                elif path == b"config":
+                    stats.set_endpoint("config")
+                    with open("config.py", "rb") as f:
+                        data = f.read()
+                        send(connection, "HTTP/1.1 200 OK\r\nContent-Length: {}\r\n\r\n".format(len(data)).encode("ascii") + data)
+
+                elif path == b"ota-listing" or path.startswith(b"ota-listing?"):
+                    stats.set_endpoint("ota-listing")
+                    ota_handler.listing(connection, url)
+
+                elif path.startswith(b"ota/"):
+                    stats.set_endpoint("ota")
+                    ota_handler.handle(connection, request, method, url, path)
+
+                elif tslog and (path == b"log" or path.startswith(b"log/") or path.startswith(b"log?")):
+                    stats.set_endpoint("log")
+                    tslog.handle(connection, request, path)
+
+                elif path.startswith(b"reboot"):
+                    stats.set_endpoint("reboot")
+                    logger.info("received reboot request, rebooting...")
+                    logger.flush()
+                    if tslog:
+                        tslog.flush()
+                    # we got far enough to serve a request, so this isn't a crash
+                    watchdog.mark_healthy()
+                    response_body = "rebooting... see you later (hopefully)"
+                    send(connection, "HTTP/1.1 202 accepted\r\nContent-Length: {}\r\n\r\n".format(len(response_body)) + response_body)
+
+                    # this is a hard reboot due to eaddrinuse errors
+                    # (soft reboots keep the part of the network stack apparently, see here:
+                    # https://github.com/micropython/micropython/issues/3739#issuecomment-384037222 )
+                    machine.reset()
+
+                elif path == b"reload" or path.startswith(b"reload?"):
+                    stats.set_endpoint("reload")
+                    # signed like an ota request, since a config.py that
+                    # was just pushed would be applied
+                    if ota_handler.authorize(connection, url, b"reload"):
+                        response_body = "reloading..."
+                        send(connection, "HTTP/1.1 202 accepted\r\nContent-Length: {}\r\n\r\n".format(len(response_body)) + response_body)
+                        reload_requested = True
+
+                else:
+                    stats.set_endpoint("webroot")
+
+                    file_found = False
+
+                    if path == b"":
+                        path = b"index.html"
+
+                    for entry_info in uos.ilistdir("webroot"):
+                        name = entry_info[0]
+                        print("iterating over files in the webroot: {}".format(name))
+                        if name.encode("ascii") == path:
+                            with open("webroot/" + name, "rb") as f:
+                                length = f.seek(0, 2)
+                                f.seek(0)
+                                send(connection, "HTTP/1.1 200 OK\r\nContent-Length: {}\r\n\r\n".format(length).encode("ascii"))
+
+                                # read the response in chunks, we don't have that much ram
+                                while True:
+                                    chunk = f.read(10000)
+                                    if len(chunk) == 0:
+                                        break
+                                    send(connection, chunk)
+                                    del chunk
+                                    stats.collect_garbage()
+
+                            file_found = True
+
+                    if not file_found:
                         response_body = "sorry, but we couldn't find that location :/"
-                        connection.send("HTTP/1.1 404 not found\r\nContent-Length: {}\r\n\r\n".format(len(response_body)) + response_body)
-                        
-                elif method == b"DELETE":
-                    query_match = ure.match(r"[^?]*\?sparkle=([0-9a-f]+)(&noop=((yes)|no))?$", url)
-                    if not query_match:
-                        body = b"no sparkle found, please add sparkle"
-                        connection.send("HTTP/1.1 400 bad request\r\nContent-Length: {}\r\n\r\n".format(len(body)).encode("ascii") + body)
-                        continue
-
-                    given_sparkle = query_match.group(1)
-                    do_noop = query_match.group(4) is not None
-
-                    noop_prefix = b"--noop " if do_noop else b""
-                    new_sparkle = Sparkle(glitter, noop_prefix + filename.encode("ascii")).make_sparkle()
-                    new_sparkle = ubinascii.hexlify(new_sparkle)
-
-                    if new_sparkle != given_sparkle:
-                        body = b"your sparkle wasn't the right one for this file, try again!"
-                        connection.send("HTTP/1.1 400 bad request\r\nContent-Length: {}\r\n\r\n".format(len(body)).encode("ascii") + body)
-                        continue
-
-                    try:
-                        is_file = uos.stat(filename)[0] & 0x8000
-                    except:
-                        is_file = False
-
-                    if is_file:
-                        if do_noop is False:
-                            uos.remove(filename)
-
-                        response_body = "file deleted."
-                        connection.send("HTTP/1.1 200 OK\r\nContent-Length: {}\r\n\r\n".format(len(response_body)) + response_body)
-
-                    else:
-                        response_body = "file not found"
-                        connection.send("HTTP/1.1 404 not found\r\nContent-Length: {}\r\n\r\n".format(len(response_body)) + response_body)
-
-                elif method == b"PUT":
-                    query_match = ure.match(r"[^?]*\?sparkle=([0-9a-f]+)(&noop=((yes)|no))?$", url)
-                    if not query_match:
-                        body = b"no sparkle found, please add sparkle"
-                        connection.send("HTTP/1.1 400 bad request\r\nContent-Length: {}\r\n\r\n".format(len(body)).encode("ascii") + body)
-                        continue
-
-                    given_sparkle = query_match.group(1)
-                    do_noop = query_match.group(4) is not None
-
-                    # try to find the content-length header
-                    request_head, content = request.split(b"\r\n\r\n")
-                    request_head += "\r\n"
-                    content_length_match = ure.search(b"[cC][oO][nN][tT][eE][nN][tT]-[lL][eE][nN][gG][tT][hH]:[ \t]+([0-9]+)\r\n", request_head)
-                    if not content_length_match:
-                        body = b"length header is required for putting files"
-                        connection.send("HTTP/1.1 411 length required\r\nContent-Length: {}\r\n\r\n".format(len(body)).encode("ascii") + body)
-                        continue
-
-                    content_length = int(content_length_match.group(1))
-                    missing_content_length = content_length - len(content)
-                    while missing_content_length > 0:
-                        content += connection.recv(missing_content_length)
-                        missing_content_length = content_length - len(content)
-
-                    noop_prefix = b"--noop " if do_noop else b""
-                    new_sparkle = Sparkle(glitter, noop_prefix + filename.encode("ascii") + b" " + content).make_sparkle()
-                    new_sparkle = ubinascii.hexlify(new_sparkle)
-                    print(new_sparkle)
-                    print(len(content))
-                    print(missing_content_length)
-                    print(content_length)
-
-                    if new_sparkle != given_sparkle:
-                        body = b"your sparkle wasn't the right one for this file, try again!"
-                        connection.send("HTTP/1.1 400 bad request\r\nContent-Length: {}\r\n\r\n".format(len(body)).encode("ascii") + body)
-                        continue
-
-                    if do_noop is False:
-                        with open(filename + ".part", "wb") as f:
-                            f.write(content)
-
-                        uos.rename(filename + ".part", filename)
-
-                    body = b"update successful"
-                    connection.send("HTTP/1.1 200 OK\r\nContent-Length: {}\r\n\r\n".format(len(body)).encode("ascii") + body)
-
-            elif path.startswith(b"reboot"):
-                logger.send("received reboot request, rebooting...")
-                response_body = "rebooting... see you later (hopefully)"
-                connection.send("HTTP/1.1 202 accepted\r\nContent-Length: {}\r\n\r\n".format(len(response_body)) + response_body)
-
-                # this is a hard reboot due to eaddrinuse errors
-                # (soft reboots keep the part of the network stack apparently, see here:
-                # https://github.com/micropython/micropython/issues/3739#issuecomment-384037222 )
-                machine.reset()
-
-            else:
-                
-                file_found = False
-
-                if path == b"":
-                    path = b"index.html"
-
-                for entry_info in uos.ilistdir("webroot"):
-                    name = entry_info[0]
-                    print("iterating over files in the webroot: {}".format(name))
-                    if name.encode("ascii") == path:
-                        with open("webroot/" + name, "rb") as f:
-                            length = f.seek(0, 2)
-                            f.seek(0)
-                            connection.send("HTTP/1.1 200 OK\r\nContent-Length: {}\r\n\r\n".format(length).encode("ascii"))
-
-                            # read the response in chunks, we don't have that much ram
-                            while True:
-                                chunk = f.read(10000)
-                                if len(chunk) == 0:
-                                    break
-                                connection.send(chunk)
-                                del chunk
-                                gc.collect()
-
-                        file_found = True
-
-                if not file_found:
-                    response_body = "sorry, but we couldn't find that location :/"
-                    connection.send("HTTP/1.1 404 not found\r\nContent-Length: {}\r\n\r\n".format(len(response_body)) + response_body)
-
-            last_connection_duration = utime.ticks_ms() - connection_start
-
-        except KeyboardInterrupt as e:
-            raise e
-
-        except Exception as e:
-            buf = uio.StringIO()
-            usys.print_exception(e, buf)
-            logger.send(buf.getvalue())
-
-        finally:
-            if connection:
-                connection.close()
-                gc.collect() # try to smoothe out memory spikes
+                        send(connection, "HTTP/1.1 404 not found\r\nContent-Length: {}\r\n\r\n".format(len(response_body)) + response_body)
+
+            except KeyboardInterrupt as e:
+                # stay at the repl instead of being reset by the watchdog
+                watchdog.stage(b"interrupted", 0)
+                raise e
+
+            except Exception as e:
+                buf = uio.StringIO()
+                usys.print_exception(e, buf)
+                logger.error("exception in main loop: {!r}".format(e), full_message=buf.getvalue())
+
+            finally:
+                if connection:
+                    connection.close()
+                    last_connection_duration = stats.end_request()
+                    stats.collect_garbage() # try to smoothe out memory spikes
+
+        # /reload: the sensors are torn down, and the modules are unloaded,
+        # so that they're imported again from flash
+        watchdog.stage(b"reload", 30000)
+        logger.info("reloading config.py and the sensor modules")
+        reload_start = utime.ticks_ms()
+        hot_reload.teardown(sensors, tslog, exporter)
+        del sensors, i2c_buses, aggregator, binary_metrics, tslog, exporter, polled_sensors
+        hot_reload.unload()
+        gc.collect()
+
+        reload_requested = False
+        # the sensors have been powered all along
+        settle_ms = 0
 
 except Exception as e:
     buf = uio.StringIO()
     usys.print_exception(e, buf)
-    logger.send(buf.getvalue())
+    logger.error("fatal exception: {!r}".format(e), full_message=buf.getvalue())
+    logger.flush()
+    # let the watchdog reset the device (and count this as a crash)
+    watchdog.stage(b"fatal exception", 1000)
     raise e
 
 finally:
@@ -0,0 +1,148 @@
+import utime
+from exposition import make_response_section
+
+# states of a breaker
+CLOSED = 0
+OPEN = 1
+HALF_OPEN = 2
+
+class CircuitBreaker:
+    """ Wraps a sensor, so that a broken one doesn't slow down (or blank
+        out) every scrape.
+
+        Failed readouts are counted, and after failure_threshold of them in
+        a row, the breaker opens: for the next open_ms, the sensor isn't
+        read at all. After that, a single readout is tried (half open). If
+        it works, the breaker closes again, otherwise it opens for twice as
+        long as before, up to max_open_ms.
+
+        Whenever the sensor can't be read, its last good values are served
+        instead and stale is set, so that they can be told apart from new
+        ones. Without any good values yet, the readout raises.
+
+        sample() is for the sampling in between scrapes. It only goes to
+        the sensor while the breaker is closed, but its failures count
+        like those of readouts.
+    """
+
+    def __init__(self, sensor, failure_threshold=3, min_open_ms=10000, max_open_ms=600000):
+
+        self.sensor = sensor
+        self.provides = sensor.provides
+        self.aggregates = getattr(sensor, "aggregates", [])
+        # sensors whose readout has side effects (like resetting the
+        # averages) have a separate sample()
+        self._sample = getattr(sensor, "sample", sensor.readout)
+        self.failure_threshold = failure_threshold
+        self.min_open_ms = min_open_ms
+        self.max_open_ms = max_open_ms
+
+        self.state = CLOSED
+        # how long the breaker stays open, the next time or this time
+        self.open_ms = min_open_ms
+        self._opened_at = 0
+        self._failures_in_a_row = 0
+
+        self._last_good = None
+        self._good_at = utime.ticks_ms()
+        self.stale = False
+
+        self.failures = 0
+        self.trips = 0
+        self.skipped = 0
+
+        # boot.py polls sensors that want it, whatever state the breaker is
+        # in, and tears them down before a reload
+        if hasattr(sensor, "poll"):
+            self.poll = sensor.poll
+        if hasattr(sensor, "deinit"):
+            self.deinit = sensor.deinit
+
+    def _open(self):
+        self.state = OPEN
+        self._opened_at = utime.ticks_ms()
+        self.trips += 1
+
+    def _failed(self):
+        self.failures += 1
+        self._failures_in_a_row += 1
+        if self.state == HALF_OPEN:
+            # still broken, so it's left alone for longer
+            self.open_ms = min(2 * self.open_ms, self.max_open_ms)
+            self._open()
+        elif self._failures_in_a_row >= self.failure_threshold:
+            self._open()
+
+    def _serve_last_good(self, error):
+        self.stale = True
+        if self._last_good is None:
+            raise error
+        return self._last_good
+
+    def readout(self):
+
+        if self.state == OPEN:
+            if utime.ticks_diff(utime.ticks_ms(), self._opened_at) < self.open_ms:
+                self.skipped += 1
+                return self._serve_last_good(RuntimeError("sensor skipped after {} failed readouts".format(self._failures_in_a_row)))
+            self.state = HALF_OPEN
+
+        try:
+            data = self.sensor.readout()
+
+        except Exception as e:
+            self._failed()
+            return self._serve_last_good(e)
+
+        self.state = CLOSED
+        self.open_ms = self.min_open_ms
+        self._failures_in_a_row = 0
+        self._last_good = data
+        self._good_at = utime.ticks_ms()
+        self.stale = False
+        return data
+
+    def sample(self):
+        """ the sensor's sample (or readout), None while the breaker isn't
+            closed """
+
+        if self.state != CLOSED:
+            return None
+
+        try:
+            data = self._sample()
+        except Exception:
+            self._failed()
+            raise
+
+        if data is not None:
+            self._failures_in_a_row = 0
+        return data
+
+    def data_age_ms(self):
+        """ how old the last good values are, nan if there are none """
+        if self._last_good is None:
+            return float("nan")
+        return utime.ticks_diff(utime.ticks_ms(), self._good_at)
+
+
+def render_text(breakers, sensor_configs):
+    """ prometheus text exposition for the breakers of all sensors, by
+        sensor label """
+
+    lines = []
+    for name, metric_type, value in (
+            ("sensor_breaker_state", "gauge", lambda breaker: breaker.state),
+            ("sensor_breaker_open_ms", "gauge", lambda breaker: breaker.open_ms),
+            ("sensor_breaker_failures_total", "counter", lambda breaker: breaker.failures),
+            ("sensor_breaker_trips_total", "counter", lambda breaker: breaker.trips),
+            ("sensor_breaker_skipped_total", "counter", lambda breaker: breaker.skipped),
+            ("sensor_data_age_ms", "gauge", lambda breaker: breaker.data_age_ms())):
+        lines.append("# TYPE {} {}".format(name, metric_type))
+        for sensor_label, breaker in breakers.items():
+            sensor_config = sensor_configs[sensor_label]
+            # make_response_section starts with a newline
+            lines.append(make_response_section(
+                    name, sensor_label, sensor_config["description"], sensor_config["type"], value(breaker))[1:])
+
+    return "\n".join(lines) + "\n"
@@ -1,4 +1,6 @@
+import os
 import sys
+import time
 import json
 import binascii
 import hmac
@@ -8,7 +10,10 @@ import requests
 import git
 import re
 import yaml
-from sparkle import Sparkle
+from sparkle import SparkleKey
+from ota_client import upload_resumable
+from derived import DERIVED_METRICS
+import hot_reload
 from git import Repo
 import argparse
 
@@ -21,17 +26,48 @@ def make_argument_parser():
     parser.add_argument('--noop', action="store_true",
                         help="do a no-op run (not actually pushing changes to the device)")
     parser.add_argument('--no-reboot', action="store_true",
-                        help="skip the reboot step after finishing updates")
+                        help="skip the reboot (or reload) step after finishing updates")
+    parser.add_argument('--reboot', action="store_true",
+                        help="always reboot, even if only config.py and sensor modules changed, which a reload would apply")
+    parser.add_argument('--unstamped-sparkle', action="store_true",
+                        help="make sparkles without timestamps, for devices that don't support them yet (or have ota_allow_unstamped_sparkle set)")
 
     return parser
 
 
-def make_sparkle(glitter, data):
-    return binascii.hexlify(Sparkle(glitter, data).make_sparkle())
+last_timestamp = 0
+
+
+def make_timestamp():
+    """ milliseconds since the epoch, different for every sparkle (the
+    device rejects timestamps that aren't newer than the last one) """
+
+    global last_timestamp
+    last_timestamp = max(time.time_ns() // 1000000, last_timestamp + 1)
+    return last_timestamp
+
+
+def make_sparkle_params(sparkle_key, data, noop=False, stamped=True):
+    """ returns the query parameters for signing data. the timestamp is
+    part of the sparkle, so that the device can reject replays. """
+
+    params = {}
+    if noop:
+        data = b"--noop " + data
+    if stamped:
+        params["ts"] = str(make_timestamp())
+        data = b"@" + params["ts"].encode("ascii") + b" " + data
+
+    params["sparkle"] = binascii.hexlify(sparkle_key.sign(data)).decode("ascii")
+    params["noop"] = "yes" if noop else "no"
+
+    # the device expects them in this order
+    return {name: params[name] for name in ("sparkle", "noop", "ts") if name in params}
 
 
 sensor_types = {
     "dht": {"port_type": "Pin"},
+    # several of them can share a bus, e.g. I2C(0) and I2C(0, 0x77)
     "bme": {"port_type": "I2C"},
     "mhz": {"port_type": "UART"},
     "sds": {"port_type": "UART"},
@@ -44,7 +80,9 @@ def get_sensor_config_string(sensor_name, sensor_config):
     sensor_type_info = sensor_types[sensor_config["type"]]
     port_type = sensor_type_info["port_type"]
 
-    port_match = re.match(port_type + r"\(([0-9]+)\)", sensor_config["port"])
+    # i2c devices can have an address, for more than one on the same bus
+    address_re = r"(?:,\s*(0x[0-9a-fA-F]+|[0-9]+))?" if port_type == "I2C" else ""
+    port_match = re.match(port_type + r"\(([0-9]+)" + address_re + r"\)", sensor_config["port"])
     if not port_match:
         raise RuntimeError(
             f"Invalid port specification for sensor {sensor_name}: {sensor_config['port']} (sensor type {sensor_config['type']} needs port type {sensor_types[sensor_config['type']]['port_type']}"
@@ -52,7 +90,45 @@ def get_sensor_config_string(sensor_name, sensor_config):
 
     port_index = int(port_match.group(1))
 
-    return f"""{{"type": "{sensor_config["type"]}", "port": machine.{port_type}({port_index}), "description": "{sensor_config["description"]}"}}"""
+    if port_type == "I2C":
+        # all devices on a bus share one I2C object, see make_config_py()
+        port = f"i2c_{port_index}"
+    else:
+        port = f"machine.{port_type}({port_index})"
+
+    # settings are passed to the sensor constructor as keyword arguments.
+    # they come from yaml, so they're plain values with a valid python repr.
+    sensor_settings = dict(sensor_config.get("settings") or {})
+    if port_type == "I2C" and port_match.group(2):
+        sensor_settings["address"] = int(port_match.group(2), 0)
+
+    settings = ""
+    if sensor_settings:
+        settings = f""", "settings": {sensor_settings!r}"""
+
+    # derived metrics, e.g. "derived: [dew_point]", or with settings:
+    # "derived: {metrics: [sea_level_pressure], altitude_m: 230}"
+    derived = ""
+    if sensor_config.get("derived"):
+        derived_config = sensor_config["derived"]
+        if isinstance(derived_config, list):
+            derived_config = {"metrics": derived_config}
+        for name in derived_config["metrics"]:
+            if name not in DERIVED_METRICS:
+                raise RuntimeError(f"Unknown derived metric for sensor {sensor_name}: {name} (known are {', '.join(DERIVED_METRICS)})")
+        derived = f""", "derived": {derived_config!r}"""
+
+    return f"""{{"type": "{sensor_config["type"]}", "port": {port}, "description": "{sensor_config["description"]}"{settings}{derived}}}"""
+
+
+def get_i2c_buses_string(sensor_configs):
+
+    bus_indices = set()
+    for sensor_config in sensor_configs.values():
+        if sensor_types[sensor_config["type"]]["port_type"] == "I2C":
+            bus_indices.add(int(re.match(r"I2C\(([0-9]+)", sensor_config["port"]).group(1)))
+
+    return "".join(f"i2c_{index} = machine.I2C({index})\n" for index in sorted(bus_indices))
 
 
 def make_config_py(device_name, device_info):
@@ -66,6 +142,17 @@ def make_config_py(device_name, device_info):
         )
     sensor_configs += "}\n"
 
+    i2c_buses = get_i2c_buses_string(device_info["sensor_configs"])
+    if i2c_buses:
+        i2c_buses += "\n"
+
+    # optional device-wide settings, e.g. sample_interval_s
+    settings = ""
+    for name, value in device_info.get("settings", {}).items():
+        settings += f"{name} = {value!r}\n"
+    if settings:
+        settings += "\n"
+
     file_contents = (
         f"""# this file is generated automatically from its corresponding entry in devices.yaml
 import machine
@@ -73,6 +160,8 @@ import machine
 hostname = "{device_name}"
 
 """
+        + settings
+        + i2c_buses
         + sensor_configs
     )
 
@@ -100,11 +189,30 @@ def parse_file_listing(raw_listing):
     return files
 
 
-def get_remote_file_listing(remote):
+def make_listing_root(files):
+    """ the same as ota.listing_root() on the device """
+
+    listing = "\n".join(sorted(f"{filename} {checksum}" for filename, checksum in files.items()))
+    return hashlib.sha1(listing.encode("ascii")).hexdigest()
+
+
+def get_remote_file_listing(remote, local_files):
+    """ only downloads the listing if something is different from
+    local_files, returns local_files otherwise """
 
     print("trying to retrieve file listing...")
 
-    response = requests.get(f"http://{device}:5000/ota-listing")
+    response = requests.get(f"http://{remote}:5000/ota-listing", params={"root": make_listing_root(local_files)})
+
+    if response.status_code == 404:
+        # that device doesn't know about roots yet
+        response = requests.get(f"http://{remote}:5000/ota-listing")
+
+    if response.status_code == 304:
+        print("  up to date.")
+        print()
+        return dict(local_files)
+
     assert response.status_code == 200
 
     print("  done.")
@@ -118,10 +226,50 @@ def git_blob_hash(data):
     return hashlib.sha1(b"blob " + str(len(data)).encode("ascii") + b"\x00" + data).hexdigest()
 
 
+# git blob hashes of local files, by filename, with the size and mtime they
+# had when they were hashed
+hash_cache_file = ".deploy-hash-cache"
+
+
+def load_hash_cache():
+
+    try:
+        with open(hash_cache_file) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_hash_cache(hash_cache):
+
+    with open(hash_cache_file, "w") as f:
+        json.dump(hash_cache, f)
+
+
+def get_file_hash(filename, hash_cache):
+
+    stat = os.stat(filename)
+    file_id = [stat.st_size, stat.st_mtime_ns]
+
+    cache_entry = hash_cache.get(filename)
+    if cache_entry and cache_entry[:2] == file_id:
+        return cache_entry[2]
+
+    with open(filename, "rb") as f:
+        checksum = git_blob_hash(f.read())
+
+    # a file that was changed within the last few seconds might be changed
+    # again without its mtime changing, so it isn't cached yet
+    if time.time_ns() - stat.st_mtime_ns > 2_000_000_000:
+        hash_cache[filename] = file_id + [checksum]
+
+    return checksum
+
+
 def get_local_file_listing(config_py):
 
     local_files = {}
-    repo = git.Repo()
+    hash_cache = load_hash_cache()
 
     with open("deploy-listing") as f:
 
@@ -133,25 +281,32 @@ def get_local_file_listing(config_py):
                 checksum = git_blob_hash(config_py)
 
             else:
-
-                # compute the git checksum for this file, plus, add it into
-                # git's object database
-                checksum = repo.git.hash_object(filename, w=True)
+                checksum = get_file_hash(filename, hash_cache)
 
             local_files[filename] = checksum
 
+    save_hash_cache(hash_cache)
+
     return local_files
 
 
-def delete_remote_file(remote, glitter, filename, noop=False):
+def add_to_git_objects(repo, filenames):
+    """ adds the files to git's object database (in one go), so that the
+    next deploy can show diffs against them """
+
+    filenames = [filename for filename in filenames if filename != "config.py"]
+    if filenames:
+        repo.git.hash_object("-w", "--", *filenames)
+
 
-    noop_prefix = b"--noop " if noop else b""
-    sparkle = make_sparkle(glitter, noop_prefix + filename.encode("ascii"))
+def delete_remote_file(remote, sparkle_key, filename, noop=False, stamped=True):
+
+    params = make_sparkle_params(sparkle_key, filename.encode("ascii"), noop=noop, stamped=stamped)
 
     print(f"  deleting file '{filename}'...")
 
     response = requests.delete(
-        f"http://{remote}:5000/ota/{filename}", params=dict(sparkle=sparkle, noop="yes" if noop else "no")
+        f"http://{remote}:5000/ota/{filename}", params=params
     )
 
     print(
@@ -163,20 +318,59 @@ def delete_remote_file(remote, glitter, filename, noop=False):
         raise RuntimeError("non-200 response code")
 
 
-def push_remote_file(remote, glitter, filename, file_contents=None, noop=False):
+# files larger than this are uploaded in chunks of this size, so that a
+# broken connection doesn't mean starting over
+resumable_chunk_size = 16384
+
+
+def push_remote_file_resumable(remote, sparkle_key, filename, file_contents):
+
+    url = f"http://{remote}:5000/ota/{filename}"
+
+    def request(method, params, body):
+        try:
+            response = requests.request(method, url, params=params, data=body, timeout=30)
+        except requests.RequestException as e:
+            # these are OSErrors, so upload_resumable() retries
+            print(f"   => {e}, resuming...")
+            raise
+
+        return response.status_code, response.text
+
+    def make_start_params():
+        return make_sparkle_params(sparkle_key, b"start " + filename.encode("ascii"))
+
+    def make_commit_params():
+        return make_sparkle_params(sparkle_key, filename.encode("ascii") + b" " + file_contents)
+
+    print(f"  pushing file '{filename}' in chunks...")
+
+    bytes_sent = upload_resumable(request, file_contents, make_start_params, make_commit_params,
+                                  chunk_size=resumable_chunk_size)
+
+    print(f"   => done, sent {bytes_sent} of {len(file_contents)} bytes")
+    print()
+
+
+def push_remote_file(remote, sparkle_key, filename, file_contents=None, noop=False, stamped=True):
 
     if not file_contents:
         with open(filename, "rb") as f:
             file_contents = f.read()
 
-    noop_prefix = b"--noop " if noop else b""
-    sparkle = make_sparkle(glitter, noop_prefix + filename.encode("ascii") + b" " + file_contents)
+    # devices that don't know about timestamps don't know about chunks
+    # either, and no-op runs don't write anything anyway
+    if len(file_contents) > resumable_chunk_size and stamped and not noop:
+        push_remote_file_resumable(remote, sparkle_key, filename, file_contents)
+        return
+
+    params = make_sparkle_params(sparkle_key, filename.encode("ascii") + b" " + file_contents, noop=noop, stamped=stamped)
 
     print(f"  pushing file '{filename}'...")
 
     response = requests.put(
         f"http://{remote}:5000/ota/{filename}",
-        params=dict(sparkle=sparkle, noop="yes" if noop else "no"),
+        params=params,
         data=file_contents,
     )
 
@@ -218,6 +412,35 @@ def reboot_remote(remote):
     )
 
 
+def reload_remote(remote, sparkle_key, stamped=True):
+    """ returns whether the device is reloading. devices without /reload
+    (or in fallback mode) have to be rebooted instead. """
+
+    params = make_sparkle_params(sparkle_key, b"reload", stamped=stamped)
+
+    response = requests.get(f"http://{remote}:5000/reload", params=params)
+
+    print(
+        f" => {response.status_code} {response.reason}: {response.text}"
+    )
+
+    return response.status_code == 202
+
+
+def wait_until_ready(remote, since, timeout_s=120):
+    """ polls until the device answers again. returns how long it's been
+    since the time.monotonic() since. """
+
+    while time.monotonic() - since < timeout_s:
+        try:
+            requests.get(f"http://{remote}:5000/config", timeout=2)
+            return time.monotonic() - since
+        except requests.RequestException:
+            time.sleep(0.5)
+
+    raise RuntimeError(f"device didn't come back within {timeout_s} s")
+
+
 if __name__ == "__main__":
 
     parser = make_argument_parser()
@@ -234,13 +457,13 @@ if __name__ == "__main__":
     except KeyError:
         raise RuntimeError(f"device {device} not found in devices.yaml")
 
-    glitter = binascii.unhexlify(device_config["glitter"])
+    sparkle_key = SparkleKey(binascii.unhexlify(device_config["glitter"]))
 
     config_py = make_config_py(device, device_config)
 
     # get file listings
-    remote_files = get_remote_file_listing(device)
     local_files = get_local_file_listing(config_py)
+    remote_files = get_remote_file_listing(device, local_files)
 
     all_file_names = set(remote_files.keys()) | set(local_files.keys())
 
@@ -250,7 +473,14 @@ if __name__ == "__main__":
 
     repo = git.Repo()
 
+    # only the files that are pushed have to go into git, for the diffs of
+    # the next deploy
+    add_to_git_objects(repo, [filename for filename, checksum in local_files.items() if remote_files.get(filename) != checksum])
+
     made_changes = False
+    # pushed or deleted, to decide between reload and reboot
+    changed_files = []
+    old_config_py = None
 
     for filename in all_file_names:
 
@@ -261,6 +491,7 @@ if __name__ == "__main__":
             continue
 
         made_changes = True
+        changed_files.append(filename)
 
         print(f"File {filename}:")
 
@@ -284,10 +515,14 @@ if __name__ == "__main__":
                 if filename == "config.py":
                     old_file_contents = get_remote_file(device, "config.py")
                 else:
-                    old_file_contents = repo.git.cat_file("blob", old_sha1)
+                    # this goes through a single cat-file --batch process
+                    old_file_contents = repo.git.get_object_data(old_sha1)[3].decode("utf-8")
             except:
                 old_file_contents = None
 
+            if filename == "config.py":
+                old_config_py = old_file_contents
+
             if old_file_contents:
                 longest_line = 0
                 print("    ┌─────────")
@@ -308,10 +543,10 @@ if __name__ == "__main__":
 
         if new_sha1 == "--":
             # this file has been removed, delete it
-            delete_remote_file(device, glitter, filename, noop=args.noop)
+            delete_remote_file(device, sparkle_key, filename, noop=args.noop, stamped=not args.unstamped_sparkle)
 
         else:
-            push_remote_file(device, glitter, filename, file_contents=new_file_contents, noop=args.noop)
+            push_remote_file(device, sparkle_key, filename, file_contents=new_file_contents, noop=args.noop, stamped=not args.unstamped_sparkle)
             pass
 
     if not made_changes:
@@ -324,5 +559,22 @@ if __name__ == "__main__":
         print("all files synced, skipping reboot")
 
     else:
-        print("rebooting...")
-        reboot_remote(device)
+        # a reload keeps wifi up, and skips the sensor warmup
+        reboot = args.reboot or hot_reload.needs_reboot(changed_files, old_config_py, config_py.decode("ascii"))
+
+        if not reboot:
+            print("reloading...")
+            start = time.monotonic()
+            if not reload_remote(device, sparkle_key, stamped=not args.unstamped_sparkle):
+                print("couldn't reload, rebooting instead")
+                reboot = True
+
+        if reboot:
+            print("rebooting...")
+            start = time.monotonic()
+            reboot_remote(device)
+            # it resets right after answering, so it might still be there
+            time.sleep(1)
+
+        downtime = wait_until_ready(device, start)
+        print(f"back after {downtime:.1f} s")
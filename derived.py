@@ -0,0 +1,77 @@
+from math import exp, log
+
+# metrics that are computed from the readings of a sensor, instead of with
+# every dashboard query. they only use the values of the reading that was
+# just taken, so they don't cost any more bus traffic or conversions.
+#
+# temperatures are in °C, humidity in %, pressure in hPa.
+
+STANDARD_SEA_LEVEL_HPA = 1013.25
+
+def dew_point(temperature, humidity):
+    """ Magnus formula, with the constants from Sonntag (1990) """
+    # log(0) doesn't work, and below that, there's no dew anyway
+    gamma = log(max(humidity, 0.01) / 100) + 17.62 * temperature / (243.12 + temperature)
+    return 243.12 * gamma / (17.62 - gamma)
+
+def absolute_humidity(temperature, humidity):
+    """ in g/m³ """
+    saturation_hpa = 6.112 * exp(17.67 * temperature / (temperature + 243.5))
+    return saturation_hpa * humidity * 2.1674 / (273.15 + temperature)
+
+def sea_level_pressure(pressure, temperature, altitude_m):
+    """ the pressure reduced to sea level, from the altitude of the sensor """
+    return pressure * (1 - 0.0065 * altitude_m / (temperature + 0.0065 * altitude_m + 273.15)) ** -5.257
+
+def altitude(pressure, sea_level_hpa=STANDARD_SEA_LEVEL_HPA):
+    """ in m, from the international barometric formula """
+    return 44330 * (1 - (pressure / sea_level_hpa) ** 0.1903)
+
+# name -> (the readings it needs, how it's computed from them and the settings)
+DERIVED_METRICS = {
+    "dew_point": (("temperature", "humidity"),
+                  lambda data, settings: dew_point(data["temperature"], data["humidity"])),
+    "absolute_humidity": (("temperature", "humidity"),
+                          lambda data, settings: absolute_humidity(data["temperature"], data["humidity"])),
+    "sea_level_pressure": (("pressure", "temperature"),
+                           lambda data, settings: sea_level_pressure(data["pressure"], data["temperature"], settings["altitude_m"])),
+    "altitude": (("pressure",),
+                 lambda data, settings: altitude(data["pressure"], settings.get("sea_level_hpa", STANDARD_SEA_LEVEL_HPA))),
+}
+
+class DerivedMetrics:
+    """ Wraps a sensor, and adds derived metrics to each of its readouts.
+        config is the "derived" entry of the sensor config, e.g.
+        {"metrics": ["dew_point", "sea_level_pressure"], "altitude_m": 230}.
+    """
+
+    def __init__(self, sensor, config):
+
+        self.sensor = sensor
+        self.settings = config
+        self.metrics = []
+        for name in config["metrics"]:
+            needs, compute = DERIVED_METRICS[name]
+            for reading in needs:
+                if reading not in sensor.provides:
+                    raise ValueError("{} needs {}, which the sensor doesn't provide".format(name, reading))
+            if name == "sea_level_pressure" and "altitude_m" not in config:
+                raise ValueError("sea_level_pressure needs altitude_m")
+            self.metrics.append((name, compute))
+
+        self.provides = sensor.provides + [name for name, compute in self.metrics]
+
+        self.aggregates = getattr(sensor, "aggregates", []) + [name for name, compute in self.metrics]
+
+        # boot.py polls sensors that want it, and samples them in between
+        # scrapes (the derived metrics are only computed for readouts)
+        if hasattr(sensor, "poll"):
+            self.poll = sensor.poll
+        if hasattr(sensor, "sample"):
+            self.sample = sensor.sample
+
+    def readout(self):
+        data = self.sensor.readout()
+        for name, compute in self.metrics:
+            data[name] = compute(data, self.settings)
+        return data
@@ -1,12 +1,67 @@
 import dht
+import time
+
+# the sensor can't be read more often than this
+MIN_INTERVAL_MS = 2000
+MAX_BACKOFF_MS = 60000
 
 class DHT22Sensor:
 
-    provides = ["temperature", "humidity"]
+    provides = ["temperature", "humidity", "reading_age_ms", "read_errors", "read_retries"]
+    # what boot.py keeps min/max/mean of between scrapes
+    aggregates = ["temperature", "humidity"]
 
     def __init__(self, port):
         self._sensor = dht.DHT22(port)
 
+        self._temperature = None
+        self._humidity = None
+        self._last_reading = time.ticks_ms()
+        self._next_attempt = self._last_reading
+        self._backoff_ms = MIN_INTERVAL_MS
+        self._failures = 0
+
+        self.read_errors = 0
+        self.read_retries = 0
+
+    def _measure(self, now):
+        # within the minimum interval (or while backing off after an
+        # error), the last good reading is served instead
+        if time.ticks_diff(now, self._next_attempt) < 0:
+            return
+
+        if self._failures > 0:
+            self.read_retries += 1
+
+        try:
+            self._sensor.measure()
+
+        except Exception:
+            # timeouts and checksum errors are usually transient
+            self.read_errors += 1
+            self._failures += 1
+            self._next_attempt = time.ticks_add(now, self._backoff_ms)
+            self._backoff_ms = min(2 * self._backoff_ms, MAX_BACKOFF_MS)
+            return
+
+        self._temperature = self._sensor.temperature()
+        self._humidity = self._sensor.humidity()
+        self._last_reading = now
+        self._next_attempt = time.ticks_add(now, MIN_INTERVAL_MS)
+        self._backoff_ms = MIN_INTERVAL_MS
+        self._failures = 0
+
     def readout(self):
-        self._sensor.measure()
-        return {"temperature": self._sensor.temperature(), "humidity": self._sensor.humidity()}
+        now = time.ticks_ms()
+        self._measure(now)
+
+        if self._temperature is None:
+            raise RuntimeError("no valid reading from DHT22 sensor yet")
+
+        return {
+            "temperature": self._temperature,
+            "humidity": self._humidity,
+            "reading_age_ms": time.ticks_diff(now, self._last_reading),
+            "read_errors": self.read_errors,
+            "read_retries": self.read_retries,
+        }
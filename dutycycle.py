@@ -0,0 +1,442 @@
+import json
+import machine
+import uos
+import utime
+from gelf import EPOCH_OFFSET
+from aggregator import MetricAggregator
+from push_exporter import PushExporter, format_line
+
+# the run mode for boards on a battery (run_mode = "duty_cycle" in
+# config.py): wake up, sample the sensors, buffer the readings on flash,
+# push them every few wakeups, and go back to deep sleep. there's no http
+# server, except for an ota window every few wakeups (and after every
+# reset that wasn't a wakeup), so that deploy.py still works.
+#
+# the rtc memory would survive deep sleep too, but it's taken by the
+# watchdog, so the buffer and the state are small files on flash.
+#
+# the settings in config.py are the arguments of DutyCycle with a
+# duty_cycle_ prefix (duty_cycle_period_s, duty_cycle_samples, ...), plus
+# duty_cycle_wifi_timeout_s and sensor_settle_ms. bench_dutycycle.py shows
+# what they cost.
+
+STATE_FILE = "dutycycle_state"
+BUFFER_FILE = "dutycycle_buffer"
+
+# timestamps from before this are from a clock that was never set. see
+# ota.py.
+CLOCK_SET_AFTER = 1600000000
+
+# even when a cycle took longer than the period
+MIN_SLEEP_MS = 1000
+
+# lines that are read from the buffer and pushed at a time. the buffer
+# itself is never in ram as a whole.
+PUSH_BATCH_LINES = 20
+
+class DutyCycle:
+    """ One wakeup. run() samples the sensors samples_per_wake times
+        (sample_spacing_ms apart) and buffers the means as influx line
+        protocol. Every push_every wakeups, the buffer is pushed, and every
+        stay_awake_every wakeups, ota is served for stay_awake_s. Then the
+        device sleeps for the rest of period_s.
+
+        The buffer holds at most max_buffer_lines, older lines are dropped
+        first. Lines buffered before the clock was set are pushed once the
+        wifi has set it. Sensors that need to be polled between readouts
+        (like the pulse counter) don't get polled while the device is
+        asleep.
+    """
+
+    def __init__(self, sensors, sensor_configs, hostname, period_s=300, samples_per_wake=1,
+                 sample_spacing_ms=2000, push_every=12, stay_awake_every=0, stay_awake_s=60,
+                 max_buffer_lines=200, woke_at=None, state_file=STATE_FILE, buffer_file=BUFFER_FILE):
+
+        self.sensors = sensors
+        self.sensor_configs = sensor_configs
+        self.hostname = hostname
+        self.period_ms = period_s * 1000
+        self.samples_per_wake = samples_per_wake
+        self.sample_spacing_ms = sample_spacing_ms
+        self.push_every = push_every
+        self.stay_awake_every = stay_awake_every
+        self.stay_awake_ms = stay_awake_s * 1000
+        self.max_buffer_lines = max_buffer_lines
+        self.state_file = state_file
+        self.buffer_file = buffer_file
+
+        self.woke_at = utime.ticks_ms() if woke_at is None else woke_at
+        self.wifi_ms = 0
+
+        # after a reset that wasn't a wakeup, someone might be waiting to
+        # deploy, so every count starts over
+        self.state = {"wakes": 0, "buffered": 0, "cycles": 0, "awake_ms": 0, "wifi_ms": 0,
+                      "lines_dropped": 0, "push_errors": 0, "sensor_errors": 0}
+        if machine.reset_cause() == machine.DEEPSLEEP_RESET:
+            self._load_state()
+        else:
+            self.state["buffered"] = self._count_buffered()
+
+        self.wake = self.state["wakes"]
+
+    def _load_state(self):
+        try:
+            with open(self.state_file) as f:
+                self.state.update(json.load(f))
+        except (OSError, ValueError):
+            self.state["buffered"] = self._count_buffered()
+
+    def _save_state(self):
+        with open(self.state_file, "w") as f:
+            json.dump(self.state, f)
+
+    def _buffered_lines(self):
+        """ the lines in the buffer, read one at a time """
+
+        try:
+            f = open(self.buffer_file)
+        except OSError:
+            return
+        with f:
+            for line in f:
+                line = line.rstrip("\n")
+                if line:
+                    yield line
+
+    def _replace_buffer(self, lines):
+        """ writes lines as the new buffer. lines can be a generator over
+            the old one, it's only replaced at the end. """
+
+        num_lines = 0
+        new_file = self.buffer_file + ".new"
+        with open(new_file, "w") as f:
+            for line in lines:
+                f.write(line + "\n")
+                num_lines += 1
+
+        if num_lines:
+            uos.rename(new_file, self.buffer_file)
+        else:
+            uos.remove(new_file)
+            try:
+                uos.remove(self.buffer_file)
+            except OSError:
+                pass
+        self.state["buffered"] = num_lines
+
+    def _count_buffered(self):
+        num_lines = 0
+        for _ in self._buffered_lines():
+            num_lines += 1
+        return num_lines
+
+    def _append(self, lines):
+        """ adds lines to the buffer on flash """
+
+        excess = self.state["buffered"] + len(lines) - self.max_buffer_lines
+        if excess > 0:
+            # this rewrites the whole buffer, but it only happens when
+            # pushing has been failing for a while
+            self.state["lines_dropped"] += excess
+            self._replace_buffer(self._without_oldest(excess, lines))
+            return
+
+        with open(self.buffer_file, "a") as f:
+            for line in lines:
+                f.write(line + "\n")
+        self.state["buffered"] += len(lines)
+
+    def _without_oldest(self, excess, lines):
+        for line in self._buffered_lines():
+            if excess > 0:
+                excess -= 1
+            else:
+                yield line
+        for line in lines[excess:]:
+            yield line
+
+    def _timestamp(self):
+        # before the clock is set, this is the time since it was powered
+        # up (plus 2000-01-01). the rtc keeps running during deep sleep,
+        # so push() can fix it up once the wifi has set the clock.
+        return utime.time() + EPOCH_OFFSET
+
+    def _note_clock_set(self, before, start):
+        """ remembers how far the clock jumped, if it was set since before
+            (its time at ticks start) """
+
+        now = utime.time() + EPOCH_OFFSET
+        if before < CLOCK_SET_AFTER <= now:
+            self.state["clock_offset"] = now - before - utime.ticks_diff(utime.ticks_ms(), start) // 1000
+
+    def push_due(self):
+        return (self.wake + 1) % self.push_every == 0
+
+    def stay_awake_due(self):
+        return self.wake == 0 or (self.stay_awake_every > 0 and self.wake % self.stay_awake_every == 0)
+
+    def sample(self):
+        """ reads out all sensors samples_per_wake times, and buffers the
+            means """
+
+        aggregator = MetricAggregator({sensor_label: sensor.provides for sensor_label, sensor in self.sensors.items()})
+        # the last readout of every sensor, for the types of the values
+        last = {}
+
+        for i in range(self.samples_per_wake):
+            if i > 0:
+                utime.sleep_ms(self.sample_spacing_ms)
+            for sensor_label, sensor in self.sensors.items():
+                if hasattr(sensor, "poll"):
+                    sensor.poll()
+                try:
+                    data = sensor.readout()
+                except Exception:
+                    self.state["sensor_errors"] += 1
+                    continue
+                aggregator.add(sensor_label, data)
+                last[sensor_label] = data
+
+        means = {}
+        for sensor_label, name, minimum, maximum, mean, samples in aggregator.collect():
+            # ints stay ints, influx doesn't allow a field to change its type
+            if type(last[sensor_label].get(name)) == int:
+                mean = int(round(mean))
+            if sensor_label not in means:
+                means[sensor_label] = {}
+            means[sensor_label][name] = mean
+
+        timestamp = self._timestamp()
+        lines = [format_line(
+                "humiditemp",
+                (("host", self.hostname), ("sensor", sensor_label), ("type", self.sensor_configs[sensor_label]["type"])),
+                values,
+                timestamp)
+            for sensor_label, values in means.items()]
+        self._append([line for line in lines if line is not None])
+
+    def push(self, transport):
+        """ pushes the buffer, with the energy statistics of the cycles
+            since the last push. returns whether everything was sent. """
+
+        state = self.state
+        self._append([format_line(
+                "dutycycle",
+                (("host", self.hostname),),
+                {"cycles": state["cycles"], "awake_ms": state["awake_ms"], "wifi_ms": state["wifi_ms"],
+                 "buffered": state["buffered"], "lines_dropped": state["lines_dropped"],
+                 "push_errors": state["push_errors"], "sensor_errors": state["sensor_errors"]},
+                self._timestamp())])
+        state["cycles"] = 0
+        state["awake_ms"] = 0
+        state["wifi_ms"] = 0
+
+        self._push_failed = False
+        exporter = PushExporter(transport, self.hostname, max_lines=PUSH_BATCH_LINES)
+        self._replace_buffer(self._push_lines(exporter))
+        if self._push_failed:
+            state["push_errors"] += 1
+        return not self._push_failed
+
+    def _push_lines(self, exporter):
+        """ streams the buffer into exporter, PUSH_BATCH_LINES at a time.
+            yields the lines that stay in the buffer. """
+
+        clock_set = self._timestamp() >= CLOCK_SET_AFTER
+        clock_offset = self.state.get("clock_offset")
+        batch = []
+
+        for line in self._buffered_lines():
+            if self._push_failed:
+                yield line
+                continue
+
+            # (buffers from older versions have lines without one)
+            head, _, timestamp = line.rpartition(" ")
+            if timestamp.isdigit() and int(timestamp) < CLOCK_SET_AFTER:
+                if clock_offset is not None:
+                    line = "{} {}".format(head, int(timestamp) + clock_offset)
+                elif clock_set:
+                    # from before a reset that wasn't a wakeup, there's no
+                    # telling when that was
+                    self.state["lines_dropped"] += 1
+                    continue
+                else:
+                    # the wifi didn't get to set the clock
+                    yield line
+                    continue
+
+            batch.append(line)
+            exporter.add_line(line)
+            if len(batch) == PUSH_BATCH_LINES:
+                for line in self._push_batch(exporter, batch):
+                    yield line
+
+        for line in self._push_batch(exporter, batch):
+            yield line
+
+    def _push_batch(self, exporter, batch):
+        """ yields the lines of batch that didn't make it """
+
+        if not batch:
+            return
+        lines_sent = exporter.lines_sent
+        if not exporter.push():
+            self._push_failed = True
+        for line in batch[exporter.lines_sent - lines_sent:]:
+            yield line
+        del batch[:]
+
+    def run(self, connect_wifi, make_transport, serve_ota):
+        """ one cycle, ending in deep sleep. connect_wifi() returns
+            whether it worked, make_transport is None if there's nowhere to
+            push to, serve_ota(window_ms) serves ota requests until nobody
+            has sent one for window_ms. """
+
+        self.sample()
+
+        push = make_transport is not None and self.push_due()
+        stay_awake = self.stay_awake_due()
+        if push or stay_awake:
+            start = utime.ticks_ms()
+            before = self._timestamp()
+            connected = connect_wifi()
+            self._note_clock_set(before, start)
+
+            if connected and make_transport is not None:
+                # on a stay awake wakeup too, the wifi is there anyway
+                try:
+                    self.push(make_transport())
+                except OSError:
+                    self.state["push_errors"] += 1
+            if connected and stay_awake:
+                serve_ota(self.stay_awake_ms)
+
+            # the radio is on from here until the deep sleep
+            self.wifi_ms = utime.ticks_diff(utime.ticks_ms(), start)
+
+        self.sleep()
+
+    def sleep(self):
+        """ saves the state, and sleeps until the next cycle is due """
+
+        awake_ms = utime.ticks_diff(utime.ticks_ms(), self.woke_at)
+        self.state["wakes"] = self.wake + 1
+        self.state["cycles"] += 1
+        self.state["awake_ms"] += awake_ms
+        self.state["wifi_ms"] += self.wifi_ms
+        self._save_state()
+
+        machine.deepsleep(max(self.period_ms - awake_ms, MIN_SLEEP_MS))
+
+
+def main(config, watchdog):
+    """ the duty cycle mode of boot.py, never returns """
+
+    woke_at = utime.ticks_ms()
+
+    watchdog.start()
+    watchdog.stage(b"duty cycle setup", 30000)
+
+    from sensor_setup import make_sensors
+    sensors, i2c_buses = make_sensors(config.sensor_configs, getattr(config, "sensor_settle_ms", 2000))
+
+    duty_cycle = DutyCycle(sensors, config.sensor_configs, config.hostname,
+                           period_s=getattr(config, "duty_cycle_period_s", 300),
+                           samples_per_wake=getattr(config, "duty_cycle_samples", 1),
+                           sample_spacing_ms=getattr(config, "duty_cycle_sample_spacing_ms", 2000),
+                           push_every=getattr(config, "duty_cycle_push_every", 12),
+                           stay_awake_every=getattr(config, "duty_cycle_stay_awake_every", 0),
+                           stay_awake_s=getattr(config, "duty_cycle_stay_awake_s", 60),
+                           max_buffer_lines=getattr(config, "duty_cycle_max_buffer_lines", 200),
+                           woke_at=woke_at)
+
+    # only set up when it's needed, the radio is what drains the battery
+    logger = None
+
+    wifi_timeout_ms = getattr(config, "duty_cycle_wifi_timeout_s", 30) * 1000
+
+    def connect_wifi():
+        nonlocal logger
+        watchdog.stage(b"duty cycle wifi", wifi_timeout_ms + 10000)
+
+        import network
+        import wifi_secrets
+        from wifi_manager import WifiManager
+        wlan = network.WLAN(network.STA_IF)
+        wlan.active(True)
+        wlan.config(dhcp_hostname=config.hostname)
+        wifi = WifiManager(wlan, wifi_secrets.wifi_ssid, wifi_secrets.wifi_passphrase)
+        if not wifi.connect(wifi_timeout_ms):
+            return False
+
+        # the rtc keeps the time during deep sleep, but not across power
+        # cycles
+        if utime.time() + EPOCH_OFFSET < CLOCK_SET_AFTER:
+            try:
+                import ntptime
+                ntptime.settime()
+            except Exception as e:
+                print("couldn't set the time:", e)
+
+        from gelf import GelfLogger
+        logger = GelfLogger(host=config.hostname)
+        watchdog.stage(b"duty cycle push", 60000)
+        return True
+
+    # without a push target, the buffer only grows (which is still useful
+    # for trying out the timing)
+    make_transport = None
+    if getattr(config, "push_target", None):
+        def make_transport():
+            from push_exporter import make_transport
+            return make_transport(config.push_target)
+
+    def serve_ota(window_ms):
+        import socket
+        import ubinascii
+        import fallback
+        from ota import OTAHandler, remove_stale_uploads
+
+        logger.info("awake for ota, for {} s".format(window_ms // 1000))
+        logger.flush()
+
+        # uploads don't carry over from the last window
+        remove_stale_uploads()
+
+        with open("glitter", "r") as f:
+            glitter = ubinascii.unhexlify(f.read())
+        ota_handler = OTAHandler(glitter, allow_unstamped=getattr(config, "ota_allow_unstamped_sparkle", False))
+
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            listener.bind(("0.0.0.0", 5000))
+            listener.listen(1)
+            listener.settimeout(1)
+
+            deadline = utime.ticks_add(utime.ticks_ms(), window_ms)
+            while utime.ticks_diff(deadline, utime.ticks_ms()) > 0:
+                watchdog.stage(b"duty cycle accept", 5000)
+                try:
+                    connection, peer = listener.accept()
+                except OSError:
+                    continue
+
+                try:
+                    connection.settimeout(None)
+                    fallback.handle_request(connection, ota_handler, watchdog, logger,
+                                            unavailable=b"this device is in duty cycle mode, only /ota and /reboot are available")
+                except Exception as e:
+                    logger.error("exception in the ota window: {!r}".format(e))
+                finally:
+                    connection.close()
+
+                # someone is deploying, give them time for the next request
+                deadline = utime.ticks_add(utime.ticks_ms(), window_ms)
+
+        finally:
+            listener.close()
+            logger.flush()
+
+    watchdog.stage(b"duty cycle", 30000 + duty_cycle.samples_per_wake * duty_cycle.sample_spacing_ms)
+    duty_cycle.run(connect_wifi, make_transport, serve_ota)
@@ -0,0 +1,36 @@
+# prometheus text exposition of the metrics that boot.py collects
+
+def make_response_section(name, label, description, sensor_type, value):
+
+    if type(value) == float:
+        fmt = ".3f"
+
+    elif type(value) == int:
+        fmt = "d"
+
+    return """
+{0}{{label="{1}", description="{2}", type="{3}"}} {4:{fmt}}""".format(name, label, description, sensor_type, value, fmt=fmt)
+
+
+def render_text(metric_names, metrics, sensor_configs):
+    """ metric_names are all names that might appear, for the type lines.
+        metrics is a list of (name, sensor label, value), where the sensor
+        label is None for device-wide metrics. """
+
+    response_body = "".join("# TYPE {} gauge\n".format(name)
+            for name in metric_names)
+
+    for name, sensor_label, value in metrics:
+        if sensor_label is None:
+            response_body += "\n{} {}".format(name, value)
+            continue
+
+        sensor_config = sensor_configs[sensor_label]
+        response_body += make_response_section(
+                name,
+                sensor_label,
+                sensor_config["description"],
+                sensor_config["type"],
+                value)
+
+    return response_body + "\n"
@@ -0,0 +1,66 @@
+import machine
+import socket
+
+# the minimal mode boot.py starts in after crashing too often in a row.
+# it only serves ota and /reboot, so that whatever broke can be fixed with
+# deploy.py. it doesn't touch the sensors and imports as little as
+# possible, since any of that might be what's broken.
+
+def _respond(connection, status, body):
+    connection.send("HTTP/1.1 {}\r\nContent-Length: {}\r\n\r\n".format(status, len(body)).encode("ascii") + body)
+
+def handle_request(connection, ota_handler, watchdog, logger,
+                   unavailable=b"this device is in fallback mode, only /ota and /reboot are available"):
+    """ returns after handling a single request. unavailable is the answer
+        to everything except ota and /reboot. """
+
+    watchdog.stage(b"recv", 10000)
+    request = connection.recv(400)
+
+    method, url, protocol = request.split(b"\r\n", 1)[0].split(b" ")
+    path = url.split(b"/", 1)[1]
+
+    watchdog.stage(b"send", 60000)
+
+    if path == b"ota-listing" or path.startswith(b"ota-listing?"):
+        ota_handler.listing(connection, url)
+
+    elif path.startswith(b"ota/"):
+        ota_handler.handle(connection, request, method, url, path)
+
+    elif path.startswith(b"reboot"):
+        logger.info("received reboot request in fallback mode, rebooting...")
+        logger.flush()
+        # give the normal mode another chance
+        watchdog.mark_healthy()
+        _respond(connection, "202 accepted", b"rebooting... see you later (hopefully)")
+        machine.reset()
+
+    else:
+        _respond(connection, "503 service unavailable", unavailable)
+
+def serve(listener, ota_handler, watchdog, logger, wifi=None):
+    """ never returns """
+
+    while True:
+        connection = None
+        try:
+            watchdog.stage(b"fallback-accept", 5000)
+            # we're no use if nobody can reach us
+            if wifi:
+                wifi.poll()
+            logger.poll()
+            try:
+                connection, peer = listener.accept()
+            except OSError:
+                continue
+
+            connection.settimeout(None)
+            handle_request(connection, ota_handler, watchdog, logger)
+
+        except Exception as e:
+            logger.error("exception in fallback mode: {!r}".format(e))
+
+        finally:
+            if connection:
+                connection.close()
@@ -0,0 +1,180 @@
+import socket
+import json
+import os
+import utime
+
+# syslog severity levels, as used by gelf
+LEVEL_ERROR = 3
+LEVEL_WARNING = 4
+LEVEL_INFO = 6
+LEVEL_DEBUG = 7
+
+CHUNK_MAGIC = b"\x1e\x0f"
+CHUNK_HEADER_LENGTH = 12
+MAX_CHUNKS = 128
+
+# micropython's epoch might be 2000-01-01 instead of 1970-01-01
+EPOCH_OFFSET = 946684800 if utime.gmtime(0)[0] == 2000 else 0
+
+class GelfLogger:
+    """ Sends log messages to graylog in gelf format over udp.
+
+        Messages are not sent right away, but collected in a ring of
+        max_pending entries and sent when flush_threshold messages have
+        piled up, or when poll() is called after flush_interval_ms. Repeats
+        of a message that is still pending only increase its counter, and
+        every level is limited to rate_limit messages per rate_period_s.
+        If the ring overflows, the oldest messages are dropped.
+    """
+
+    def __init__(self, ingest_location=("10.23.40.2", 5555), host="humiditemp",
+                 max_pending=16, flush_threshold=8, flush_interval_ms=5000,
+                 rate_limit=10, rate_period_s=60, chunk_size=1024):
+
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.connect(ingest_location)
+        self.host = host
+
+        self.flush_threshold = flush_threshold
+        self.flush_interval_ms = flush_interval_ms
+        self.chunk_size = chunk_size
+
+        # entries are [level, short message, full message, timestamp, count]
+        self._pending = [[0, None, None, 0, 0] for _ in range(max_pending)]
+        self._first = 0
+        self._num_pending = 0
+        self._last_flush = utime.ticks_ms()
+
+        self.rate_limit = rate_limit
+        self.rate_period_ms = rate_period_s * 1000
+        self._rate_counts = [0] * 8
+        self._rate_period_start = utime.ticks_ms()
+        self._chunk_header = bytearray(CHUNK_HEADER_LENGTH)
+
+        self.messages_sent = 0
+        self.bytes_sent = 0
+        self.dropped = 0
+        self.suppressed = 0
+        self.deduplicated = 0
+        self.send_errors = 0
+
+    def _rate_limited(self, level):
+        now = utime.ticks_ms()
+        if utime.ticks_diff(now, self._rate_period_start) >= self.rate_period_ms:
+            self._rate_period_start = now
+            for i in range(len(self._rate_counts)):
+                self._rate_counts[i] = 0
+
+        if self._rate_counts[level] >= self.rate_limit:
+            return True
+
+        self._rate_counts[level] += 1
+        return False
+
+    def log(self, level, short_message, full_message=None):
+
+        max_pending = len(self._pending)
+
+        for i in range(self._num_pending):
+            entry = self._pending[(self._first + i) % max_pending]
+            if entry[0] == level and entry[1] == short_message and entry[2] == full_message:
+                entry[4] += 1
+                self.deduplicated += 1
+                return
+
+        if self._rate_limited(level):
+            self.suppressed += 1
+            return
+
+        if self._num_pending == max_pending:
+            # no space left, drop the oldest one
+            self._first = (self._first + 1) % max_pending
+            self._num_pending -= 1
+            self.dropped += 1
+
+        entry = self._pending[(self._first + self._num_pending) % max_pending]
+        entry[0] = level
+        entry[1] = short_message
+        entry[2] = full_message
+        entry[3] = utime.time() + EPOCH_OFFSET
+        entry[4] = 1
+        self._num_pending += 1
+
+        if self._num_pending >= self.flush_threshold:
+            self.flush()
+
+    def error(self, short_message, full_message=None):
+        self.log(LEVEL_ERROR, short_message, full_message)
+
+    def warning(self, short_message, full_message=None):
+        self.log(LEVEL_WARNING, short_message, full_message)
+
+    def info(self, short_message, full_message=None):
+        self.log(LEVEL_INFO, short_message, full_message)
+
+    def debug(self, short_message, full_message=None):
+        self.log(LEVEL_DEBUG, short_message, full_message)
+
+    def poll(self):
+        if self._num_pending > 0 and utime.ticks_diff(utime.ticks_ms(), self._last_flush) >= self.flush_interval_ms:
+            self.flush()
+
+    def _send(self, data):
+        try:
+            self.socket.send(data)
+        except OSError:
+            # there's nobody we could complain to about this
+            self.send_errors += 1
+            return
+
+        self.bytes_sent += len(data)
+
+    def _send_chunked(self, message):
+        chunk_data_size = self.chunk_size - CHUNK_HEADER_LENGTH
+        num_chunks = (len(message) + chunk_data_size - 1) // chunk_data_size
+        if num_chunks > MAX_CHUNKS:
+            # graylog would drop it anyway
+            self.dropped += 1
+            return
+
+        header = self._chunk_header
+        header[0:2] = CHUNK_MAGIC
+        header[2:10] = os.urandom(8)
+        header[11] = num_chunks
+
+        for i in range(num_chunks):
+            header[10] = i
+            self._send(header + message[i * chunk_data_size:(i + 1) * chunk_data_size])
+
+    def flush(self):
+        max_pending = len(self._pending)
+
+        while self._num_pending > 0:
+            level, short_message, full_message, timestamp, count = self._pending[self._first]
+
+            record = {
+                "version": "1.1",
+                "host": self.host,
+                "short_message": short_message,
+                "timestamp": timestamp,
+                "level": level,
+            }
+            if full_message:
+                record["full_message"] = full_message
+            if count > 1:
+                record["_count"] = count
+
+            message = json.dumps(record).encode("utf-8")
+            if len(message) > self.chunk_size:
+                self._send_chunked(message)
+            else:
+                self._send(message)
+            self.messages_sent += 1
+
+            # don't keep the strings alive
+            self._pending[self._first][1] = None
+            self._pending[self._first][2] = None
+            self._first = (self._first + 1) % max_pending
+            self._num_pending -= 1
+
+        self._last_flush = utime.ticks_ms()
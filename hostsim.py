@@ -0,0 +1,296 @@
+# host-side stand-ins for the micropython hardware modules, so that device
+# code can be tested and benchmarked on a normal computer.
+#
+# call install() before importing any device module. the fakes are driven
+# by a virtual clock, so tests decide how much time passes.
+
+import sys
+import time
+import types
+
+# ticks wrap around like they do on the esp32
+TICKS_PERIOD = 1 << 30
+TICKS_MAX = TICKS_PERIOD - 1
+TICKS_HALFPERIOD = TICKS_PERIOD // 2
+
+
+class FakeClock(object):
+    """ virtual time, in microseconds. provides the parts of the utime api
+    that we use. sleeping just advances the clock. """
+
+    def __init__(self, start_us=0):
+        self.now_us = start_us
+        # what settime() moved the rtc by
+        self.rtc_offset_s = 0
+
+    def advance_us(self, us):
+        self.now_us += us
+
+    def advance_ms(self, ms):
+        self.now_us += ms * 1000
+
+    def ticks_us(self):
+        return self.now_us & TICKS_MAX
+
+    def ticks_ms(self):
+        return (self.now_us // 1000) & TICKS_MAX
+
+    def ticks_add(self, ticks, delta):
+        return (ticks + delta) & TICKS_MAX
+
+    def ticks_diff(self, ticks1, ticks2):
+        return ((ticks1 - ticks2 + TICKS_HALFPERIOD) & TICKS_MAX) - TICKS_HALFPERIOD
+
+    def sleep_us(self, us):
+        self.advance_us(us)
+
+    def sleep_ms(self, ms):
+        self.advance_ms(ms)
+
+    def sleep(self, seconds):
+        self.advance_us(int(seconds * 1000000))
+
+    def time(self):
+        return self.now_us // 1000000 + self.rtc_offset_s
+
+    def settime(self, secs):
+        """ like ntptime.settime(): only the rtc moves, the ticks don't """
+        self.rtc_offset_s = secs - self.now_us // 1000000
+
+    def gmtime(self, secs=None):
+        if secs is None:
+            secs = self.time()
+        return time.gmtime(secs)
+
+
+class FakePin(object):
+
+    IN = 1
+    OUT = 3
+    IRQ_FALLING = 2
+    IRQ_RISING = 1
+
+    def __init__(self, number, mode=None, value=0):
+        self.number = number
+        self.mode = mode
+        self._value = value
+        self.handler = None
+        self.trigger = None
+
+    def init(self, mode=None, pull=None):
+        self.mode = mode
+
+    def irq(self, handler=None, trigger=IRQ_FALLING | IRQ_RISING):
+        self.handler = handler
+        self.trigger = trigger
+
+    def value(self, value=None):
+        if value is None:
+            return self._value
+        self._value = value
+
+    def on(self):
+        self._value = 1
+
+    def off(self):
+        self._value = 0
+
+    def fire(self):
+        """ simulate an interrupt on this pin """
+        self.handler(self)
+
+
+class FakeWDT(object):
+    """ the hardware watchdog. it can't reset anything here, so tests ask
+    it whether it would have. """
+
+    def __init__(self, id=0, timeout=5000, clock=None):
+        self.clock = clock
+        self.timeout = timeout
+        self.feeds = 0
+        self.last_feed_us = clock.now_us
+
+    def feed(self):
+        self.feeds += 1
+        self.last_feed_us = self.clock.now_us
+
+    def expired(self):
+        return self.clock.now_us - self.last_feed_us > self.timeout * 1000
+
+
+class FakeRTC(object):
+    """ rtc memory survives resets, so there's only one of it """
+
+    _memory = b""
+
+    def memory(self, data=None):
+        if data is None:
+            return FakeRTC._memory
+        FakeRTC._memory = bytes(data)
+
+
+class FakeTimer(object):
+
+    PERIODIC = 1
+    ONE_SHOT = 0
+
+    def __init__(self, id=-1):
+        self.id = id
+        self.callback = None
+        self.period = None
+
+    def init(self, mode=PERIODIC, period=-1, callback=None):
+        self.period = period
+        self.callback = callback
+
+    def deinit(self):
+        self.callback = None
+
+    def fire(self):
+        """ simulate the timer expiring """
+        if self.callback is not None:
+            self.callback(self)
+
+
+class FakeDHT22(object):
+    """ the sensor of the dht module. tests set the values it reads, or
+    break it. """
+
+    def __init__(self, pin):
+        self.pin = pin
+        self.values = (21.5, 45.0)
+        self.broken = False
+        self.measurements = 0
+
+    def measure(self):
+        self.measurements += 1
+        if self.broken:
+            raise OSError(116) # ETIMEDOUT, like a sensor that doesn't answer
+
+    def temperature(self):
+        return self.values[0]
+
+    def humidity(self):
+        return self.values[1]
+
+
+class Reset(BaseException):
+    """ raised by machine.reset() and machine.deepsleep(), since we can't
+    actually reset. it isn't an Exception, so that it gets past "except
+    Exception". """
+
+
+def _get_module(name):
+    # modules that are already installed are updated in-place, so that
+    # device modules which imported them earlier see the changes
+    module = sys.modules.get(name)
+    if module is None or not getattr(module, "_hostsim", False):
+        module = types.ModuleType(name)
+        module._hostsim = True
+        sys.modules[name] = module
+    return module
+
+
+def install_utime(clock):
+    utime = _get_module("utime")
+    for name in ("ticks_us", "ticks_ms", "ticks_add", "ticks_diff",
+                 "sleep_us", "sleep_ms", "sleep", "time", "gmtime"):
+        setattr(utime, name, getattr(clock, name))
+    return utime
+
+
+def install_machine(clock):
+    machine = _get_module("machine")
+    machine.Pin = FakePin
+    machine.irq_enabled = True
+
+    def disable_irq():
+        state = machine.irq_enabled
+        machine.irq_enabled = False
+        return state
+
+    def enable_irq(state=True):
+        machine.irq_enabled = state
+
+    machine.disable_irq = disable_irq
+    machine.enable_irq = enable_irq
+
+    # same values as on the esp32
+    machine.PWRON_RESET = 1
+    machine.HARD_RESET = 2
+    machine.WDT_RESET = 3
+    machine.DEEPSLEEP_RESET = 4
+    machine.SOFT_RESET = 5
+    # tests set this to whatever the last reset should have been
+    machine.last_reset_cause = machine.PWRON_RESET
+
+    def reset_cause():
+        return machine.last_reset_cause
+
+    def reset():
+        raise Reset()
+
+    def deepsleep(time_ms=0):
+        # the device sleeps, and then boots again
+        machine.slept_ms = time_ms
+        clock.advance_ms(time_ms)
+        machine.last_reset_cause = machine.DEEPSLEEP_RESET
+        raise Reset()
+
+    machine.reset_cause = reset_cause
+    machine.reset = reset
+    machine.deepsleep = deepsleep
+    machine.slept_ms = None
+    machine.RTC = FakeRTC
+    machine.Timer = FakeTimer
+    machine.WDT = lambda id=0, timeout=5000: FakeWDT(id, timeout, clock)
+
+    return machine
+
+
+def install_dht():
+    dht = _get_module("dht")
+    dht.DHT22 = FakeDHT22
+    return dht
+
+
+def install_stdlib():
+    """ the micropython names of the standard modules that we use """
+
+    import binascii
+    import os
+    import re
+    import struct
+
+    sys.modules.setdefault("ubinascii", binascii)
+    sys.modules.setdefault("ure", re)
+    sys.modules.setdefault("ustruct", struct)
+
+    # micropython's compile-time constants are just values here
+    import builtins
+    if not hasattr(builtins, "const"):
+        builtins.const = lambda value: value
+
+    uos = _get_module("uos")
+    for name in ("stat", "statvfs", "remove", "rename", "mkdir", "listdir"):
+        setattr(uos, name, getattr(os, name))
+
+    def ilistdir(path="."):
+        for name in os.listdir(path):
+            mode = os.stat(os.path.join(path, name)).st_mode
+            yield (name, 0x4000 if mode & 0x4000 else 0x8000, 0, 0)
+
+    uos.ilistdir = ilistdir
+
+
+# the clock that drives the fake modules unless told otherwise
+clock = FakeClock()
+
+
+def install(clock=clock):
+    """ registers the fake modules and returns the clock driving them """
+    install_utime(clock)
+    install_machine(clock)
+    install_dht()
+    install_stdlib()
+    return clock
@@ -0,0 +1,92 @@
+import sys
+
+# boot.py can reload config.py and the sensor modules on /reload, without
+# a reboot: it tears down the sensors, forgets these modules, and imports
+# them again. everything else (boot.py itself, and what's kept across
+# reloads: wifi, the listener, ota, the watchdog and the logger) only
+# changes with a reboot. deploy.py uses this list to decide which one it
+# needs.
+
+RELOADABLE_MODULES = (
+    "config",
+    "sensor_setup",
+    "circuit_breaker",
+    "irq_counter",
+    "bme280_sensor",
+    "bme280_float",
+    "i2c_bus",
+    "derived",
+    "dht22_sensor",
+    "mhz19_sensor",
+    "sds011_sensor",
+    "aggregator",
+    "exposition",
+    "binmetrics",
+    "instrumentation",
+    "push_exporter",
+    "tslog",
+)
+
+# settings in config.py that boot.py reads only once, before the loop that
+# reloads: the hostname goes into dhcp, the logger and the push exporter.
+# changing any of them takes a reboot.
+BOOT_SETTINGS = (
+    "hostname",
+    "run_mode",
+    "wifi_boot_timeout_s",
+    "ota_allow_unstamped_sparkle",
+)
+
+def reloadable(filename):
+    """ whether a change to filename can be applied with a reload """
+    return filename.endswith(".py") and filename[:-3] in RELOADABLE_MODULES
+
+def _settings(config_py):
+    """ the top-level "name = value" lines of a config.py, as deploy.py
+        generates it """
+
+    settings = {}
+    for line in config_py.splitlines():
+        name, separator, value = line.partition(" = ")
+        if separator and not line.startswith(" ") and not line.startswith("#"):
+            settings[name] = value
+    return settings
+
+def needs_reboot(changed_files, old_config_py=None, new_config_py=None):
+    """ whether applying changed_files takes a reboot rather than a
+        reload. if config.py is among them, its old and new contents
+        decide (without the old one, it's a reboot to be safe). """
+
+    if not all(reloadable(filename) for filename in changed_files):
+        return True
+
+    if "config.py" in changed_files:
+        if old_config_py is None or new_config_py is None:
+            return True
+        old_settings = _settings(old_config_py)
+        new_settings = _settings(new_config_py)
+        return any(old_settings.get(name) != new_settings.get(name) for name in BOOT_SETTINGS)
+
+    return False
+
+def teardown(sensors, tslog=None, exporter=None):
+    """ the first half of a reload in boot.py: saves what's buffered, and
+        lets go of the pins and irqs of the sensors, so that they can be
+        set up again """
+
+    if tslog:
+        tslog.flush()
+    if exporter:
+        exporter.push()
+    for sensor in sensors.values():
+        if hasattr(sensor, "deinit"):
+            sensor.deinit()
+
+def unload():
+    """ the next import of any of the modules reads it from flash again.
+        modules that imported them keep the old ones, so all of them go
+        at once. """
+
+    for name in RELOADABLE_MODULES:
+        if name in sys.modules:
+            del sys.modules[name]
@@ -0,0 +1,124 @@
+import utime
+from array import array
+
+# results of a bus readout are handed out for this long. after that (or
+# once a device has had its result), the next readout starts a new round.
+MAX_AGE_MS = 1000
+
+class I2CBus:
+    """ Reads out all devices on one i2c bus together: conversions are
+        started on all of them, then there's a single wait for the slowest
+        one, then all results are collected in one pass. Reading N devices
+        takes about one conversion time instead of N.
+
+        Devices need start(), which returns the conversion time in us, and
+        collect(). Errors are counted per device, and one broken device
+        doesn't keep the others from being read.
+    """
+
+    def __init__(self, name, max_age_ms=MAX_AGE_MS):
+
+        self.name = name
+        self.max_age_ms = max_age_ms
+
+        self.labels = []
+        self._devices = []
+        # the data of the last round per device, or the exception it raised
+        self._results = []
+        self._fresh = []
+        self._deadlines = None
+        self.errors = None
+        self._read_at = utime.ticks_ms()
+
+        self.rounds = 0
+        self.last_round_us = 0
+
+    def add(self, label, device):
+        """ returns a sensor for boot.py, which reads device as part of the
+            bus """
+
+        index = len(self._devices)
+        self.labels.append(label)
+        self._devices.append(device)
+        self._results.append(None)
+        self._fresh.append(False)
+        self._deadlines = array("i", [0] * len(self._devices))
+        self.errors = array("I", [0] * len(self._devices))
+        return BusDevice(self, index, device)
+
+    def read_all(self):
+        """ one round: start all conversions, wait once, collect all """
+
+        start = utime.ticks_us()
+
+        wait_until = start
+        for i, device in enumerate(self._devices):
+            self._fresh[i] = True
+            try:
+                self._deadlines[i] = utime.ticks_add(utime.ticks_us(), device.start())
+            except Exception as e:
+                self.errors[i] += 1
+                self._results[i] = e
+                self._deadlines[i] = start
+                continue
+            self._results[i] = None
+            if utime.ticks_diff(self._deadlines[i], wait_until) > 0:
+                wait_until = self._deadlines[i]
+
+        remaining = utime.ticks_diff(wait_until, utime.ticks_us())
+        if remaining > 0:
+            utime.sleep_us(remaining)
+
+        for i, device in enumerate(self._devices):
+            if self._results[i] is not None:
+                # didn't even start
+                continue
+            try:
+                self._results[i] = device.collect()
+            except Exception as e:
+                self.errors[i] += 1
+                self._results[i] = e
+
+        self._read_at = utime.ticks_ms()
+        self.rounds += 1
+        self.last_round_us = utime.ticks_diff(utime.ticks_us(), start)
+
+    def readout(self, index):
+
+        if not self._fresh[index] or utime.ticks_diff(utime.ticks_ms(), self._read_at) > self.max_age_ms:
+            self.read_all()
+
+        self._fresh[index] = False
+        result = self._results[index]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+class BusDevice:
+    """ a device on an I2CBus, looks like any other sensor to boot.py """
+
+    def __init__(self, bus, index, device):
+        self.bus = bus
+        self.index = index
+        self.device = device
+        self.provides = device.provides
+        self.aggregates = getattr(device, "aggregates", [])
+
+    def readout(self):
+        return self.bus.readout(self.index)
+
+def render_text(buses):
+    """ prometheus text exposition for all buses, by bus name """
+
+    lines = ["# TYPE i2c_bus_rounds counter"]
+    for bus in buses:
+        lines.append('i2c_bus_rounds{{bus="{}"}} {}'.format(bus.name, bus.rounds))
+    lines.append("# TYPE i2c_bus_last_round_us gauge")
+    for bus in buses:
+        lines.append('i2c_bus_last_round_us{{bus="{}"}} {}'.format(bus.name, bus.last_round_us))
+    lines.append("# TYPE i2c_bus_errors counter")
+    for bus in buses:
+        for i, label in enumerate(bus.labels):
+            lines.append('i2c_bus_errors{{bus="{}",label="{}"}} {}'.format(bus.name, label, bus.errors[i]))
+
+    return "\n".join(lines) + "\n"
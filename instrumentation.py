@@ -0,0 +1,219 @@
+import gc
+import utime
+from array import array
+from exposition import make_response_section
+
+# upper bounds of the request latency histogram, in ms. everything slower
+# ends up in the +Inf bucket.
+LATENCY_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+class Instrumentation:
+    """ Request, heap, gc and sensor readout statistics for /metrics.
+
+        Recording doesn't allocate: all counters live in arrays that are
+        created up front, endpoints and sensors are looked up in dicts by
+        the strings boot.py already has, and the tick and heap values are
+        small ints on the esp32. Only render_text() allocates.
+    """
+
+    def __init__(self, endpoints, sensor_labels):
+
+        self.endpoints = list(endpoints)
+        self._endpoint_index = {endpoint: i for i, endpoint in enumerate(self.endpoints)}
+        num_endpoints = len(self.endpoints)
+
+        self.requests = array("I", [0] * num_endpoints)
+        self.bytes_sent = array("I", [0] * num_endpoints)
+        self.bytes_received = array("I", [0] * num_endpoints)
+        self.heap_allocated = array("I", [0] * num_endpoints)
+        self.heap_allocated_max = array("I", [0] * num_endpoints)
+        self.latency_sum_ms = array("I", [0] * num_endpoints)
+        # one row of buckets per endpoint, the last column is +Inf
+        self._num_buckets = len(LATENCY_BUCKETS_MS) + 1
+        self.latency_buckets = array("I", [0] * (num_endpoints * self._num_buckets))
+
+        self.sensor_labels = list(sensor_labels)
+        self._sensor_index = {label: i for i, label in enumerate(self.sensor_labels)}
+        num_sensors = len(self.sensor_labels)
+
+        self.readouts = array("I", [0] * num_sensors)
+        self.readout_errors = array("I", [0] * num_sensors)
+        self.readout_last_us = array("I", [0] * num_sensors)
+        self.readout_max_us = array("I", [0] * num_sensors)
+        self.readout_sum_us = array("I", [0] * num_sensors)
+        self.samples = array("I", [0] * num_sensors)
+        self.sample_errors = array("I", [0] * num_sensors)
+
+        self.heap_peak = gc.mem_alloc()
+        self.gc_collections = 0
+        self.gc_time_us = 0
+        self.gc_time_max_us = 0
+        # requests during which the gc ran on its own, so that we don't
+        # know how much they allocated
+        self.gc_during_request = 0
+
+        self._active = False
+        self._endpoint = 0
+        self._request_start = 0
+        self._heap_start = 0
+        self._sent = 0
+        self._received = 0
+
+    def start_request(self):
+        """ call right after accept(). until set_endpoint() is called, the
+            request counts for the last endpoint. """
+        self._active = True
+        self._endpoint = len(self.endpoints) - 1
+        self._sent = 0
+        self._received = 0
+        self._heap_start = gc.mem_alloc()
+        self._request_start = utime.ticks_ms()
+
+    def set_endpoint(self, endpoint):
+        self._endpoint = self._endpoint_index[endpoint]
+
+    def sent(self, num_bytes):
+        self._sent += num_bytes
+
+    def received(self, num_bytes):
+        self._received += num_bytes
+
+    def end_request(self):
+        """ returns the duration of the request in ms """
+
+        if not self._active:
+            return 0
+        self._active = False
+
+        duration = utime.ticks_diff(utime.ticks_ms(), self._request_start)
+        heap = gc.mem_alloc()
+        self._update_peak(heap)
+
+        endpoint = self._endpoint
+        self.requests[endpoint] += 1
+        self.bytes_sent[endpoint] += self._sent
+        self.bytes_received[endpoint] += self._received
+        self.latency_sum_ms[endpoint] += duration
+
+        bucket = 0
+        while bucket < len(LATENCY_BUCKETS_MS) and duration > LATENCY_BUCKETS_MS[bucket]:
+            bucket += 1
+        self.latency_buckets[endpoint * self._num_buckets + bucket] += 1
+
+        allocated = heap - self._heap_start
+        if allocated < 0:
+            self.gc_during_request += 1
+        else:
+            self.heap_allocated[endpoint] += allocated
+            if allocated > self.heap_allocated_max[endpoint]:
+                self.heap_allocated_max[endpoint] = allocated
+
+        return duration
+
+    def _update_peak(self, heap):
+        if heap > self.heap_peak:
+            self.heap_peak = heap
+
+    def collect_garbage(self):
+        """ gc.collect(), but counted and timed """
+
+        before = gc.mem_alloc()
+        self._update_peak(before)
+        start = utime.ticks_us()
+        gc.collect()
+        duration = utime.ticks_diff(utime.ticks_us(), start)
+
+        self.gc_collections += 1
+        self.gc_time_us += duration
+        if duration > self.gc_time_max_us:
+            self.gc_time_max_us = duration
+
+        # whatever was freed during a request was still allocated by it
+        if self._active:
+            self._heap_start -= before - gc.mem_alloc()
+
+    def readout(self, sensor_label, sensor):
+        """ sensor.readout(), but counted and timed. exceptions are counted
+            and passed on. """
+
+        index = self._sensor_index[sensor_label]
+        start = utime.ticks_us()
+        try:
+            data = sensor.readout()
+        except Exception:
+            self.readout_errors[index] += 1
+            raise
+        finally:
+            duration = utime.ticks_diff(utime.ticks_us(), start)
+            self.readouts[index] += 1
+            self.readout_last_us[index] = duration
+            self.readout_sum_us[index] += duration
+            if duration > self.readout_max_us[index]:
+                self.readout_max_us[index] = duration
+
+        self._update_peak(gc.mem_alloc())
+        return data
+
+    def sample(self, sensor_label, sensor):
+        """ sensor.sample() for the sampling in between scrapes, counted
+            separately from the readouts. exceptions are counted and passed
+            on. """
+
+        index = self._sensor_index[sensor_label]
+        self.samples[index] += 1
+        try:
+            return sensor.sample()
+        except Exception:
+            self.sample_errors[index] += 1
+            raise
+
+    def render_text(self, sensor_configs):
+        """ prometheus text exposition of everything above """
+
+        lines = []
+
+        def per_endpoint(name, metric_type, values):
+            lines.append("# TYPE {} {}".format(name, metric_type))
+            for i, endpoint in enumerate(self.endpoints):
+                lines.append('{}{{endpoint="{}"}} {}'.format(name, endpoint, values[i]))
+
+        per_endpoint("http_requests_total", "counter", self.requests)
+        per_endpoint("http_bytes_sent_total", "counter", self.bytes_sent)
+        per_endpoint("http_bytes_received_total", "counter", self.bytes_received)
+        per_endpoint("http_heap_allocated_bytes_total", "counter", self.heap_allocated)
+        per_endpoint("http_heap_allocated_max_bytes", "gauge", self.heap_allocated_max)
+
+        lines.append("# TYPE http_request_duration_ms histogram")
+        for i, endpoint in enumerate(self.endpoints):
+            cumulative = 0
+            for bucket in range(self._num_buckets):
+                cumulative += self.latency_buckets[i * self._num_buckets + bucket]
+                le = LATENCY_BUCKETS_MS[bucket] if bucket < len(LATENCY_BUCKETS_MS) else "+Inf"
+                lines.append('http_request_duration_ms_bucket{{endpoint="{}", le="{}"}} {}'.format(endpoint, le, cumulative))
+            lines.append('http_request_duration_ms_sum{{endpoint="{}"}} {}'.format(endpoint, self.latency_sum_ms[i]))
+            lines.append('http_request_duration_ms_count{{endpoint="{}"}} {}'.format(endpoint, self.requests[i]))
+
+        for name, metric_type, value in (
+                ("memory_peak_used", "gauge", self.heap_peak),
+                ("gc_collections_total", "counter", self.gc_collections),
+                ("gc_time_us_total", "counter", self.gc_time_us),
+                ("gc_time_max_us", "gauge", self.gc_time_max_us),
+                ("gc_during_request_total", "counter", self.gc_during_request)):
+            lines.append("# TYPE {} {}\n{} {}".format(name, metric_type, name, value))
+
+        for name, metric_type, values in (
+                ("sensor_readouts_total", "counter", self.readouts),
+                ("sensor_readout_errors_total", "counter", self.readout_errors),
+                ("sensor_readout_duration_us", "gauge", self.readout_last_us),
+                ("sensor_readout_duration_max_us", "gauge", self.readout_max_us),
+                ("sensor_readout_duration_us_total", "counter", self.readout_sum_us),
+                ("sensor_samples_total", "counter", self.samples),
+                ("sensor_sample_errors_total", "counter", self.sample_errors)):
+            lines.append("# TYPE {} {}".format(name, metric_type))
+            for i, sensor_label in enumerate(self.sensor_labels):
+                sensor_config = sensor_configs[sensor_label]
+                # make_response_section starts with a newline
+                lines.append(make_response_section(
+                        name, sensor_label, sensor_config["description"], sensor_config["type"], values[i])[1:])
+
+        return "\n".join(lines) + "\n"
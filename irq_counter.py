@@ -1,29 +1,141 @@
-from machine import Pin
+import machine
 import utime
-#import pyb
+from array import array
+
+# the irq handler keeps the timestamps (in us) of the last few events here,
+# for the inter-event interval statistics
+INTERVAL_RING_SIZE = 64
+
+# for the event rates, poll() takes a snapshot of the counter about once a
+# second. this keeps enough of them for the longest window.
+SNAPSHOT_INTERVAL_MS = 1000
+RATE_WINDOWS_S = (10, 60, 300)
+SNAPSHOT_RING_SIZE = 301
 
 class IRQCounter:
 
-    provides = ["count", "time_since_last_trigger"]
+    provides = ["count", "time_since_last_trigger",
+                "events_per_second_10s", "events_per_second_60s", "events_per_second_300s",
+                "interval_min_us", "interval_mean_us"]
+    # what boot.py keeps min/max/mean of between scrapes
+    aggregates = ["events_per_second_10s"]
 
     def __init__(self, port, trigger, cooldown):
+        """ cooldown is the minimum time between two events in ms,
+            triggers within the cooldown are ignored (for debouncing). """
+
         self.counter = 0
         self.last_trigger = utime.ticks_ms()
+        self._last_trigger_us = utime.ticks_us()
+        self._cooldown_us = cooldown * 1000
+
+        self._timestamps = array("I", [0] * INTERVAL_RING_SIZE)
+        self._timestamps_copy = array("I", [0] * INTERVAL_RING_SIZE)
+        self._index = 0
+
+        self._snapshot_ticks = array("I", [0] * SNAPSHOT_RING_SIZE)
+        self._snapshot_counts = array("I", [0] * SNAPSHOT_RING_SIZE)
+        self._snapshot_index = 0
+        self._snapshots = 0
+
+        # this runs in interrupt context, so it must not allocate.
+        # everything it touches exists already, and ticks are small ints.
+        timestamps = self._timestamps
+        cooldown_us = self._cooldown_us
 
         def irq_handler(pin):
-            now = utime.ticks_ms()
-            if self.last_trigger + cooldown < now:
+            now = utime.ticks_us()
+            if utime.ticks_diff(now, self._last_trigger_us) >= cooldown_us:
+                index = self._index
+                timestamps[index] = now
+                self._index = (index + 1) % INTERVAL_RING_SIZE
+                self._last_trigger_us = now
+                self.last_trigger = utime.ticks_ms()
                 self.counter += 1
-                self.last_trigger = now
 
-        port.init(Pin.IN, None)
+        self._irq_handler = irq_handler
+
+        self._port = port
+        port.init(machine.Pin.IN, None)
         port.irq(irq_handler, trigger)
 
+    def deinit(self):
+        """ stops counting, e.g. before the sensors are set up again """
+        self._port.irq(None)
+
+    def poll(self):
+        now = utime.ticks_ms()
+
+        if self._snapshots > 0:
+            last = (self._snapshot_index - 1) % SNAPSHOT_RING_SIZE
+            if utime.ticks_diff(now, self._snapshot_ticks[last]) < SNAPSHOT_INTERVAL_MS:
+                return
+
+        index = self._snapshot_index
+        self._snapshot_ticks[index] = now
+        # reading a single attribute is atomic, no need to disable irqs
+        self._snapshot_counts[index] = self.counter
+        self._snapshot_index = (index + 1) % SNAPSHOT_RING_SIZE
+        self._snapshots = min(self._snapshots + 1, SNAPSHOT_RING_SIZE)
+
+    def _rate(self, now, count, window_ms):
+        # find the oldest snapshot within the window, going backwards in time
+        # (if we don't have snapshots for the whole window yet, this ends up
+        # with the oldest one we have)
+        oldest = -1
+        for i in range(1, self._snapshots + 1):
+            index = (self._snapshot_index - i) % SNAPSHOT_RING_SIZE
+            if utime.ticks_diff(now, self._snapshot_ticks[index]) > window_ms:
+                break
+            oldest = index
+
+        if oldest == -1:
+            return 0.
+
+        elapsed_ms = utime.ticks_diff(now, self._snapshot_ticks[oldest])
+        if elapsed_ms <= 0:
+            return 0.
+
+        return (count - self._snapshot_counts[oldest]) * 1000. / elapsed_ms
+
     def readout(self):
 
-        irq_state = pyb.disable_irq()
+        self.poll()
+
+        irq_state = machine.disable_irq()
         count = self.counter
-        time_since_last_trigger = utime.ticks_ms() - self.last_trigger
-        pyb.enable_irq(irq_state)
+        last_trigger = self.last_trigger
+        index = self._index
+        for i in range(INTERVAL_RING_SIZE):
+            self._timestamps_copy[i] = self._timestamps[i]
+        machine.enable_irq(irq_state)
+
+        now = utime.ticks_ms()
+        time_since_last_trigger = utime.ticks_diff(now, last_trigger)
+
+        # inter-event intervals, oldest first
+        num_timestamps = min(count, INTERVAL_RING_SIZE)
+        interval_min = 0
+        interval_mean = 0.
+        if num_timestamps > 1:
+            timestamps = self._timestamps_copy
+            first = (index - num_timestamps) % INTERVAL_RING_SIZE
+            newest = (index - 1) % INTERVAL_RING_SIZE
+            interval_min = -1
+            for i in range(1, num_timestamps):
+                interval = utime.ticks_diff(
+                    timestamps[(first + i) % INTERVAL_RING_SIZE],
+                    timestamps[(first + i - 1) % INTERVAL_RING_SIZE])
+                if interval_min == -1 or interval < interval_min:
+                    interval_min = interval
+            interval_mean = utime.ticks_diff(timestamps[newest], timestamps[first]) / (num_timestamps - 1)
 
-        return {"count": count, "time_since_last_trigger": time_since_last_trigger}
+        return {
+            "count": count,
+            "time_since_last_trigger": time_since_last_trigger,
+            "events_per_second_10s": self._rate(now, count, RATE_WINDOWS_S[0] * 1000),
+            "events_per_second_60s": self._rate(now, count, RATE_WINDOWS_S[1] * 1000),
+            "events_per_second_300s": self._rate(now, count, RATE_WINDOWS_S[2] * 1000),
+            "interval_min_us": interval_min,
+            "interval_mean_us": interval_mean,
+        }
@@ -1,3 +1,9 @@
+import time
+
+REPLY_LENGTH = 9
+
+COMMAND_READ_CONCENTRATION = 0x86
+
 def _check_checksum(data):
     if (sum(data[1:]) & 0xff) == 0: # ignore first byte
         return True
@@ -10,44 +16,152 @@ def _compute_checksum(data):
 
 class MHZ19Sensor:
 
-    provides = ["co2_concentration"]
+    provides = ["co2_concentration", "temperature", "status", "read_errors"]
+    # what boot.py keeps min/max/mean of between scrapes
+    aggregates = ["co2_concentration", "temperature"]
 
-    def __init__(self, uart):
+    def __init__(self, uart, timeout_ms=500):
 
         uart.init(baudrate=9600, bits=8, parity=None, stop=1)
         self._uart = uart
+        self._timeout_ms = timeout_ms
+
+        # all buffers are allocated once and reused for every readout
+        self._command = bytearray(9)
+        self._buf = bytearray(REPLY_LENGTH)
+        self._reply = bytearray(REPLY_LENGTH)
+        self._pos = 0
+        self._deadline = 0
+        # whether sample() sent the last request
+        self._sampling = False
+
+        self.co2_concentration = None
+        self.temperature = None
+        self.status = None
+        self.read_errors = 0
 
         # push bytes to clear the uart
         self._send_command(0)
 
     def _send_command(self, command_id, args=bytes(0)):
-        command = bytearray(9)
+        command = self._command
         command[0] = 0xff # start byte
         command[1] = 0x01 # sensor number
         command[2] = command_id
         assert len(args) <= 5
-        command[3:3 + len(args)] = args
+        for i in range(5):
+            command[3 + i] = args[i] if i < len(args) else 0
+        command[8] = 0
         command[8] = _compute_checksum(command)
 
         self._uart.write(command)
 
-    def _get_concentration(self):
+    def _discard_input(self):
+        while self._uart.readinto(self._buf):
+            pass
+
+    def _feed(self, byte):
+        reply = self._reply
+        pos = self._pos
+
+        # wait for the 0xff 0x86 header
+        if pos == 0:
+            if byte == 0xff:
+                reply[0] = byte
+                self._pos = 1
+            return False
+
+        if pos == 1:
+            if byte == COMMAND_READ_CONCENTRATION:
+                reply[1] = byte
+                self._pos = 2
+            elif byte != 0xff:
+                self._pos = 0
+            return False
+
+        reply[pos] = byte
+        pos += 1
+        if pos < REPLY_LENGTH:
+            self._pos = pos
+            return False
+
+        self._pos = 0
+        if _check_checksum(reply):
+            return True
+
+        # corrupted reply, look for another header in the rest of it.
+        # (this only ever writes to positions before the one being read.)
+        self.read_errors += 1
+        for i in range(1, REPLY_LENGTH):
+            self._feed(reply[i])
+        return False
+
+    def request(self):
+        """ Asks the sensor for a measurement. The reply arrives after a
+            few milliseconds, and has to be picked up with collect(). """
+
         # clear read buffer
-        self._uart.read()
-        self._send_command(0x86)
-        reply = bytes()
-        while len(reply) < 9:
-            new_bytes = self._uart.read(9 - len(reply))
-            if new_bytes:
-                reply += new_bytes
-
-        assert _check_checksum(reply)
-        assert reply[0] == 0xff
-        assert reply[1] == 0x86
-        
-        concentration = reply[2] * 256 + reply[3]
-
-        return concentration
+        self._discard_input()
+        self._pos = 0
+        self._send_command(COMMAND_READ_CONCENTRATION)
+        self._deadline = time.ticks_add(time.ticks_ms(), self._timeout_ms)
+
+    def collect(self):
+        """ Reads whatever part of the reply has arrived so far. Returns
+            True once a complete reply has been received (the values are
+            then available as attributes), False if it's still on its way.
+
+            Raises a RuntimeError if there is no valid reply after the
+            timeout has passed.
+        """
+
+        buf = self._buf
+        while True:
+            num_bytes = self._uart.readinto(buf, REPLY_LENGTH - self._pos)
+            if not num_bytes:
+                break
+
+            for i in range(num_bytes):
+                if self._feed(buf[i]):
+                    reply = self._reply
+                    self.co2_concentration = reply[2] * 256 + reply[3]
+                    # undocumented, offset by 40 degrees
+                    self.temperature = reply[4] - 40
+                    self.status = reply[5]
+                    return True
+
+        if time.ticks_diff(time.ticks_ms(), self._deadline) >= 0:
+            self.read_errors += 1
+            raise RuntimeError("no valid reply from MH-Z19 sensor")
+
+        return False
+
+    def sample(self):
+        """ For sampling in between readouts, without waiting for the
+            sensor: collects the reply to the request that the last call
+            sent, and sends the next one. Returns None if there's nothing
+            to collect (yet), or if readout() has been called since. """
+
+        data = None
+        if self._sampling:
+            self._sampling = False
+            if self.collect():
+                data = {"co2_concentration": self.co2_concentration, "temperature": self.temperature}
+
+        self.request()
+        self._sampling = True
+        return data
 
     def readout(self):
-        return {"co2_concentration": self._get_concentration()}
+        # this discards the reply that sample() is waiting for
+        self._sampling = False
+        self.request()
+        while not self.collect():
+            time.sleep_ms(5)
+
+        return {
+            "co2_concentration": self.co2_concentration,
+            "temperature": self.temperature,
+            "status": self.status,
+            "read_errors": self.read_errors,
+        }
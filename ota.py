@@ -0,0 +1,467 @@
+import gc
+import hashlib
+import ubinascii
+import uos
+import ure
+import utime
+from gelf import EPOCH_OFFSET
+from sparkle import SparkleKey
+
+# over-the-air updates, see the over-the-air-updates file. this is used by
+# both the normal and the fallback mode of boot.py, so it shouldn't import
+# anything it doesn't need.
+
+# the last timestamp of a sparkle that was accepted. sparkles with older
+# (or the same) timestamps are rejected, so they can't be replayed.
+TIMESTAMP_FILE = "sparkle_timestamp"
+
+# sparkles are only accepted for this long after (or before) their
+# timestamp, as long as our clock has been set
+TIMESTAMP_WINDOW_S = 300
+CLOCK_SET_AFTER = 1600000000
+
+RECV_CHUNK_SIZE = 4096
+
+# uploads are refused if they would leave less than this on the flash. the
+# body is only checked after it has been written, so without this, anyone
+# could fill up the flash (and break the log and the state files).
+FLASH_RESERVE = 64 * 1024
+
+# files that belong to the device itself. they aren't listed, so that
+# deploy.py doesn't delete them.
+UNLISTED_FILES = ("glitter", "watchdog_state", "dutycycle_state", "dutycycle_buffer", TIMESTAMP_FILE)
+
+def parse_query(url):
+    """ b"/ota/a.py?offset=12&part" -> {b"offset": b"12", b"part": b""} """
+
+    query = {}
+    if b"?" in url:
+        for parameter in url.split(b"?", 1)[1].split(b"&"):
+            name_value = parameter.split(b"=", 1)
+            query[name_value[0]] = name_value[1] if len(name_value) > 1 else b""
+    return query
+
+def listing_root(listing):
+    """ the hash over the sorted "<filename> <hash>" lines of a listing,
+        which changes whenever any of the files does. deploy.py computes it
+        the same way. """
+
+    return ubinascii.hexlify(hashlib.sha1(listing).digest())
+
+def free_space():
+    """ in bytes, on the filesystem that ota writes to """
+    stat = uos.statvfs("/")
+    return stat[0] * stat[3]
+
+def remove_stale_uploads():
+    """ removes the .part files of uploads that were never committed.
+        boot.py calls this once after a reset, so that abandoned uploads
+        don't take up the flash for good. """
+
+    for entry_info in uos.ilistdir("/"):
+        name = entry_info[0]
+        if name.endswith(".part"):
+            uos.remove(name)
+
+def _send(connection, data):
+    connection.send(data)
+
+def _recv(connection, size):
+    return connection.recv(size)
+
+class OTAHandler:
+
+    def __init__(self, glitter, send=_send, recv=_recv, collect_garbage=gc.collect,
+                 allow_unstamped=False, timestamp_window_s=TIMESTAMP_WINDOW_S):
+        """ send(connection, data) and recv(connection, size) are used for
+            all socket io, so that the caller can count the bytes.
+            allow_unstamped also accepts sparkles without a timestamp, as
+            made by old versions of deploy.py. """
+
+        self.sparkle_key = SparkleKey(glitter)
+        self.send = send
+        self.recv = recv
+        self.collect_garbage = collect_garbage
+
+        self.allow_unstamped = allow_unstamped
+        self.timestamp_window_s = timestamp_window_s
+
+        # git blob hashes of the files, by filename. only ota changes files
+        # (other than the unlisted ones), so this is kept until it does.
+        self.file_hashes = {}
+        try:
+            with open(TIMESTAMP_FILE) as f:
+                self.last_timestamp = int(f.read())
+        except (OSError, ValueError):
+            self.last_timestamp = 0
+
+    def _file_hash(self, name):
+        """ computes a git-compatible hash """
+
+        checksum = self.file_hashes.get(name)
+        if checksum:
+            return checksum
+
+        hasher = hashlib.sha1(b"blob ")
+        with open(name, "rb") as f:
+            length = f.seek(0, 2)
+            f.seek(0)
+
+            hasher.update(str(length).encode("ascii") + bytes([0]))
+
+            while True:
+                chunk = f.read(10000)
+                if len(chunk) == 0:
+                    break
+                hasher.update(chunk)
+                del chunk
+                self.collect_garbage()
+
+        checksum = ubinascii.hexlify(hasher.digest())
+        self.file_hashes[name] = checksum
+        return checksum
+
+    def listing(self, connection, url=b"/ota-listing"):
+        """ GET /ota-listing, or GET /ota-listing?root=<root> to only get
+            the listing if its root is different """
+
+        files = []
+
+        for entry_info in uos.ilistdir("/"):
+            name = entry_info[0]
+            entry_type = entry_info[1]
+
+            # unfinished uploads aren't files of the tree, and deploy.py
+            # would delete them instead of resuming
+            if name in UNLISTED_FILES or name.endswith(".part"):
+                continue
+
+            if entry_type & 0x8000:
+                files.append(name.encode("ascii") + b" " + self._file_hash(name))
+
+        # sorted, so that the root doesn't depend on the order of the
+        # directory entries
+        files.sort()
+        response = b"\n".join(files)
+        root = listing_root(response)
+
+        if parse_query(url).get(b"root") == root:
+            # nothing changed, no need to send everything
+            self._respond(connection, "304 not modified", b"")
+            return
+
+        self.send(connection, "HTTP/1.1 200 OK\r\nContent-Length: {}\r\nX-Listing-Root: {}\r\n\r\n".format(len(response), root.decode("ascii")).encode("ascii") + response)
+
+    def handle(self, connection, request, method, url, path):
+        """ /ota/<filename>, path is the request path without the leading
+            slash """
+
+        path = path.decode("ascii")
+        path = path.split("?")[0]
+        path_parts = path.split("/")[1:]
+        if len(path_parts) > 1:
+            body = b"ota is currently not supported for files in directories other than /"
+            self.send(connection, "HTTP/1.1 404 not found\r\nContent-Length: {}\r\n\r\n".format(len(body)).encode("ascii") + body)
+            return
+
+        filename = path_parts[0]
+        if not ure.match(r"[0-9a-zA-Z_.]+$", filename):
+            body = b"invalid filename: may only contain digits, letters, or underscore"
+            self.send(connection, "HTTP/1.1 400 bad request\r\nContent-Length: {}\r\n\r\n".format(len(body)).encode("ascii") + body)
+            return
+
+        if filename == "wifi_secrets.py" or filename == "glitter":
+            body = b"the glitter is secret!"
+            self.send(connection, "HTTP/1.1 403 forbidden\r\nContent-Length: {}\r\n\r\n".format(len(body)).encode("ascii") + body)
+            return
+
+        query = parse_query(url)
+        part_filename = filename + ".part"
+
+        if method != b"GET":
+            # whatever this does, it might change a file
+            self.file_hashes = {}
+
+        if method == b"GET" and b"part" in query:
+            # how much of a resumable upload has arrived
+            try:
+                size = uos.stat(part_filename)[6]
+            except OSError:
+                self._respond(connection, "404 not found", b"no upload in progress")
+                return
+            self._respond(connection, "200 OK", str(size).encode("ascii"))
+
+        elif method == b"GET":
+            try:
+                is_file = uos.stat(filename)[0] & 0x8000
+            except:
+                is_file = False
+
+            if is_file:
+                with open(filename, "rb") as f:
+                    data = f.read()
+                    self.send(connection, "HTTP/1.1 200 OK\r\nContent-Length: {}\r\n\r\n".format(len(data)).encode("ascii") + data)
+
+            else:
+                response_body = "sorry, but we couldn't find that location :/"
+                self.send(connection, "HTTP/1.1 404 not found\r\nContent-Length: {}\r\n\r\n".format(len(response_body)) + response_body)
+
+        elif method == b"PUT" and b"offset" in query:
+            # only plain decimal numbers, so that "00" or "-0" can't start
+            # over without the sparkle below
+            if not ure.match(b"(0|[1-9][0-9]*)$", query[b"offset"]):
+                self._respond(connection, "400 bad request", b"invalid offset")
+                return
+            offset = int(query[b"offset"])
+
+            # starting an upload takes a sparkle, so that nobody else can
+            # create .part files. the chunks after it are only checked by
+            # the commit.
+            if offset == 0 and not self.authorize(connection, url, b"start " + filename.encode("ascii")):
+                return
+            self._put_chunk(connection, request, part_filename, offset)
+
+        elif method == b"DELETE" or method == b"PUT" or (method == b"POST" and b"commit" in query):
+            if not ure.match(b"[0-9a-f]+$", query.get(b"sparkle", b"")):
+                body = b"no sparkle found, please add sparkle"
+                self.send(connection, "HTTP/1.1 400 bad request\r\nContent-Length: {}\r\n\r\n".format(len(body)).encode("ascii") + body)
+                return
+
+            try:
+                given_sparkle = ubinascii.unhexlify(query[b"sparkle"])
+            except ValueError:
+                given_sparkle = b""
+            do_noop = query.get(b"noop") == b"yes"
+            timestamp = query.get(b"ts")
+
+            error = self._check_timestamp(timestamp)
+            if error:
+                self.send(connection, "HTTP/1.1 400 bad request\r\nContent-Length: {}\r\n\r\n".format(len(error)).encode("ascii") + error)
+                return
+
+            stamp = b"@" + timestamp + b" " if timestamp else b""
+            noop_prefix = b"--noop " if do_noop else b""
+            sparkle = self.sparkle_key.start(stamp + noop_prefix + filename.encode("ascii"))
+
+            if method == b"DELETE":
+                self._delete(connection, filename, sparkle, given_sparkle, timestamp, do_noop)
+            elif method == b"PUT":
+                self._put(connection, request, filename, sparkle, given_sparkle, timestamp, do_noop)
+            else:
+                self._commit(connection, filename, sparkle, given_sparkle, timestamp, do_noop)
+
+        else:
+            self._respond(connection, "405 method not allowed", b"that's not something we can do with files")
+
+    def authorize(self, connection, url, command):
+        """ checks the sparkle of a command that isn't about a file, like
+            b"reload". it's signed like a file with that name would be,
+            without the contents. responds with an error and returns False
+            if it isn't right. """
+
+        query = parse_query(url)
+        timestamp = query.get(b"ts")
+
+        error = self._check_timestamp(timestamp)
+        if error is None:
+            try:
+                given_sparkle = ubinascii.unhexlify(query.get(b"sparkle", b""))
+            except ValueError:
+                given_sparkle = b""
+            stamp = b"@" + timestamp + b" " if timestamp else b""
+            if not self._accept_sparkle(self.sparkle_key.start(stamp + command), given_sparkle, timestamp):
+                error = b"your sparkle wasn't the right one, try again!"
+
+        if error:
+            self._respond(connection, "403 forbidden", error)
+            return False
+        return True
+
+    def _respond(self, connection, status, body):
+        self.send(connection, "HTTP/1.1 {}\r\nContent-Length: {}\r\n\r\n".format(status, len(body)).encode("ascii") + body)
+
+    def _check_timestamp(self, timestamp):
+        """ returns an error message for the client, or None """
+
+        if timestamp is None:
+            if self.allow_unstamped:
+                return None
+            return b"this sparkle has no timestamp, please update your deploy script"
+
+        try:
+            timestamp = int(timestamp)
+        except ValueError:
+            return b"invalid timestamp"
+        if timestamp <= self.last_timestamp:
+            return b"this timestamp has been used already, please make a new sparkle"
+
+        now = utime.time() + EPOCH_OFFSET
+        # without ntp, our clock is somewhere around 2000. then, only the
+        # order of the timestamps protects against replays.
+        if now > CLOCK_SET_AFTER and abs(timestamp // 1000 - now) > self.timestamp_window_s:
+            return b"this timestamp is too old (or too new), check your clock"
+
+        return None
+
+    def _accept_sparkle(self, sparkle, given_sparkle, timestamp):
+        """ checks the sparkle, and makes sure its timestamp can't be used
+            again """
+
+        if not self.sparkle_key.verify(sparkle, given_sparkle):
+            return False
+
+        if timestamp:
+            self.last_timestamp = int(timestamp)
+            with open(TIMESTAMP_FILE, "w") as f:
+                f.write(str(self.last_timestamp))
+
+        return True
+
+    def _delete(self, connection, filename, sparkle, given_sparkle, timestamp, do_noop):
+
+        if not self._accept_sparkle(sparkle, given_sparkle, timestamp):
+            body = b"your sparkle wasn't the right one for this file, try again!"
+            self.send(connection, "HTTP/1.1 400 bad request\r\nContent-Length: {}\r\n\r\n".format(len(body)).encode("ascii") + body)
+            return
+
+        try:
+            is_file = uos.stat(filename)[0] & 0x8000
+        except:
+            is_file = False
+
+        if is_file:
+            if do_noop is False:
+                uos.remove(filename)
+
+            response_body = "file deleted."
+            self.send(connection, "HTTP/1.1 200 OK\r\nContent-Length: {}\r\n\r\n".format(len(response_body)) + response_body)
+
+        else:
+            response_body = "file not found"
+            self.send(connection, "HTTP/1.1 404 not found\r\nContent-Length: {}\r\n\r\n".format(len(response_body)) + response_body)
+
+    def _receive_body(self, connection, request, consume, max_length=None):
+        """ calls consume() with every piece of the request body as it
+            arrives, so that it never has to fit into memory as a whole.
+            returns False (after responding) if there's no content-length,
+            or if it's larger than max_length. """
+
+        # try to find the content-length header
+        request_head, content = request.split(b"\r\n\r\n", 1)
+        request_head += b"\r\n"
+        content_length_match = ure.search(b"[cC][oO][nN][tT][eE][nN][tT]-[lL][eE][nN][gG][tT][hH]:[ \t]+([0-9]+)\r\n", request_head)
+        if not content_length_match:
+            body = b"length header is required for putting files"
+            self.send(connection, "HTTP/1.1 411 length required\r\nContent-Length: {}\r\n\r\n".format(len(body)).encode("ascii") + body)
+            return False
+
+        content_length = int(content_length_match.group(1))
+        if max_length is not None and content_length > max_length:
+            self._respond(connection, "413 payload too large", b"that doesn't fit on the flash")
+            return False
+
+        missing_content_length = content_length - len(content)
+        while True:
+            consume(content)
+            if missing_content_length <= 0:
+                return True
+
+            del content
+            content = self.recv(connection, min(missing_content_length, RECV_CHUNK_SIZE))
+            if not content:
+                raise OSError("connection closed with {} bytes missing".format(missing_content_length))
+            missing_content_length -= len(content)
+
+    def _put(self, connection, request, filename, sparkle, given_sparkle, timestamp, do_noop):
+
+        sparkle.update(b" ")
+        part_filename = filename + ".part"
+        f = None if do_noop else open(part_filename, "wb")
+
+        def consume(content):
+            sparkle.update(content)
+            if f:
+                f.write(content)
+
+        complete = False
+        try:
+            complete = self._receive_body(connection, request, consume,
+                                          None if do_noop else free_space() - FLASH_RESERVE)
+        finally:
+            if f:
+                f.close()
+                if not complete:
+                    uos.remove(part_filename)
+
+        if not complete:
+            return
+
+        if not self._accept_sparkle(sparkle, given_sparkle, timestamp):
+            if not do_noop:
+                uos.remove(part_filename)
+            body = b"your sparkle wasn't the right one for this file, try again!"
+            self.send(connection, "HTTP/1.1 400 bad request\r\nContent-Length: {}\r\n\r\n".format(len(body)).encode("ascii") + body)
+            return
+
+        if do_noop is False:
+            uos.rename(part_filename, filename)
+
+        body = b"update successful"
+        self.send(connection, "HTTP/1.1 200 OK\r\nContent-Length: {}\r\n\r\n".format(len(body)).encode("ascii") + body)
+
+    def _put_chunk(self, connection, request, part_filename, offset):
+        """ appends to the .part file of a resumable upload. the offset
+            has to be its current size (or 0 to start over), and whatever
+            arrives is kept, even if the connection breaks. responds with
+            the new size. chunks that would leave less than FLASH_RESERVE
+            are refused. """
+
+        try:
+            size = uos.stat(part_filename)[6]
+        except OSError:
+            size = 0
+
+        if offset != 0 and offset != size:
+            self._respond(connection, "409 conflict", str(size).encode("ascii"))
+            return
+
+        max_length = free_space() - FLASH_RESERVE
+        if offset == 0:
+            # that's overwritten
+            max_length += size
+
+        with open(part_filename, "wb" if offset == 0 else "ab") as f:
+            if not self._receive_body(connection, request, f.write, max_length):
+                return
+            size = f.tell()
+
+        self._respond(connection, "200 OK", str(size).encode("ascii"))
+
+    def _commit(self, connection, filename, sparkle, given_sparkle, timestamp, do_noop):
+        """ finishes a resumable upload. the sparkle is the same as for
+            putting the whole file at once. """
+
+        part_filename = filename + ".part"
+
+        sparkle.update(b" ")
+        try:
+            with open(part_filename, "rb") as f:
+                while True:
+                    chunk = f.read(RECV_CHUNK_SIZE)
+                    if len(chunk) == 0:
+                        break
+                    sparkle.update(chunk)
+                    del chunk
+        except OSError:
+            self._respond(connection, "404 not found", b"no upload in progress")
+            return
+
+        # the .part file is kept, the client can start over with offset 0
+        if not self._accept_sparkle(sparkle, given_sparkle, timestamp):
+            self._respond(connection, "400 bad request", b"your sparkle wasn't the right one for this file, try again!")
+            return
+
+        if do_noop is False:
+            uos.rename(part_filename, filename)
+
+        self._respond(connection, "200 OK", b"update successful")
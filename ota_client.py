@@ -0,0 +1,86 @@
+import time
+
+# the client side of resumable ota uploads (see over-the-air-updates), for
+# deploy.py. it doesn't do any http itself, so that it can be tested
+# against the device code directly.
+
+
+class UploadError(RuntimeError):
+    pass
+
+
+def upload_resumable(request, file_contents, make_start_params, make_commit_params, chunk_size=16384,
+                     max_failures=10, retry_delay_s=1):
+    """ Uploads file_contents in chunks, picking up where the device left
+    off after connection problems (including an earlier, unfinished upload
+    of the same file), then commits it.
+
+    request(method, params, body) sends a request for /ota/<filename> and
+    returns (status code, response text). It raises OSError when the
+    connection breaks. make_start_params() and make_commit_params() return
+    fresh sparkle parameters for the first chunk and for the commit.
+
+    Returns the number of bytes sent. Raises UploadError after
+    max_failures connection problems, or if the device refuses.
+    """
+
+    failures = 0
+    bytes_sent = 0
+    offset = None
+    started_over = False
+    committing = False
+
+    while True:
+        try:
+            if offset is None:
+                status, text = request("GET", {"part": ""}, b"")
+                if status == 200:
+                    offset = int(text)
+                elif committing and status == 404:
+                    # the commit went through, only its response got lost
+                    return bytes_sent
+                else:
+                    offset = 0
+
+                # that's from some other upload
+                if offset > len(file_contents):
+                    offset = 0
+
+            committing = False
+            while offset < len(file_contents) or (offset == 0 and bytes_sent == 0):
+                chunk = file_contents[offset:offset + chunk_size]
+                bytes_sent += len(chunk)
+                params = {"offset": str(offset)}
+                if offset == 0:
+                    params.update(make_start_params())
+                status, text = request("PUT", params, chunk)
+                if status not in (200, 409):
+                    raise UploadError(f"device refused chunk at offset {offset}: {status} {text}")
+                # either way, the device tells us how much it has now
+                offset = int(text)
+                if len(file_contents) == 0:
+                    break
+
+            committing = True
+            status, text = request("POST", dict(commit="", **make_commit_params()), b"")
+
+        except OSError as e:
+            failures += 1
+            if failures > max_failures:
+                raise UploadError(f"giving up after {failures} connection problems") from e
+            time.sleep(retry_delay_s)
+            # ask the device how much arrived
+            offset = None
+            continue
+
+        if status == 200:
+            return bytes_sent
+
+        if status == 400 and "sparkle wasn't the right one" in text and not started_over:
+            # the .part file might have been left over from an upload of
+            # something else, start over once
+            started_over = True
+            offset = 0
+            continue
+
+        raise UploadError(f"device refused the commit: {status} {text}")
@@ -1,32 +1,136 @@
+import argparse
+import binascii
+import os
 import socket
 import sys
-import json
-import binascii
-import hmac
+import time
 import yaml
 
-with open("devices.yaml") as f:
-    devices = yaml.safe_load(f)
+from sparkle import SparkleKey
+
+# pushes a single file, without the startup cost of deploy.py (no git, no
+# requests). the file is never read into memory as a whole: it's read once
+# to make the sparkle, and once more while sending it.
+
+chunk_size = 65536
+
+
+def make_argument_parser():
+
+    parser = argparse.ArgumentParser(description="push a single file to a device via ota")
+    parser.add_argument("device", type=str,
+                        help="device name, as in devices.yaml. it has to resolve to the IP of the device.")
+    parser.add_argument("filename", type=str,
+                        help="file to push, it ends up under the same name in the root directory of the device")
+    parser.add_argument("--noop", action="store_true",
+                        help="do a no-op run (the device checks the sparkle, but doesn't write the file)")
+
+    return parser
+
+
+def read_chunks(filename):
+
+    with open(filename, "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+
+def make_sparkle_params(sparkle_key, filename, timestamp, noop=False):
+    """ the same as deploy.py's, but reads the file in chunks """
+
+    prefix = b"@" + str(timestamp).encode("ascii") + b" "
+    if noop:
+        prefix += b"--noop "
+
+    sparkle = sparkle_key.start(prefix + os.path.basename(filename).encode("ascii") + b" ")
+    for chunk in read_chunks(filename):
+        sparkle.update(chunk)
+
+    return [
+        ("sparkle", binascii.hexlify(sparkle.make_sparkle()).decode("ascii")),
+        ("noop", "yes" if noop else "no"),
+        ("ts", str(timestamp)),
+    ]
+
+
+def read_response(sock):
+    """ returns (status code, reason, body) """
+
+    data = b""
+    while b"\r\n\r\n" not in data:
+        chunk = sock.recv(4096)
+        if not chunk:
+            raise ConnectionError(f"connection closed before the response was complete: {data!r}")
+        data += chunk
+
+    head, body = data.split(b"\r\n\r\n", 1)
+    status_line, *header_lines = head.decode("iso-8859-1").split("\r\n")
+    _, status, reason = (status_line.split(" ", 2) + [""])[:3]
+
+    headers = {}
+    for line in header_lines:
+        name, _, value = line.partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+    if "content-length" in headers:
+        content_length = int(headers["content-length"])
+        while len(body) < content_length:
+            chunk = sock.recv(4096)
+            if not chunk:
+                raise ConnectionError("connection closed before the response body was complete")
+            body += chunk
+    else:
+        # the device closes the connection after responding
+        while True:
+            chunk = sock.recv(4096)
+            if not chunk:
+                break
+            body += chunk
+
+    return int(status), reason, body
+
+
+def push_file(sock, filename, params):
+    """ streams the file to the device, returns (bytes sent, seconds
+    taken, status code, reason, body) """
+
+    size = os.path.getsize(filename)
+    query = "&".join(f"{name}={value}" for name, value in params)
+
+    started = time.monotonic()
+
+    sock.sendall(f"PUT /ota/{os.path.basename(filename)}?{query} HTTP/1.1\r\ncontent-length: {size}\r\nhost: {sock.getpeername()[0]}\r\n\r\n".encode("ascii"))
+
+    bytes_sent = 0
+    for chunk in read_chunks(filename):
+        sock.sendall(chunk)
+        bytes_sent += len(chunk)
+
+    # the device only responds once it has written everything
+    status, reason, body = read_response(sock)
+
+    return bytes_sent, time.monotonic() - started, status, reason, body
+
+
+if __name__ == "__main__":
 
-device = sys.argv[1]
-filename = sys.argv[2]
+    args = make_argument_parser().parse_args()
 
-key = binascii.unhexlify(devices[device]["glitter"])
+    with open("devices.yaml") as f:
+        devices = yaml.safe_load(f)
 
-with open(filename, "rb") as f:
-    file_contents = f.read()
+    sparkle_key = SparkleKey(binascii.unhexlify(devices[args.device]["glitter"]))
 
-hmac = binascii.hexlify(
-        hmac.digest(key, filename.encode("ascii") + b" " + file_contents, "sha256")
-       ).decode("ascii")
+    # the device rejects sparkles with old (or reused) timestamps
+    params = make_sparkle_params(sparkle_key, args.filename, time.time_ns() // 1000000, noop=args.noop)
 
-s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-s.connect((device, 5000))
+    with socket.create_connection((args.device, 5000)) as sock:
+        bytes_sent, duration, status, reason, body = push_file(sock, args.filename, params)
 
-s.send("PUT /ota/{}?sparkle={} HTTP/1.1\r\ncontent-length: {}\r\nhost: bla\r\n\r\n".format(
-    filename,
-    hmac,
-    len(file_contents)).encode("ascii") + file_contents)
+    print(f"{status} {reason}: {body.decode('utf-8', 'replace')}")
+    print(f"sent {bytes_sent} bytes in {duration:.2f} s ({bytes_sent / duration / 1024:.1f} KiB/s)")
 
-print(s.recv(1000).decode("ascii"))
-s.close()
+    sys.exit(0 if status == 200 else 1)
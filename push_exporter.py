@@ -0,0 +1,206 @@
+import socket
+import utime
+from gelf import EPOCH_OFFSET
+
+INF = float("inf")
+
+def _escape(value):
+    # tag keys and values in the line protocol
+    return value.replace(" ", "\\ ").replace(",", "\\,").replace("=", "\\=")
+
+def format_line(measurement, tags, fields, timestamp=None):
+    """ Formats one line of influx line protocol. The timestamp is in
+        seconds, tags is a sequence of (name, value) pairs. nan and inf
+        fields (e.g. the rssi without wifi) are left out, since the line
+        protocol has no way to write them. Returns None if that leaves no
+        fields. """
+
+    line = _escape(measurement)
+    for name, value in tags:
+        line += "," + _escape(name) + "=" + _escape(value)
+
+    separator = " "
+    for name, value in fields.items():
+        if type(value) == float and (value != value or value == INF or value == -INF):
+            continue
+        if type(value) == int:
+            value = "{}i".format(value)
+        else:
+            value = "{}".format(value)
+        line += separator + _escape(name) + "=" + value
+        separator = ","
+
+    if separator == " ":
+        return None
+
+    if timestamp is not None:
+        line += " {}".format(timestamp)
+
+    return line
+
+
+class UDPTransport:
+
+    # keep datagrams below the usual mtu
+    max_payload = 1400
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.socket = None
+
+    def send(self, payload):
+        # resolved on the first push rather than at setup, which might be
+        # without wifi. a failed lookup is an OSError like any failed send.
+        if self.socket is None:
+            address = socket.getaddrinfo(self.host, self.port)[0][-1]
+            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            try:
+                s.connect(address)
+            except OSError:
+                s.close()
+                raise
+            self.socket = s
+        self.socket.send(payload)
+
+
+class HTTPTransport:
+    """ POSTs to an influxdb-compatible /write endpoint. Raises an OSError
+        if the collector can't be reached or doesn't answer with 2xx. """
+
+    max_payload = 4096
+
+    def __init__(self, host, port, path, timeout_s=5):
+        self.host = host
+        self.port = port
+        self.path = path
+        self.timeout_s = timeout_s
+        # resolved on the first push, like for udp
+        self.address = None
+
+    def send(self, payload):
+        if self.address is None:
+            self.address = socket.getaddrinfo(self.host, self.port)[0][-1]
+
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            s.settimeout(self.timeout_s)
+            s.connect(self.address)
+            # send() may write only part of a payload this size
+            s.sendall("POST {} HTTP/1.0\r\nHost: {}\r\nContent-Length: {}\r\n\r\n".format(
+                self.path, self.host, len(payload)).encode("ascii"))
+            s.sendall(payload)
+
+            status_line = s.recv(64).split(b"\r\n", 1)[0]
+            status = status_line.split(b" ")
+            if len(status) < 2 or not status[1].startswith(b"2"):
+                raise OSError("collector replied with {}".format(status_line))
+
+        finally:
+            s.close()
+
+
+def make_transport(url):
+    """ udp://host:port or http://host:port/path?query. our timestamps are
+        in seconds, so precision=s is added to http paths that don't have a
+        precision (influxdb would take them as nanoseconds). for udp, the
+        precision is set in the collector's config. """
+
+    scheme, rest = url.split("://", 1)
+    if "/" in rest:
+        address, path = rest.split("/", 1)
+        path = "/" + path
+    else:
+        address, path = rest, "/write"
+    host, port = address.split(":")
+
+    if "precision=" not in path:
+        path += ("&" if "?" in path else "?") + "precision=s"
+
+    if scheme == "udp":
+        return UDPTransport(host, int(port))
+
+    elif scheme == "http":
+        return HTTPTransport(host, int(port), path)
+
+    raise ValueError("unsupported push target {}".format(url))
+
+
+class PushExporter:
+    """ Collects sensor readings as influx line protocol and pushes them to
+        a collector every interval_s.
+
+        If the collector can't be reached, the lines are kept and sent with
+        the next push. At most max_lines are kept, older ones are dropped
+        (and counted) first.
+    """
+
+    def __init__(self, transport, hostname, interval_s=60, max_lines=200):
+        self.transport = transport
+        self.hostname = hostname
+        self.interval_ms = int(interval_s * 1000)
+        self.max_lines = max_lines
+
+        self._lines = []
+        self._last_push = utime.ticks_ms()
+
+        self.lines_sent = 0
+        self.bytes_sent = 0
+        self.lines_dropped = 0
+        self.push_errors = 0
+
+    def add(self, sensor_label, sensor_type, values):
+        timestamp = utime.time() + EPOCH_OFFSET
+        line = format_line(
+                "humiditemp",
+                (("host", self.hostname), ("sensor", sensor_label), ("type", sensor_type)),
+                values,
+                timestamp)
+        if line is not None:
+            self.add_line(line)
+
+    def add_line(self, line):
+        """ for lines that were formatted elsewhere, e.g. read back from
+            flash """
+
+        if len(self._lines) >= self.max_lines:
+            self._lines.pop(0)
+            self.lines_dropped += 1
+
+        self._lines.append(line)
+
+    def poll(self):
+        if self._lines and utime.ticks_diff(utime.ticks_ms(), self._last_push) >= self.interval_ms:
+            self.push()
+
+    def push(self):
+        """ Sends everything that's buffered, in batches that fit the
+            transport. Stops at the first error. """
+
+        self._last_push = utime.ticks_ms()
+        max_payload = self.transport.max_payload
+
+        while self._lines:
+            # take as many lines as fit into one payload (at least one)
+            num_lines = 0
+            size = 0
+            while num_lines < len(self._lines):
+                line_size = len(self._lines[num_lines]) + 1
+                if num_lines > 0 and size + line_size > max_payload:
+                    break
+                size += line_size
+                num_lines += 1
+
+            payload = "\n".join(self._lines[:num_lines]).encode("utf-8") + b"\n"
+
+            try:
+                self.transport.send(payload)
+            except OSError:
+                self.push_errors += 1
+                return False
+
+            self._lines = self._lines[num_lines:]
+            self.lines_sent += num_lines
+            self.bytes_sent += len(payload)
+
+        return True
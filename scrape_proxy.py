@@ -0,0 +1,227 @@
+import argparse
+import asyncio
+import re
+import time
+import yaml
+
+
+def make_argument_parser():
+
+    parser = argparse.ArgumentParser(description="scrape all devices from devices.yaml once per interval, and serve the results to any number of clients")
+    parser.add_argument("--devices", type=str, default="devices.yaml",
+                        help="device list (default: devices.yaml)")
+    parser.add_argument("--listen", type=str, default="0.0.0.0:5001",
+                        help="address and port to serve on (default: 0.0.0.0:5001)")
+    parser.add_argument("--interval", type=float, default=30,
+                        help="scrape interval in seconds (default: 30)")
+    parser.add_argument("--timeout", type=float, default=10,
+                        help="timeout for scraping a single device in seconds (default: 10)")
+    parser.add_argument("--concurrency", type=int, default=8,
+                        help="maximum number of devices scraped at once (default: 8)")
+
+    return parser
+
+
+sample_re = re.compile(r"([a-zA-Z_:][a-zA-Z0-9_:]*)(\{.*\})?\s+(\S+)\s*$")
+type_re = re.compile(r"# TYPE ([a-zA-Z_:][a-zA-Z0-9_:]*) (\S+)\s*$")
+
+
+def add_instance_label(line, instance):
+
+    match_result = sample_re.match(line)
+    if not match_result:
+        return None
+
+    name, labels, value = match_result.groups()
+    if labels and labels != "{}":
+        labels = f'{{instance="{instance}", ' + labels[1:]
+    else:
+        labels = f'{{instance="{instance}"}}'
+
+    return name, f"{name}{labels} {value}"
+
+
+class DeviceState:
+
+    def __init__(self, name, address):
+
+        self.name = name
+        self.address = address
+        self.body = None
+        self.up = 0
+        self.scrape_duration = 0.
+        self.last_success = None
+        self.scrapes = 0
+        self.failures = 0
+
+
+class ScrapeProxy:
+
+    def __init__(self, devices, interval=30, timeout=10, concurrency=8):
+        """ devices maps device names to (host, port) """
+
+        self.devices = {name: DeviceState(name, address) for name, address in devices.items()}
+        self.interval = interval
+        self.timeout = timeout
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.merged = ""
+
+    async def fetch(self, address):
+
+        host, port = address
+        reader, writer = await asyncio.open_connection(host, port)
+        try:
+            writer.write(f"GET /metrics HTTP/1.0\r\nHost: {host}\r\n\r\n".encode("ascii"))
+            await writer.drain()
+
+            # the devices close the connection after responding
+            response = await reader.read()
+
+        finally:
+            writer.close()
+
+        head, _, body = response.partition(b"\r\n\r\n")
+        status_line = head.split(b"\r\n", 1)[0]
+        status = status_line.split(b" ")
+        if len(status) < 2 or status[1] != b"200":
+            raise RuntimeError(f"device responded with {status_line!r}")
+
+        return body.decode("utf-8")
+
+    async def scrape_device(self, device):
+
+        async with self.semaphore:
+            start = time.monotonic()
+            try:
+                device.body = await asyncio.wait_for(self.fetch(device.address), self.timeout)
+                device.up = 1
+                device.last_success = time.time()
+
+            except Exception:
+                # the last response isn't served as if it were current
+                device.body = None
+                device.up = 0
+                device.failures += 1
+
+            device.scrapes += 1
+            device.scrape_duration = time.monotonic() - start
+
+    async def scrape_all(self):
+
+        await asyncio.gather(*(self.scrape_device(device) for device in self.devices.values()))
+        self.merged = self.merge()
+
+    def merge(self):
+        """ Merges all device responses into one exposition, with an
+            instance label added to every sample. Samples are grouped by
+            metric name, so every TYPE line appears only once. """
+
+        types = {}
+        samples = {}
+
+        for device in self.devices.values():
+            if device.body is None:
+                continue
+
+            for line in device.body.splitlines():
+                line = line.strip()
+                if not line:
+                    continue
+
+                type_match = type_re.match(line)
+                if type_match:
+                    types.setdefault(type_match.group(1), type_match.group(2))
+                    continue
+
+                if line.startswith("#"):
+                    continue
+
+                result = add_instance_label(line, device.name)
+                if result:
+                    name, sample = result
+                    samples.setdefault(name, []).append(sample)
+
+        output = []
+        for name, lines in samples.items():
+            output.append(f"# TYPE {name} {types.get(name, 'untyped')}")
+            output += lines
+
+        output.append("# TYPE humiditemp_up gauge")
+        output += [f'humiditemp_up{{instance="{device.name}"}} {device.up}' for device in self.devices.values()]
+        output.append("# TYPE humiditemp_scrape_duration_seconds gauge")
+        output += [f'humiditemp_scrape_duration_seconds{{instance="{device.name}"}} {device.scrape_duration:.3f}' for device in self.devices.values()]
+        output.append("# TYPE humiditemp_scrape_failures_total counter")
+        output += [f'humiditemp_scrape_failures_total{{instance="{device.name}"}} {device.failures}' for device in self.devices.values()]
+
+        return "\n".join(output) + "\n"
+
+    async def run_scraper(self):
+
+        while True:
+            start = time.monotonic()
+            await self.scrape_all()
+            await asyncio.sleep(max(0, self.interval - (time.monotonic() - start)))
+
+    def get_response(self, path):
+
+        if path == "/metrics":
+            return 200, self.merged
+
+        match_result = re.fullmatch(r"/devices/([^/]+)/metrics", path)
+        if match_result:
+            device = self.devices.get(match_result.group(1))
+            if device is not None and device.body is not None:
+                return 200, device.body
+
+        return 404, "sorry, but we couldn't find that location :/"
+
+    async def handle_client(self, reader, writer):
+
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), self.timeout)
+            # skip the headers, we don't need them
+            while (await asyncio.wait_for(reader.readline(), self.timeout)).strip():
+                pass
+
+            parts = request_line.decode("ascii", "replace").split(" ")
+            if len(parts) != 3:
+                status, body = 400, "bad request"
+            else:
+                status, body = self.get_response(parts[1].split("?")[0])
+
+            body = body.encode("utf-8")
+            reason = {200: "OK", 400: "bad request", 404: "not found"}[status]
+            writer.write(f"HTTP/1.1 {status} {reason}\r\nContent-Length: {len(body)}\r\nContent-Type: text/plain; version=0.0.4\r\nConnection: close\r\n\r\n".encode("ascii") + body)
+            await writer.drain()
+
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+
+        finally:
+            writer.close()
+
+    async def serve(self, host, port):
+
+        server = await asyncio.start_server(self.handle_client, host, port)
+        async with server:
+            await asyncio.gather(server.serve_forever(), self.run_scraper())
+
+
+def load_devices(filename):
+
+    with open(filename) as f:
+        device_configs = yaml.safe_load(f)
+
+    # like deploy.py, this relies on the device names resolving to the devices
+    return {device: (device, 5000) for device in device_configs.keys()}
+
+
+if __name__ == "__main__":
+
+    parser = make_argument_parser()
+    args = parser.parse_args()
+
+    host, port = args.listen.rsplit(":", 1)
+
+    proxy = ScrapeProxy(load_devices(args.devices), interval=args.interval, timeout=args.timeout, concurrency=args.concurrency)
+    asyncio.run(proxy.serve(host, int(port)))
@@ -1,43 +1,325 @@
+import time
+
+FRAME_LENGTH = 10
+COMMAND_LENGTH = 19
+
+# command ids, see the "laser dust sensor control protocol" document
+COMMAND_REPORTING_MODE = 2
+COMMAND_QUERY = 4
+COMMAND_SLEEP_WORK = 6
+COMMAND_WORKING_PERIOD = 8
+
+# how long to wait for the sensor to acknowledge a command before resending it
+COMMAND_TIMEOUT_MS = 1000
+
+STATE_CONTINUOUS = 0
+STATE_SLEEPING = 1
+STATE_WARMING_UP = 2
+STATE_SAMPLING = 3
+
 def _check_checksum(data):
     checksum = sum(data[2:8]) & 0xff
     return (checksum == data[8])
 
-def _check_reply(data):
-    if len(data) < 10:
-        return False
-    if data[-1] != 0xab or data[-10] != 0xaa or data[-9] != 0xc0:
-        return False
-    return True
+def _make_command(command, command_id, value):
+    # aa b4 <command id> <set> <value> 00 ... 00 ff ff <checksum> ab
+    # (the set byte is ignored for the query command)
+    command[0] = 0xaa
+    command[1] = 0xb4
+    command[2] = command_id
+    command[3] = 1
+    command[4] = value
+    for i in range(5, 15):
+        command[i] = 0
+    # ff ff addresses all sensors
+    command[15] = 0xff
+    command[16] = 0xff
+    command[17] = sum(command[2:17]) & 0xff
+    command[18] = 0xab
+    return command
 
 class SDS011Sensor:
 
-    provides = ["pm2_5_ug_m3", "pm10_ug_m3"]
+    provides = ["pm2_5_ug_m3", "pm10_ug_m3",
+                "pm2_5_ug_m3_min", "pm2_5_ug_m3_max",
+                "pm10_ug_m3_min", "pm10_ug_m3_max",
+                "frames", "frame_errors", "command_errors", "sleeping"]
+    # what boot.py keeps min/max/mean of between scrapes. the _min and _max
+    # above are the sensor's own, over the frames since the last readout.
+    aggregates = ["pm2_5_ug_m3", "pm10_ug_m3"]
+
+    def __init__(self, uart, period_s=None, warmup_s=30, samples=5, working_period_min=None):
+        """ By default, the sensor measures continuously, and we just
+            listen to it.
+
+            If period_s is given, the sensor is duty-cycled by us instead:
+            every period_s, it is woken up, and after running the fan for
+            warmup_s, samples frames are queried before it is put back to
+            sleep. Readouts between bursts return the values of the last
+            burst.
 
-    def __init__(self, uart):
+            Alternatively, working_period_min (1 to 30) makes the sensor
+            duty-cycle itself, reporting a measurement every n minutes.
+        """
 
         uart.init(baudrate=9600, bits=8, parity=None, stop=1)
         self._uart = uart
 
+        # the sensor sends one frame per second. we read whatever is in the
+        # uart into _buf and push it through the parser byte by byte, which
+        # assembles frames in _frame. both buffers are allocated only once.
+        self._buf = bytearray(64)
+        self._frame = bytearray(FRAME_LENGTH)
+        self._pos = 0
+
+        self.frame_errors = 0
+        self._burst_frames = 0
+        self._reset_stats()
+        self._last_data = None
+        # the newest frame, for sample()
+        self._newest_pm25 = 0
+        self._newest_pm10 = 0
+        self._new_frame = False
+
+        self._command = bytearray(COMMAND_LENGTH)
+        self._queued_commands = []
+        self._pending_command = None
+        self._command_sent = 0
+        self.command_errors = 0
+
+        if period_s is None:
+            self._state = STATE_CONTINUOUS
+            if working_period_min is not None:
+                self.set_working_period(working_period_min)
+
+        else:
+            self._period_ms = int(period_s * 1000)
+            self._warmup_ms = int(warmup_s * 1000)
+            self._samples = samples
+            self._sampling_timeout_ms = samples * 1000 + 5000
+            self._last_query = 0
+
+            self.set_query_mode(True)
+            self.set_working_period(0)
+            self._wake_up(time.ticks_ms())
+
+    def _reset_stats(self):
+        # all values are kept in the sensor's native unit of 0.1 ug/m^3
+        self._frames = 0
+        self._pm25_sum = 0
+        self._pm25_min = 0xffff
+        self._pm25_max = 0
+        self._pm10_sum = 0
+        self._pm10_min = 0xffff
+        self._pm10_max = 0
+
+    def _add_frame(self, frame):
+        pm25 = frame[3] * 256 + frame[2]
+        pm10 = frame[5] * 256 + frame[4]
+
+        self._frames += 1
+        self._burst_frames += 1
+        self._pm25_sum += pm25
+        self._pm25_min = min(self._pm25_min, pm25)
+        self._pm25_max = max(self._pm25_max, pm25)
+        self._pm10_sum += pm10
+        self._pm10_min = min(self._pm10_min, pm10)
+        self._pm10_max = max(self._pm10_max, pm10)
+
+        self._newest_pm25 = pm25
+        self._newest_pm10 = pm10
+        self._new_frame = True
+
+    def _handle_reply(self, frame):
+        # aa c5 <command id> <set> <value> ...
+        pending = self._pending_command
+        if pending is not None and frame[2] == pending[0] and frame[4] == pending[1]:
+            self._pending_command = None
+
+    def _feed(self, byte):
+        frame = self._frame
+        pos = self._pos
+
+        # wait for the 0xaa 0xc0 (measurement) or 0xaa 0xc5 (command reply)
+        # header
+        if pos == 0:
+            if byte == 0xaa:
+                frame[0] = byte
+                self._pos = 1
+            return
+
+        if pos == 1:
+            if byte == 0xc0 or byte == 0xc5:
+                frame[1] = byte
+                self._pos = 2
+            elif byte != 0xaa:
+                self._pos = 0
+            return
+
+        frame[pos] = byte
+        pos += 1
+        if pos < FRAME_LENGTH:
+            self._pos = pos
+            return
+
+        self._pos = 0
+        if frame[9] == 0xab and _check_checksum(frame):
+            if frame[1] == 0xc0:
+                self._add_frame(frame)
+            else:
+                self._handle_reply(frame)
+            return
+
+        # broken frame. there might be the start of a valid frame somewhere
+        # in there, so we push the rest of it through the parser again.
+        # the parser only ever writes to positions before the byte it is
+        # currently reading, so it's safe to do this in-place.
+        self.frame_errors += 1
+        for i in range(1, FRAME_LENGTH):
+            self._feed(frame[i])
+
+    def _queue_command(self, command_id, value):
+        self._queued_commands.append((command_id, value))
+
+    def _write_command(self, command_id, value):
+        self._uart.write(_make_command(self._command, command_id, value))
+
+    def _process_commands(self, now):
+        """ Sends queued commands one at a time, waiting for each to be
+            acknowledged. Returns True while commands are outstanding. """
+
+        if self._pending_command is not None:
+            if time.ticks_diff(now, self._command_sent) < COMMAND_TIMEOUT_MS:
+                return True
+
+            # no reply, try again
+            self.command_errors += 1
+
+        elif self._queued_commands:
+            self._pending_command = self._queued_commands.pop(0)
+
+        else:
+            return False
+
+        self._write_command(*self._pending_command)
+        self._command_sent = now
+        return True
+
+    def set_query_mode(self, query):
+        """ In query mode, the sensor only sends measurements on request,
+            otherwise it sends them continuously. """
+        self._queue_command(COMMAND_REPORTING_MODE, 1 if query else 0)
+
+    def set_working(self, work):
+        """ Puts the sensor to sleep (laser and fan off) or wakes it up. """
+        self._queue_command(COMMAND_SLEEP_WORK, 1 if work else 0)
+
+    def set_working_period(self, minutes):
+        """ 0 means continuous operation, otherwise the sensor wakes up
+            every n minutes (up to 30) to take a measurement. """
+        assert 0 <= minutes <= 30
+        self._queue_command(COMMAND_WORKING_PERIOD, minutes)
+
+    def _wake_up(self, now):
+        self.set_working(True)
+        self._state = STATE_WARMING_UP
+        self._state_since = now
+        self._cycle_start = now
+
+    def _step(self, now):
+        if self._process_commands(now):
+            return
+
+        state = self._state
+        elapsed = time.ticks_diff(now, self._state_since)
+
+        if state == STATE_SLEEPING:
+            if time.ticks_diff(now, self._cycle_start) >= self._period_ms:
+                self._wake_up(now)
+
+        elif state == STATE_WARMING_UP:
+            if elapsed >= self._warmup_ms:
+                self._state = STATE_SAMPLING
+                self._state_since = now
+                self._burst_frames = 0
+                self._write_command(COMMAND_QUERY, 0)
+                self._last_query = now
+
+        elif state == STATE_SAMPLING:
+            if self._burst_frames >= self._samples or elapsed >= self._sampling_timeout_ms:
+                self.set_working(False)
+                self._state = STATE_SLEEPING
+                self._state_since = now
+
+            elif time.ticks_diff(now, self._last_query) >= 1000:
+                self._write_command(COMMAND_QUERY, 0)
+                self._last_query = now
+
+    def poll(self):
+        """ Parses everything the sensor has sent since the last call, and
+            advances the duty cycle. This never blocks, and should be
+            called often enough for the uart buffer not to overflow (i.e.,
+            every few seconds), or every second or so when duty-cycling. """
+
+        buf = self._buf
+        while True:
+            num_bytes = self._uart.readinto(buf)
+            if not num_bytes:
+                break
+
+            for i in range(num_bytes):
+                self._feed(buf[i])
+
+        if self._state != STATE_CONTINUOUS:
+            self._step(time.ticks_ms())
+
+        elif self._pending_command is not None or self._queued_commands:
+            self._process_commands(time.ticks_ms())
+
+    def sample(self):
+        """ The newest frame, for sampling in between readouts. Unlike
+            readout(), this leaves the averages alone. Returns None if
+            there hasn't been a new frame since the last call. """
+
+        self.poll()
+
+        if not self._new_frame:
+            return None
+        self._new_frame = False
+
+        return {"pm2_5_ug_m3": self._newest_pm25 / 10., "pm10_ug_m3": self._newest_pm10 / 10.}
+
     def readout(self):
 
-        reply = bytes()
-        i = 0
-        while not _check_reply(reply):
-            new_bytes = self._uart.read()
-            if new_bytes:
-                reply += new_bytes
-            i += 1
-            if i >= 20:
-                raise RuntimeError("too many iterations")
-
-        reply = reply[-10:]
-
-        assert _check_checksum(reply)
-        assert reply[0] == 0xaa
-        assert reply[1] == 0xc0
-        assert reply[9] == 0xab
-        
-        pm25 = (reply[3] * 256 + reply[2]) / 10.
-        pm10 = (reply[5] * 256 + reply[4]) / 10.
-
-        return {"pm2_5_ug_m3": pm25, "pm10_ug_m3": pm10}
+        self.poll()
+
+        frames = self._frames
+        if frames == 0:
+            # the sensor is sleeping between bursts, or two readouts came
+            # within a second of each other
+            if self._last_data is not None:
+                self._last_data["frames"] = 0
+                self._last_data["frame_errors"] = self.frame_errors
+                self._last_data["command_errors"] = self.command_errors
+                self._last_data["sleeping"] = int(self._state == STATE_SLEEPING)
+                return self._last_data
+
+            raise RuntimeError("no valid frame received yet")
+
+        data = {
+            "pm2_5_ug_m3": self._pm25_sum / frames / 10.,
+            "pm10_ug_m3": self._pm10_sum / frames / 10.,
+            "pm2_5_ug_m3_min": self._pm25_min / 10.,
+            "pm2_5_ug_m3_max": self._pm25_max / 10.,
+            "pm10_ug_m3_min": self._pm10_min / 10.,
+            "pm10_ug_m3_max": self._pm10_max / 10.,
+            "frames": frames,
+            "frame_errors": self.frame_errors,
+            "command_errors": self.command_errors,
+            "sleeping": int(self._state == STATE_SLEEPING),
+        }
+
+        self._reset_stats()
+        self._last_data = data
+
+        return data
@@ -0,0 +1,58 @@
+import machine
+import utime
+from irq_counter import IRQCounter
+from bme280_sensor import BME280Sensor
+from i2c_bus import I2CBus
+from derived import DerivedMetrics
+from dht22_sensor import DHT22Sensor
+from mhz19_sensor import MHZ19Sensor
+from sds011_sensor import SDS011Sensor
+
+# creates the sensors from sensor_configs, for both run modes of boot.py
+
+def make_sensors(sensor_configs, settle_ms=2000):
+    """ returns the sensors by label, and the i2c buses that some of them
+        are on. settle_ms is how long the sensors get after powering up. """
+
+    # extra 3.3v pin (for connecting two sensors at once)
+    machine.Pin(13, machine.Pin.OUT).on()
+
+    print("before sleep")
+
+    # wait for dht sensor to stabilize
+    utime.sleep_ms(settle_ms)
+
+    # initialize sensor objects
+    sensors = {}
+    for sensor_label, sensor_config in sensor_configs.items():
+        if sensor_config["type"] == "dht":
+            sensors[sensor_label] = DHT22Sensor(sensor_config["port"], **sensor_config.get("settings", {}))
+
+        elif sensor_config["type"] == "bme":
+            sensors[sensor_label] = BME280Sensor(sensor_config["port"], **sensor_config.get("settings", {}))
+
+        elif sensor_config["type"] == "mhz":
+            sensors[sensor_label] = MHZ19Sensor(sensor_config["port"], **sensor_config.get("settings", {}))
+
+        elif sensor_config["type"] == "sds":
+            sensors[sensor_label] = SDS011Sensor(sensor_config["port"], **sensor_config.get("settings", {}))
+
+        elif sensor_config["type"] == "counter":
+            sensors[sensor_label] = IRQCounter(sensor_config["port"], **sensor_config.get("settings", {}))
+
+    # devices on the same i2c bus are read out together, so that their
+    # conversions run at the same time
+    i2c_buses = {}
+    for sensor_label, sensor in list(sensors.items()):
+        if sensor_configs[sensor_label]["type"] == "bme":
+            port = sensor_configs[sensor_label]["port"]
+            if port not in i2c_buses:
+                i2c_buses[port] = I2CBus(str(len(i2c_buses)))
+            sensors[sensor_label] = i2c_buses[port].add(sensor_label, sensor)
+
+    # e.g. the dew point, computed from the same readout
+    for sensor_label, sensor_config in sensor_configs.items():
+        if sensor_config.get("derived"):
+            sensors[sensor_label] = DerivedMetrics(sensors[sensor_label], sensor_config["derived"])
+
+    return sensors, i2c_buses
@@ -11,13 +11,46 @@ def _make_meow(miao):
 def _make_nyaa(miao):
     return _translate_miao(miao, 0x5c)
 
+def _equal(a, b):
+    # compares in constant time, so that the time a comparison takes
+    # doesn't tell how many bytes were right
+    if len(a) != len(b):
+        return False
+    difference = 0
+    for x, y in zip(a, b):
+        difference |= x ^ y
+    return difference == 0
+
+class SparkleKey:
+    """ A glitter with its meow and nyaa computed once, for checking (or
+        making) any number of sparkles. """
+
+    def __init__(self, miao):
+
+        assert(len(miao) == 32)
+        self.meow = _make_meow(miao)
+        self.nyaa = _make_nyaa(miao)
+
+    def start(self, initial=bytes()):
+        """ returns a Sparkle, to be fed with update() """
+        return Sparkle(self, initial)
+
+    def sign(self, data):
+        return Sparkle(self, data).make_sparkle()
+
+    def verify(self, sparkle, given_sparkle):
+        """ given_sparkle is the raw (not hex) sparkle from the request """
+        return _equal(sparkle.make_sparkle(), given_sparkle)
+
 class Sparkle:
 
     def __init__(self, miao, initial=bytes()):
+        """ miao is a glitter or a SparkleKey """
 
-        assert(len(miao) == 32)
-        self.nyaa = _make_nyaa(miao)
-        self.munch = hashlib.sha256(_make_meow(miao) + initial)
+        key = miao if isinstance(miao, SparkleKey) else SparkleKey(miao)
+        self.nyaa = key.nyaa
+        self.munch = hashlib.sha256(key.meow)
+        self.munch.update(initial)
 
     def update(self, data):
         self.munch.update(data)
@@ -0,0 +1,82 @@
+import pytest
+
+import hostsim
+clock = hostsim.install()
+
+from aggregator import MetricAggregator, SUFFIXES
+from bme280_sensor import BME280Sensor
+from dht22_sensor import DHT22Sensor
+from irq_counter import IRQCounter
+from mhz19_sensor import MHZ19Sensor
+from sds011_sensor import SDS011Sensor
+
+sensors = {"kitchen": ["temperature", "humidity"], "co2": ["co2_concentration"]}
+
+def collect(aggregator):
+    return {(label, name): stats for label, name, *stats in aggregator.collect()}
+
+def test_reset_per_collect():
+
+    aggregator = MetricAggregator(sensors)
+    for temperature in (20., 23., 21.):
+        aggregator.add("kitchen", {"temperature": temperature, "humidity": 50.})
+    aggregator.add("co2", {"co2_concentration": 400})
+
+    result = collect(aggregator)
+    assert result[("kitchen", "temperature")] == pytest.approx([20., 23., 64. / 3, 3])
+    assert result[("kitchen", "humidity")] == pytest.approx([50., 50., 50., 3])
+    assert result[("co2", "co2_concentration")] == pytest.approx([400, 400, 400, 1])
+
+    aggregator.add("co2", {"co2_concentration": 800})
+    result = collect(aggregator)
+    assert list(result.keys()) == [("co2", "co2_concentration")]
+    assert result[("co2", "co2_concentration")] == pytest.approx([800, 800, 800, 1])
+
+def test_unknown_metrics_are_ignored():
+
+    aggregator = MetricAggregator(sensors)
+    aggregator.add("co2", {"co2_concentration": 400, "status": 0})
+    assert len(collect(aggregator)) == 1
+
+def test_rolling_window():
+
+    aggregator = MetricAggregator(sensors, window_s=60, num_buckets=6)
+
+    # one sample every 5 seconds for two minutes, the value is the time
+    for t in range(0, 120, 5):
+        aggregator.add("co2", {"co2_concentration": t})
+        clock.advance_ms(5000)
+
+    # the window covers the current bucket and the five before it
+    result = collect(aggregator)
+    minimum, maximum, mean, samples = result[("co2", "co2_concentration")]
+    assert maximum == 115
+    assert 60 <= minimum <= 70
+    assert samples == (115 - minimum) / 5 + 1
+
+    # collecting doesn't reset the window
+    assert collect(aggregator) == result
+
+    # and after a long pause, everything is gone
+    clock.advance_ms(120000)
+    assert collect(aggregator) == {}
+
+@pytest.mark.parametrize("sensor_class", [BME280Sensor, DHT22Sensor, IRQCounter, MHZ19Sensor, SDS011Sensor])
+def test_aggregate_names_dont_clash(sensor_class):
+
+    assert set(sensor_class.aggregates) <= set(sensor_class.provides)
+    names = [name + suffix for name in sensor_class.aggregates for suffix in SUFFIXES]
+    assert not set(names) & set(sensor_class.provides)
+
+def test_sds011_aggregates():
+
+    # the sensor has its own _min/_max and counters, which aren't aggregated
+    aggregator = MetricAggregator({"dust": SDS011Sensor.aggregates})
+    aggregator.add("dust", {"pm2_5_ug_m3": 3.5, "pm10_ug_m3": 7.0, "pm2_5_ug_m3_min": 2.0,
+                            "pm2_5_ug_m3_max": 5.0, "pm10_ug_m3_min": 6.0, "pm10_ug_m3_max": 9.0,
+                            "frames": 10, "frame_errors": 0, "command_errors": 0, "sleeping": 0})
+
+    names = [name + suffix for label, name, *stats in aggregator.collect() for suffix in SUFFIXES]
+    assert names == ["pm2_5_ug_m3_agg_min", "pm2_5_ug_m3_agg_max", "pm2_5_ug_m3_agg_avg", "pm2_5_ug_m3_agg_samples",
+                     "pm10_ug_m3_agg_min", "pm10_ug_m3_agg_max", "pm10_ug_m3_agg_avg", "pm10_ug_m3_agg_samples"]
+    assert not set(names) & set(SDS011Sensor.provides)
@@ -0,0 +1,99 @@
+import json
+import math
+
+import pytest
+
+from binmetrics import BinaryMetrics, HEADER_SIZE
+from binmetrics_decode import decode, to_prometheus_text
+from exposition import render_text
+from sds011_sensor import SDS011Sensor
+
+sensor_configs = {
+    "kitchen": {"type": "bme", "description": "next to the fridge"},
+    "co2": {"type": "mhz", "description": "living room"},
+}
+
+def make_index():
+    index = []
+    for sensor_label, names in (("kitchen", ["temperature", "humidity"]), ("co2", ["co2_concentration"])):
+        config = sensor_configs[sensor_label]
+        labels = {"label": sensor_label, "description": config["description"], "type": config["type"]}
+        index += [(name, sensor_label, labels) for name in names]
+    index.append(("memory_free", None, {}))
+    index.append(("frames", "co2", index[2][2]))
+    index.append(("load", None, {}))
+    return index
+
+metrics = [
+    ("temperature", "kitchen", 21.5),
+    ("humidity", "kitchen", 40.25),
+    ("co2_concentration", "co2", 812),
+    ("memory_free", None, 51200),
+    # a counter that f32 can't hold exactly
+    ("frames", "co2", 123456789),
+    ("load", None, 0.1),
+]
+
+def test_roundtrip():
+
+    binary_metrics = BinaryMetrics(make_index())
+    schema = json.loads(binary_metrics.schema)
+
+    data = bytes(binary_metrics.pack(metrics))
+    # one byte of int flags
+    assert len(data) == HEADER_SIZE + 1 + 6 * 4
+
+    sequence, decoded = decode(schema, data)
+    assert sequence == 1
+    assert [(name, value) for name, labels, value in decoded][:5] == [(name, value) for name, sensor_label, value in metrics][:5]
+    assert [type(value) for name, labels, value in decoded] == [float, float, int, int, int, float]
+    assert decoded[0][1] == {"label": "kitchen", "description": "next to the fridge", "type": "bme"}
+
+    assert decode(schema, bytes(binary_metrics.pack(metrics)))[0] == 2
+
+def test_missing_values():
+
+    binary_metrics = BinaryMetrics(make_index())
+    schema = json.loads(binary_metrics.schema)
+
+    # the co2 sensor is broken, and something unknown showed up
+    data = binary_metrics.pack([metrics[0], metrics[1], ("unknown", "kitchen", 1.), metrics[3]])
+    sequence, decoded = decode(schema, bytes(data))
+    assert [name for name, labels, value in decoded] == ["temperature", "humidity", "memory_free"]
+
+def test_duplicate_names():
+
+    # e.g. aggregates named like what the sds011 reports itself
+    labels = {"label": "dust", "description": "balcony", "type": "sds"}
+    index = [(name, "dust", labels) for name in SDS011Sensor.provides]
+    index += [(name + "_min", "dust", labels) for name in ("pm2_5_ug_m3", "pm10_ug_m3")]
+    with pytest.raises(ValueError, match="pm2_5_ug_m3_min"):
+        BinaryMetrics(index)
+
+    # the same name for another sensor is fine
+    BinaryMetrics(make_index() + [("temperature", "co2", {})])
+
+def test_schema_change():
+
+    binary_metrics = BinaryMetrics(make_index())
+    schema = json.loads(binary_metrics.schema)
+
+    other_metrics = BinaryMetrics(make_index()[:2])
+    assert other_metrics.schema_id != binary_metrics.schema_id
+    with pytest.raises(RuntimeError, match="schema"):
+        decode(schema, bytes(other_metrics.pack(metrics)))
+
+def test_same_text_as_device():
+
+    binary_metrics = BinaryMetrics(make_index())
+    schema = json.loads(binary_metrics.schema)
+    sequence, decoded = decode(schema, bytes(binary_metrics.pack(metrics)))
+
+    metric_names = ["temperature", "humidity", "co2_concentration", "memory_free", "frames", "load"]
+    device_text = render_text(metric_names, metrics, sensor_configs)
+    decoded_text = to_prometheus_text(decoded)
+
+    def lines(text):
+        return sorted(line for line in text.splitlines() if line.strip())
+
+    assert lines(device_text) == lines(decoded_text)
@@ -0,0 +1,152 @@
+import math
+
+import pytest
+
+import hostsim
+clock = hostsim.install()
+
+from circuit_breaker import CircuitBreaker, CLOSED, OPEN, HALF_OPEN, render_text
+
+class MockSDS:
+    """ fails like the particle sensor without any frames: slowly """
+
+    provides = ["pm2_5_ug_m3"]
+
+    def __init__(self):
+        self.broken = False
+        self.readouts = 0
+        self.polls = 0
+
+    def poll(self):
+        self.polls += 1
+
+    def readout(self):
+        self.readouts += 1
+        if self.broken:
+            clock.advance_ms(3000)
+            raise RuntimeError("too many iterations")
+        return {"pm2_5_ug_m3": 4.5 + self.readouts}
+
+@pytest.fixture
+def sensor():
+    clock.now_us = 0
+    return MockSDS()
+
+def test_passes_readouts_through(sensor):
+
+    breaker = CircuitBreaker(sensor)
+    assert breaker.provides == ["pm2_5_ug_m3"]
+    assert breaker.readout() == {"pm2_5_ug_m3": 5.5}
+    assert not breaker.stale
+
+    breaker.poll()
+    assert sensor.polls == 1
+
+def test_opens_and_backs_off(sensor):
+
+    breaker = CircuitBreaker(sensor, failure_threshold=3, min_open_ms=10000, max_open_ms=40000)
+    breaker.readout()
+    sensor.broken = True
+
+    for failures in range(1, 4):
+        # the last good values are served right away
+        assert breaker.readout() == {"pm2_5_ug_m3": 5.5}
+        assert breaker.stale
+        assert breaker.failures == failures
+    assert breaker.state == OPEN
+    assert breaker.trips == 1
+    assert sensor.readouts == 4
+
+    # the sensor is left alone, so scrapes are fast again
+    start = clock.now_us
+    for _ in range(9):
+        assert breaker.readout() == {"pm2_5_ug_m3": 5.5}
+        clock.advance_ms(1000)
+    assert sensor.readouts == 4
+    assert breaker.skipped == 9
+    assert clock.now_us - start == 9000 * 1000
+
+    # a single try after open_ms, then twice as long, up to max_open_ms
+    clock.advance_ms(1000)
+    for readouts, open_ms in ((5, 20000), (6, 40000), (7, 40000)):
+        breaker.readout()
+        assert sensor.readouts == readouts
+        assert breaker.state == OPEN
+        assert breaker.open_ms == open_ms
+        clock.advance_ms(open_ms - 1)
+        breaker.readout()
+        assert sensor.readouts == readouts
+        clock.advance_ms(1)
+
+    # it works again
+    sensor.broken = False
+    assert breaker.readout() == {"pm2_5_ug_m3": 12.5}
+    assert breaker.state == CLOSED
+    assert breaker.open_ms == 10000
+    assert not breaker.stale
+    assert breaker.data_age_ms() == 0
+
+def test_half_open(sensor):
+
+    breaker = CircuitBreaker(sensor, failure_threshold=1, min_open_ms=10000)
+    breaker.readout()
+    sensor.broken = True
+    breaker.readout()
+    clock.advance_ms(10000)
+
+    # the try in between is what's half open
+    def readout():
+        assert breaker.state == HALF_OPEN
+        raise RuntimeError("still broken")
+    sensor.readout = readout
+    breaker.readout()
+    assert breaker.state == OPEN
+
+def test_sample(sensor):
+
+    breaker = CircuitBreaker(sensor, failure_threshold=2)
+    assert breaker.sample() == {"pm2_5_ug_m3": 5.5}
+    assert breaker.aggregates == []
+
+    # failed samples count like failed readouts, but there's no last good
+    # value to serve instead
+    sensor.broken = True
+    for _ in range(2):
+        with pytest.raises(RuntimeError):
+            breaker.sample()
+    assert breaker.state == OPEN
+    assert breaker.failures == 2
+
+    # only readouts try the sensor while the breaker is open
+    assert breaker.sample() is None
+    assert sensor.readouts == 3
+
+def test_without_good_values(sensor):
+
+    sensor.broken = True
+    breaker = CircuitBreaker(sensor, failure_threshold=2)
+    for _ in range(2):
+        with pytest.raises(RuntimeError, match="too many iterations"):
+            breaker.readout()
+    assert breaker.state == OPEN
+
+    # skipped, but there's still nothing to serve
+    with pytest.raises(RuntimeError, match="skipped"):
+        breaker.readout()
+    assert sensor.readouts == 2
+    assert math.isnan(breaker.data_age_ms())
+
+def test_render_text(sensor):
+
+    breaker = CircuitBreaker(sensor, failure_threshold=1)
+    breaker.readout()
+    sensor.broken = True
+    breaker.readout()
+    clock.advance_ms(500)
+
+    text = render_text({"dust": breaker}, {"dust": {"description": "balcony", "type": "sds"}})
+    assert "# TYPE sensor_breaker_state gauge" in text
+    assert 'sensor_breaker_state{label="dust", description="balcony", type="sds"} 1' in text
+    assert 'sensor_breaker_failures_total{label="dust", description="balcony", type="sds"} 1' in text
+    assert 'sensor_breaker_trips_total{label="dust", description="balcony", type="sds"} 1' in text
+    assert 'sensor_data_age_ms{label="dust", description="balcony", type="sds"} 3500' in text
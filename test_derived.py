@@ -0,0 +1,73 @@
+import pytest
+
+import hostsim
+clock = hostsim.install()
+
+from derived import DerivedMetrics, dew_point, absolute_humidity, sea_level_pressure, altitude
+
+def test_formulas():
+
+    # reference values from the usual online calculators
+    assert dew_point(20, 50) == pytest.approx(9.3, abs=0.1)
+    assert dew_point(-5, 80) == pytest.approx(-8.0, abs=0.2)
+    assert dew_point(20, 0) < -60
+    assert absolute_humidity(20, 50) == pytest.approx(8.65, abs=0.05)
+    assert absolute_humidity(30, 100) == pytest.approx(30.4, abs=0.2)
+    assert sea_level_pressure(986.0, 15, 230) == pytest.approx(1013.4, abs=0.5)
+    assert altitude(1013.25) == pytest.approx(0)
+    assert altitude(986.0) == pytest.approx(230, abs=5)
+
+class MockSensor:
+
+    provides = ["temperature", "humidity", "pressure"]
+
+    def __init__(self):
+        self.readouts = 0
+
+    def readout(self):
+        self.readouts += 1
+        return {"temperature": 15.0, "humidity": 60.0, "pressure": 986.0}
+
+class MockDHT:
+
+    provides = ["temperature", "humidity", "reading_age_ms"]
+
+    def __init__(self):
+        self.polls = 0
+
+    def poll(self):
+        self.polls += 1
+
+    def readout(self):
+        return {"temperature": 20.0, "humidity": 50.0, "reading_age_ms": 0}
+
+def test_single_readout():
+
+    sensor = MockSensor()
+    derived = DerivedMetrics(sensor, {"metrics": ["dew_point", "absolute_humidity", "sea_level_pressure", "altitude"], "altitude_m": 230})
+
+    assert derived.provides == ["temperature", "humidity", "pressure", "dew_point", "absolute_humidity", "sea_level_pressure", "altitude"]
+    data = derived.readout()
+    assert sensor.readouts == 1
+    assert data["pressure"] == 986.0
+    assert data["sea_level_pressure"] == pytest.approx(sea_level_pressure(986.0, 15.0, 230))
+    assert data["dew_point"] == pytest.approx(dew_point(15.0, 60.0))
+    assert data["altitude"] == pytest.approx(altitude(986.0))
+
+def test_dht():
+
+    sensor = MockDHT()
+    derived = DerivedMetrics(sensor, {"metrics": ["dew_point"]})
+    assert derived.readout()["dew_point"] == pytest.approx(9.3, abs=0.1)
+
+    # still gets polled
+    derived.poll()
+    assert sensor.polls == 1
+
+    with pytest.raises(ValueError):
+        DerivedMetrics(MockDHT(), {"metrics": ["altitude"]})
+
+def test_sea_level_pressure_needs_altitude():
+
+    with pytest.raises(ValueError):
+        DerivedMetrics(MockSensor(), {"metrics": ["sea_level_pressure"]})
@@ -0,0 +1,75 @@
+import pytest
+
+import hostsim
+clock = hostsim.install()
+
+import dht22_sensor
+from dht22_sensor import DHT22Sensor, MIN_INTERVAL_MS, MAX_BACKOFF_MS
+
+@pytest.fixture
+def sensor(monkeypatch):
+    clock.now_us = 0
+    monkeypatch.setattr(dht22_sensor, "time", clock)
+    return DHT22Sensor(None)
+
+def test_cached_within_min_interval(sensor):
+
+    data = sensor.readout()
+    assert data["temperature"] == 21.5
+    assert data["humidity"] == 45.0
+    assert data["reading_age_ms"] == 0
+    assert sensor._sensor.measurements == 1
+
+    # the sensor isn't asked again within the minimum interval
+    sensor._sensor.values = (22.0, 50.0)
+    clock.advance_ms(MIN_INTERVAL_MS - 1)
+    data = sensor.readout()
+    assert data["temperature"] == 21.5
+    assert data["reading_age_ms"] == MIN_INTERVAL_MS - 1
+    assert sensor._sensor.measurements == 1
+
+    # but right after it
+    clock.advance_ms(1)
+    data = sensor.readout()
+    assert data["temperature"] == 22.0
+    assert data["humidity"] == 50.0
+    assert data["reading_age_ms"] == 0
+    assert sensor._sensor.measurements == 2
+
+def test_no_reading_yet(sensor):
+
+    sensor._sensor.broken = True
+    with pytest.raises(RuntimeError):
+        sensor.readout()
+    assert sensor.read_errors == 1
+
+def test_backs_off_after_errors(sensor):
+
+    sensor.readout()
+    sensor._sensor.broken = True
+
+    # the last good reading is served, and the retries get further apart
+    attempts = []
+    for _ in range(400):
+        clock.advance_ms(500)
+        measurements = sensor._sensor.measurements
+        data = sensor.readout()
+        if sensor._sensor.measurements > measurements:
+            attempts.append(clock.now_us // 1000)
+        assert data["temperature"] == 21.5
+        assert data["reading_age_ms"] == clock.now_us // 1000
+
+    intervals = [b - a for a, b in zip(attempts, attempts[1:])]
+    assert intervals[:5] == [2000, 4000, 8000, 16000, 32000]
+    assert max(intervals) == MAX_BACKOFF_MS
+    assert sensor.read_errors == len(attempts)
+    assert sensor.read_retries == len(attempts) - 1
+
+    # back to normal after the first good reading
+    sensor._sensor.broken = False
+    clock.advance_ms(MAX_BACKOFF_MS)
+    assert sensor.readout()["reading_age_ms"] == 0
+    clock.advance_ms(MIN_INTERVAL_MS)
+    measurements = sensor._sensor.measurements
+    sensor.readout()
+    assert sensor._sensor.measurements == measurements + 1
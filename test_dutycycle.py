@@ -0,0 +1,232 @@
+import os
+
+import pytest
+
+import hostsim
+clock = hostsim.install()
+
+import machine
+from dutycycle import DutyCycle, MIN_SLEEP_MS, PUSH_BATCH_LINES
+
+class MockSensor:
+
+    provides = ["temperature", "status"]
+
+    def __init__(self, readout_ms=50):
+        self.readout_ms = readout_ms
+        self.readouts = 0
+        self.broken = False
+
+    def readout(self):
+        clock.advance_ms(self.readout_ms)
+        if self.broken:
+            raise OSError("no answer")
+        self.readouts += 1
+        return {"temperature": 20.0 + self.readouts, "status": self.readouts}
+
+class MockTransport:
+
+    max_payload = 1400
+
+    def __init__(self):
+        self.lines = []
+        self.payloads = 0
+        self.fail = False
+
+    def send(self, payload):
+        if self.fail:
+            raise OSError("collector unreachable")
+        self.payloads += 1
+        self.lines += payload.decode("utf-8").splitlines()
+
+class Environment:
+    """ the parts of the device that DutyCycle.run() gets as callbacks """
+
+    def __init__(self, connect_ms=1500, ntp_time=1760000000):
+        self.connect_ms = connect_ms
+        self.connected = True
+        self.ntp_time = ntp_time
+        self.transport = MockTransport()
+        self.connects = 0
+        self.ota_windows = []
+
+    def connect_wifi(self):
+        self.connects += 1
+        clock.advance_ms(self.connect_ms)
+        # like main(), which sets the clock once it's connected
+        if self.connected and self.ntp_time is not None and clock.time() < 1600000000:
+            clock.settime(self.ntp_time)
+        return self.connected
+
+    def make_transport(self):
+        return self.transport
+
+    def serve_ota(self, window_ms):
+        self.ota_windows.append(window_ms)
+        clock.advance_ms(window_ms)
+
+@pytest.fixture
+def files(tmp_path):
+    clock.now_us = 0
+    machine.last_reset_cause = machine.PWRON_RESET
+    yield {"state_file": str(tmp_path / "dutycycle_state"), "buffer_file": str(tmp_path / "dutycycle_buffer")}
+    clock.rtc_offset_s = 0
+
+def wake(files, sensors, environment, **kwargs):
+    """ one cycle, up to the deep sleep """
+
+    duty_cycle = DutyCycle(sensors, {label: {"type": "dht"} for label in sensors}, "balcony", **files, **kwargs)
+    with pytest.raises(hostsim.Reset):
+        duty_cycle.run(environment.connect_wifi, environment.make_transport, environment.serve_ota)
+    assert machine.last_reset_cause == machine.DEEPSLEEP_RESET
+    return duty_cycle
+
+def test_push_every(files):
+
+    sensors = {"outside": MockSensor()}
+    environment = Environment()
+
+    wake(files, sensors, environment, period_s=60, push_every=3, stay_awake_s=10)
+    # the first wakeup after powering up is an ota window
+    assert environment.ota_windows == [10000]
+    assert environment.connects == 1
+    # the sample was pushed right away, since the wifi was up anyway
+    assert len(environment.transport.lines) == 2
+    assert machine.slept_ms == 60000 - 50 - 1500 - 10000
+
+    environment.transport.lines = []
+    start = clock.now_us
+    wake(files, sensors, environment, period_s=60, push_every=3)
+    # sleeping for the rest of the period
+    assert clock.now_us - start == 60000 * 1000
+    assert environment.connects == 1
+    with open(files["buffer_file"]) as f:
+        assert len(f.read().splitlines()) == 1
+
+    # the third wakeup pushes
+    duty_cycle = wake(files, sensors, environment, period_s=60, push_every=3)
+    assert environment.connects == 2
+    assert environment.ota_windows == [10000]
+    assert not os.path.exists(files["buffer_file"])
+
+    lines = environment.transport.lines
+    assert len(lines) == 3
+    assert lines[0].startswith("humiditemp,host=balcony,sensor=outside,type=dht temperature=22.0,status=2i")
+    # the statistics of the two cycles before this one
+    assert lines[2].startswith("dutycycle,host=balcony cycles=2i,awake_ms=11600i,wifi_ms=11500i,buffered=2i")
+    assert duty_cycle.state["wakes"] == 3
+
+def test_stay_awake_every(files):
+
+    sensors = {"outside": MockSensor()}
+    environment = Environment()
+
+    for _ in range(10):
+        wake(files, sensors, environment, push_every=100, stay_awake_every=4, stay_awake_s=30)
+    assert environment.ota_windows == [30000] * 3
+    assert environment.connects == 3
+
+    # a reset that isn't a wakeup (e.g. after deploying) starts over. without
+    # wifi, there's no ota window, and the cycle goes on.
+    environment.connected = False
+    machine.last_reset_cause = machine.SOFT_RESET
+    duty_cycle = wake(files, sensors, environment, push_every=100, stay_awake_every=4, stay_awake_s=30)
+    assert duty_cycle.wake == 0
+    assert environment.connects == 4
+    assert len(environment.ota_windows) == 3
+    # the buffer is on flash, so the reading of the last wakeup is still
+    # there
+    assert duty_cycle.state["buffered"] == 2
+
+def test_failed_push_keeps_lines(files):
+
+    sensors = {"outside": MockSensor(), "inside": MockSensor()}
+    environment = Environment()
+    environment.transport.fail = True
+
+    for _ in range(6):
+        duty_cycle = wake(files, sensors, environment, push_every=2, max_buffer_lines=7)
+    # the first wakeup pushes as well
+    assert duty_cycle.state["push_errors"] == 4
+    # 12 readings and 4 statistics lines, of which only the newest 7 fit
+    assert duty_cycle.state["lines_dropped"] == 9
+    assert duty_cycle.state["buffered"] == 7
+
+    environment.transport.fail = False
+    for _ in range(2):
+        duty_cycle = wake(files, sensors, environment, push_every=2, max_buffer_lines=7)
+    assert len(environment.transport.lines) == 7
+    assert environment.transport.lines[-1].startswith("dutycycle,host=balcony cycles=2i")
+    assert "push_errors=4i" in environment.transport.lines[-1]
+    assert duty_cycle.state["buffered"] == 0
+
+def test_samples_per_wake(files):
+
+    sensors = {"outside": MockSensor(), "broken": MockSensor()}
+    sensors["broken"].broken = True
+    environment = Environment()
+
+    wake(files, sensors, environment, samples_per_wake=4, sample_spacing_ms=1000,
+         push_every=1, stay_awake_s=0)
+    # the mean, and ints stay ints
+    assert environment.transport.lines[0].startswith("humiditemp,host=balcony,sensor=outside,type=dht temperature=22.5,status=2i")
+    assert "sensor_errors=4i" in environment.transport.lines[1]
+
+def test_long_cycle(files):
+
+    sensors = {"outside": MockSensor(readout_ms=2000)}
+    wake(files, sensors, Environment(), period_s=1, push_every=100)
+    assert machine.slept_ms == MIN_SLEEP_MS
+
+def test_timestamps_from_before_the_clock_was_set(files):
+
+    sensors = {"outside": MockSensor()}
+    environment = Environment()
+    environment.ntp_time = None
+
+    # the wifi can't set the clock, so nothing is pushed
+    for _ in range(2):
+        duty_cycle = wake(files, sensors, environment, period_s=60, push_every=2, stay_awake_s=10)
+    assert environment.transport.lines == []
+    assert duty_cycle.state["buffered"] == 4
+
+    environment.ntp_time = 1760000000
+    for _ in range(2):
+        wake(files, sensors, environment, period_s=60, push_every=2)
+
+    timestamps = [int(line.rpartition(" ")[2]) for line in environment.transport.lines if line.startswith("humiditemp")]
+    # one reading every minute since powering up. the clock was set 181 s
+    # after that, while connecting for the last push.
+    assert timestamps == [1760000000 - 181 + 60 * i for i in range(4)]
+
+def test_push_in_batches(files):
+
+    sensors = {"sensor{}".format(i): MockSensor() for i in range(3 * PUSH_BATCH_LINES)}
+    environment = Environment()
+    duty_cycle = wake(files, sensors, environment, push_every=1, stay_awake_s=0)
+
+    assert len(environment.transport.lines) == 3 * PUSH_BATCH_LINES + 1
+    assert environment.transport.payloads >= 4
+    assert duty_cycle.state["buffered"] == 0
+    assert not os.path.exists(files["buffer_file"])
+
+def test_failed_batch_stays(files):
+
+    sensors = {"sensor{}".format(i): MockSensor() for i in range(3 * PUSH_BATCH_LINES)}
+    environment = Environment()
+    transport = environment.transport
+    send = transport.send
+
+    def fail_second_batch(payload):
+        if transport.payloads >= 2:
+            raise OSError("collector unreachable")
+        send(payload)
+    transport.send = fail_second_batch
+
+    duty_cycle = wake(files, sensors, environment, push_every=1, stay_awake_s=0)
+    assert duty_cycle.state["push_errors"] == 1
+    assert duty_cycle.state["buffered"] == 3 * PUSH_BATCH_LINES + 1 - len(transport.lines)
+
+    transport.send = send
+    wake(files, sensors, environment, push_every=1)
+    assert len(set(transport.lines)) == len(transport.lines) == 2 * (3 * PUSH_BATCH_LINES + 1)
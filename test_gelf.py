@@ -0,0 +1,125 @@
+import json
+import socket
+
+import pytest
+
+import hostsim
+clock = hostsim.install()
+
+import gelf
+from gelf import GelfLogger
+
+class Listener(object):
+    """ a local stand-in for the graylog udp input """
+
+    def __init__(self):
+
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind(("127.0.0.1", 0))
+        self.socket.settimeout(0.1)
+        self.address = self.socket.getsockname()
+        self.chunks = {}
+
+    def receive_datagram(self):
+
+        try:
+            return self.socket.recv(65536)
+        except socket.timeout:
+            return None
+
+    def receive(self):
+        """ returns all complete messages received so far """
+
+        messages = []
+        while True:
+            data = self.receive_datagram()
+            if data is None:
+                return messages
+
+            if data[:2] == gelf.CHUNK_MAGIC:
+                message_id, sequence_number, sequence_count = data[2:10], data[10], data[11]
+                chunks = self.chunks.setdefault(message_id, {})
+                chunks[sequence_number] = data[12:]
+                if len(chunks) < sequence_count:
+                    continue
+                data = b"".join(chunks[i] for i in range(sequence_count))
+                del self.chunks[message_id]
+
+            messages.append(json.loads(data))
+
+@pytest.fixture
+def listener():
+    listener = Listener()
+    yield listener
+    listener.socket.close()
+
+def test_batching(listener):
+
+    logger = GelfLogger(listener.address, host="test-device", flush_threshold=3, flush_interval_ms=1000)
+    logger.info("one")
+    logger.error("two", full_message="details")
+    assert listener.receive() == []
+
+    logger.warning("three")
+    messages = listener.receive()
+    assert [message["short_message"] for message in messages] == ["one", "two", "three"]
+    assert [message["level"] for message in messages] == [gelf.LEVEL_INFO, gelf.LEVEL_ERROR, gelf.LEVEL_WARNING]
+    assert messages[1]["full_message"] == "details"
+    assert all(message["host"] == "test-device" and message["version"] == "1.1" for message in messages)
+
+    # the rest is sent on the next poll after the interval
+    logger.info("four")
+    logger.poll()
+    assert listener.receive() == []
+    clock.advance_ms(1000)
+    logger.poll()
+    assert [message["short_message"] for message in listener.receive()] == ["four"]
+
+def test_deduplication(listener):
+
+    logger = GelfLogger(listener.address, flush_threshold=10)
+    for _ in range(50):
+        logger.error("exception in main loop", full_message="traceback")
+    logger.flush()
+
+    messages = listener.receive()
+    assert len(messages) == 1
+    assert messages[0]["_count"] == 50
+    assert logger.deduplicated == 49
+
+def test_rate_limit(listener):
+
+    logger = GelfLogger(listener.address, flush_threshold=1, rate_limit=5, rate_period_s=60)
+    for i in range(20):
+        logger.error("error {}".format(i))
+        logger.debug("debug {}".format(i))
+
+    messages = listener.receive()
+    assert len(messages) == 10
+    assert logger.suppressed == 30
+
+    clock.advance_ms(60000)
+    logger.error("after the pause")
+    assert len(listener.receive()) == 1
+
+def test_overflow(listener):
+
+    logger = GelfLogger(listener.address, max_pending=4, flush_threshold=10)
+    for i in range(6):
+        logger.info(str(i))
+    logger.flush()
+
+    assert [message["short_message"] for message in listener.receive()] == ["2", "3", "4", "5"]
+    assert logger.dropped == 2
+
+def test_chunking(listener):
+
+    logger = GelfLogger(listener.address, chunk_size=200)
+    traceback = "\n".join("  File \"boot.py\", line {}, in <module>".format(i) for i in range(50))
+    logger.error("long traceback", full_message=traceback)
+    logger.flush()
+
+    messages = listener.receive()
+    assert len(messages) == 1
+    assert messages[0]["full_message"] == traceback
+    assert logger.bytes_sent > len(traceback)
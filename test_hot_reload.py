@@ -0,0 +1,111 @@
+import sys
+
+import hostsim
+clock = hostsim.install()
+
+import hot_reload
+
+def test_reloadable():
+
+    assert hot_reload.reloadable("config.py")
+    assert hot_reload.reloadable("sds011_sensor.py")
+    # these are kept across reloads
+    for filename in ("boot.py", "ota.py", "watchdog.py", "wifi_manager.py", "hot_reload.py", "glitter"):
+        assert not hot_reload.reloadable(filename)
+
+def test_unload(monkeypatch):
+
+    import derived
+    import i2c_bus
+    import sparkle
+
+    # the other tests keep the modules they imported
+    for name in hot_reload.RELOADABLE_MODULES:
+        if name in sys.modules:
+            monkeypatch.setitem(sys.modules, name, sys.modules[name])
+
+    hot_reload.unload()
+    assert "derived" not in sys.modules
+    assert "i2c_bus" not in sys.modules
+    assert "sparkle" in sys.modules
+
+    # imported again, as a new module
+    import derived as reloaded
+    assert reloaded is not derived
+
+# like deploy.py's make_config_py()
+old_config_py = """# this file is generated automatically from its corresponding entry in devices.yaml
+import machine
+
+hostname = "balcony"
+
+push_interval_s = 60
+
+sensor_configs = {
+    "outside": {"type": "dht", "port": machine.Pin(4)},
+}
+"""
+
+def test_needs_reboot():
+
+    assert not hot_reload.needs_reboot(["sds011_sensor.py", "derived.py"])
+    assert hot_reload.needs_reboot(["sds011_sensor.py", "boot.py"])
+
+    new_sensor = old_config_py.replace('    "outside"', '    "inside": {"type": "dht", "port": machine.Pin(5)},\n    "outside"')
+    assert not hot_reload.needs_reboot(["config.py"], old_config_py, new_sensor)
+    assert not hot_reload.needs_reboot(["config.py"], old_config_py, old_config_py.replace("= 60", "= 10"))
+    # boot.py only reads these once
+    assert hot_reload.needs_reboot(["config.py"], old_config_py, old_config_py.replace("balcony", "garden"))
+    assert hot_reload.needs_reboot(["config.py"], old_config_py, old_config_py.replace("\nsensor_configs", 'run_mode = "duty_cycle"\n\nsensor_configs'))
+    # the device's config.py couldn't be retrieved
+    assert hot_reload.needs_reboot(["config.py"], None, old_config_py)
+
+class MockLog:
+
+    def __init__(self):
+        self.calls = []
+
+    def flush(self):
+        self.calls.append("flush")
+
+    def push(self):
+        self.calls.append("push")
+
+def test_teardown():
+
+    from circuit_breaker import CircuitBreaker
+    from irq_counter import IRQCounter
+
+    pin = hostsim.FakePin(4)
+    sensors = {"door": CircuitBreaker(IRQCounter(pin, hostsim.FakePin.IRQ_RISING, cooldown=0))}
+    tslog = MockLog()
+    exporter = MockLog()
+
+    hot_reload.teardown(sensors, tslog, exporter)
+    assert tslog.calls == ["flush"]
+    assert exporter.calls == ["push"]
+    # the pin is free for the next setup
+    assert pin.handler is None
+
+    hot_reload.teardown(sensors)
+
+def test_reload_reads_config_again(tmp_path, monkeypatch):
+
+    monkeypatch.syspath_prepend(str(tmp_path))
+    for name in hot_reload.RELOADABLE_MODULES:
+        if name in sys.modules:
+            monkeypatch.setitem(sys.modules, name, sys.modules[name])
+    # so that the config.py of this test is forgotten afterwards
+    monkeypatch.setitem(sys.modules, "config", None)
+    monkeypatch.delitem(sys.modules, "config")
+
+    (tmp_path / "config.py").write_text('sensor_configs = {"outside": {"type": "dht"}}\n')
+    import config
+    assert list(config.sensor_configs) == ["outside"]
+
+    # what boot.py does between two rounds of its loop
+    (tmp_path / "config.py").write_text('sensor_configs = {"outside": {"type": "dht"}, "inside": {"type": "dht"}}\n')
+    hot_reload.teardown({})
+    hot_reload.unload()
+    import config
+    assert list(config.sensor_configs) == ["outside", "inside"]
@@ -0,0 +1,133 @@
+import pytest
+
+import hostsim
+clock = hostsim.install()
+
+from i2c_bus import I2CBus, render_text
+from bme280_sensor import BME280Sensor
+
+class MockDevice:
+
+    provides = ["temperature"]
+
+    def __init__(self, conversion_time_us, value, broken=False):
+        self.conversion_time_us = conversion_time_us
+        self.value = value
+        self.broken = broken
+        self.started_at = None
+        self.starts = 0
+
+    def start(self):
+        if self.broken:
+            raise OSError(19)
+        self.starts += 1
+        self.started_at = clock.now_us
+        # every bus transaction takes a bit
+        clock.advance_us(100)
+        return self.conversion_time_us
+
+    def collect(self):
+        assert clock.now_us - self.started_at >= self.conversion_time_us, "conversion isn't done yet"
+        clock.advance_us(200)
+        return {"temperature": self.value}
+
+@pytest.fixture
+def bus():
+    clock.now_us = 0
+    return I2CBus("0")
+
+def test_one_conversion_time_for_all(bus):
+
+    devices = [MockDevice(10000, 20), MockDevice(40000, 21), MockDevice(10000, 22)]
+    sensors = [bus.add(label, device) for label, device in zip(("a", "b", "c"), devices)]
+
+    assert [sensor.readout() for sensor in sensors] == [{"temperature": 20}, {"temperature": 21}, {"temperature": 22}]
+    # the slowest conversion, plus the bus transactions
+    assert clock.now_us < 40000 + 3 * 100 + 3 * 200 + 1
+    assert bus.rounds == 1
+    assert [device.starts for device in devices] == [1, 1, 1]
+
+    # the next readout starts a new round
+    clock.advance_ms(10)
+    [sensor.readout() for sensor in sensors]
+    assert bus.rounds == 2
+
+def test_stale_results(bus):
+
+    a = bus.add("a", MockDevice(10000, 20))
+    b = bus.add("b", MockDevice(10000, 21))
+
+    a.readout()
+    clock.advance_ms(2000)
+    b.readout()
+    assert bus.rounds == 2
+
+def test_broken_device(bus):
+
+    a = bus.add("a", MockDevice(10000, 20))
+    b = bus.add("b", MockDevice(10000, 21, broken=True))
+    c = bus.add("c", MockDevice(10000, 22))
+
+    for _ in range(3):
+        assert a.readout() == {"temperature": 20}
+        with pytest.raises(OSError):
+            b.readout()
+        assert c.readout() == {"temperature": 22}
+
+    assert list(bus.errors) == [0, 3, 0]
+    assert 'i2c_bus_errors{bus="0",label="b"} 3' in render_text([bus])
+
+def test_render_text_of_several_buses(bus):
+
+    other_bus = I2CBus("1")
+    bus.add("a", MockDevice(1000, 21))
+    other_bus.add("b", MockDevice(1000, 22))
+    other_bus.add("c", MockDevice(1000, 23))
+
+    text = render_text([bus, other_bus])
+    type_lines = [line for line in text.splitlines() if line.startswith("# TYPE")]
+    assert len(type_lines) == len(set(type_lines)) == 3
+    assert 'i2c_bus_rounds{bus="1"} 0' in text
+    assert 'i2c_bus_errors{bus="1",label="c"} 0' in text
+    # all samples of a metric come right after its TYPE line
+    names = [line.split("{")[0] for line in text.splitlines() if not line.startswith("#")]
+    assert names == sorted(names, key=["i2c_bus_rounds", "i2c_bus_last_round_us", "i2c_bus_errors"].index)
+
+class FakeI2C:
+    """ a bus with bme280s at some addresses """
+
+    def __init__(self, addresses):
+        self.registers = {address: {} for address in addresses}
+        self.writes = []
+
+    def _device(self, address):
+        if address not in self.registers:
+            # like machine.I2C does for devices that don't answer
+            raise OSError(19)
+        return self.registers[address]
+
+    def readfrom_mem(self, address, register, size):
+        self._device(address)
+        return bytes(size)
+
+    def readfrom_mem_into(self, address, register, buffer):
+        self._device(address)
+        for i in range(len(buffer)):
+            buffer[i] = 0
+
+    def writeto_mem(self, address, register, data):
+        self._device(address)
+        self.writes.append((address, register))
+
+def test_bme280_addresses(bus):
+
+    i2c = FakeI2C([0x76, 0x77])
+    kitchen = bus.add("kitchen", BME280Sensor(i2c))
+    outside = bus.add("outside", BME280Sensor(i2c, address=0x77))
+
+    kitchen.readout()
+    outside.readout()
+    assert {address for address, register in i2c.writes} == {0x76, 0x77}
+
+    with pytest.raises(OSError):
+        BME280Sensor(i2c, address=0x78)
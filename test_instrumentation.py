@@ -0,0 +1,186 @@
+import tracemalloc
+
+import pytest
+
+import hostsim
+clock = hostsim.install()
+
+import instrumentation
+from instrumentation import Instrumentation
+
+endpoints = ["metrics", "ota", "invalid"]
+sensor_configs = {
+    "kitchen": {"type": "bme", "description": "next to the fridge"},
+    "balcony": {"type": "sds", "description": "outside"},
+}
+
+class FakeGC:
+    """ a heap that grows when the test says so, and shrinks back to
+        what's still in use when collected """
+
+    def __init__(self):
+        self.allocated = 1000
+        self.in_use = 1000
+        self.collections = 0
+
+    def mem_alloc(self):
+        return self.allocated
+
+    def collect(self):
+        self.collections += 1
+        self.allocated = self.in_use
+        clock.advance_us(800)
+
+class MockSensor:
+
+    def __init__(self, readout_us, fail=False):
+        self.readout_us = readout_us
+        self.fail = fail
+
+    def readout(self):
+        clock.advance_us(self.readout_us)
+        if self.fail:
+            raise RuntimeError("sensor broke")
+        return {"temperature": 21.5}
+
+    def sample(self):
+        return self.readout()
+
+@pytest.fixture
+def fake_gc(monkeypatch):
+    clock.now_us = 0
+    fake_gc = FakeGC()
+    monkeypatch.setattr(instrumentation, "gc", fake_gc)
+    return fake_gc
+
+def request(stats, fake_gc, endpoint, duration_ms, allocates, sent=100, received=50):
+    stats.start_request()
+    stats.received(received)
+    if endpoint is not None:
+        stats.set_endpoint(endpoint)
+    fake_gc.allocated += allocates
+    stats.sent(sent)
+    clock.advance_ms(duration_ms)
+    return stats.end_request()
+
+def test_requests(fake_gc):
+
+    stats = Instrumentation(endpoints, sensor_configs.keys())
+
+    assert request(stats, fake_gc, "metrics", 3, 2000) == 3
+    request(stats, fake_gc, "metrics", 120, 4000)
+    request(stats, fake_gc, "ota", 7000, 500, sent=10, received=5000)
+    # the request line couldn't be parsed
+    request(stats, fake_gc, None, 1, 0)
+
+    assert list(stats.requests) == [2, 1, 1]
+    assert list(stats.bytes_sent) == [200, 10, 100]
+    assert list(stats.bytes_received) == [100, 5000, 50]
+    assert list(stats.heap_allocated) == [6000, 500, 0]
+    assert list(stats.heap_allocated_max) == [4000, 500, 0]
+    assert list(stats.latency_sum_ms) == [123, 7000, 1]
+    assert stats.heap_peak == 1000 + 6500
+
+    text = stats.render_text(sensor_configs)
+    assert 'http_request_duration_ms_bucket{endpoint="metrics", le="5"} 1' in text
+    assert 'http_request_duration_ms_bucket{endpoint="metrics", le="100"} 1' in text
+    assert 'http_request_duration_ms_bucket{endpoint="metrics", le="250"} 2' in text
+    assert 'http_request_duration_ms_bucket{endpoint="metrics", le="+Inf"} 2' in text
+    assert 'http_request_duration_ms_bucket{endpoint="ota", le="5000"} 0' in text
+    assert 'http_request_duration_ms_bucket{endpoint="ota", le="+Inf"} 1' in text
+    assert 'http_request_duration_ms_count{endpoint="ota"} 1' in text
+    assert 'http_requests_total{endpoint="invalid"} 1' in text
+    assert "memory_peak_used 7500" in text
+
+def test_gc_during_request(fake_gc):
+
+    stats = Instrumentation(endpoints, sensor_configs.keys())
+
+    # an explicit collection in the middle of a request doesn't hide what
+    # the request allocated
+    stats.start_request()
+    stats.set_endpoint("ota")
+    fake_gc.allocated += 3000
+    stats.collect_garbage()
+    fake_gc.allocated += 1000
+    stats.end_request()
+
+    assert stats.heap_allocated[1] == 4000
+    assert stats.gc_collections == 1
+    assert stats.gc_time_us == 800
+    assert stats.heap_peak == 4000
+
+    # the gc ran on its own, so the heap shrank
+    stats.start_request()
+    fake_gc.allocated = 500
+    stats.end_request()
+    assert stats.gc_during_request == 1
+    assert stats.heap_allocated[2] == 0
+
+def test_sensor_readouts(fake_gc):
+
+    stats = Instrumentation(endpoints, sensor_configs.keys())
+
+    assert stats.readout("kitchen", MockSensor(1500)) == {"temperature": 21.5}
+    stats.readout("kitchen", MockSensor(500))
+    with pytest.raises(RuntimeError):
+        stats.readout("balcony", MockSensor(2000, fail=True))
+
+    assert list(stats.readouts) == [2, 1]
+    assert list(stats.readout_errors) == [0, 1]
+    assert list(stats.readout_last_us) == [500, 2000]
+    assert list(stats.readout_max_us) == [1500, 2000]
+    assert list(stats.readout_sum_us) == [2000, 2000]
+
+    text = stats.render_text(sensor_configs)
+    assert 'sensor_readout_errors_total{label="balcony", description="outside", type="sds"} 1' in text
+    assert 'sensor_readout_duration_max_us{label="kitchen", description="next to the fridge", type="bme"} 1500' in text
+
+def test_sensor_samples(fake_gc):
+
+    stats = Instrumentation(endpoints, sensor_configs.keys())
+
+    assert stats.sample("kitchen", MockSensor(1500)) == {"temperature": 21.5}
+    with pytest.raises(RuntimeError):
+        stats.sample("balcony", MockSensor(2000, fail=True))
+
+    # counted apart from the readouts
+    assert list(stats.samples) == [1, 1]
+    assert list(stats.sample_errors) == [0, 1]
+    assert list(stats.readouts) == [0, 0]
+
+    text = stats.render_text(sensor_configs)
+    assert 'sensor_sample_errors_total{label="balcony", description="outside", type="sds"} 1' in text
+
+def test_no_allocations_per_request(fake_gc):
+
+    stats = Instrumentation(endpoints, sensor_configs.keys())
+    sensor = MockSensor(100)
+
+    def run(num_requests):
+        for i in range(num_requests):
+            stats.start_request()
+            stats.received(400)
+            stats.set_endpoint(endpoints[i % 2])
+            stats.sent(1200)
+            stats.readout("kitchen", sensor)
+            clock.advance_ms(i % 300)
+            stats.end_request()
+            stats.collect_garbage()
+
+    tracemalloc.start()
+    try:
+        # warm up, so that the counters that live in attributes are past
+        # cpython's small int cache and have been replaced while tracing
+        run(300)
+        before = tracemalloc.take_snapshot()
+        run(1000)
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+
+    # host python allocates temporary ints, but nothing may stick around
+    filters = [tracemalloc.Filter(True, instrumentation.__file__)]
+    growth = after.filter_traces(filters).compare_to(before.filter_traces(filters), "lineno")
+    assert sum(stat.size_diff for stat in growth) == 0
+    assert sum(stat.count_diff for stat in growth) == 0
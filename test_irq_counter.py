@@ -0,0 +1,74 @@
+import pytest
+
+import hostsim
+clock = hostsim.install()
+
+from irq_counter import IRQCounter
+
+@pytest.fixture
+def pin():
+    clock.now_us = 0
+    return hostsim.FakePin(4)
+
+def run(counter, pin, seconds, rate):
+    """ fire events at the given rate (per second), polling once a second """
+    for _ in range(seconds):
+        for _ in range(rate):
+            clock.advance_us(1000000 // rate)
+            pin.fire()
+        counter.poll()
+
+def test_count(pin):
+
+    counter = IRQCounter(pin, hostsim.FakePin.IRQ_RISING, cooldown=0)
+    for _ in range(5):
+        clock.advance_ms(10)
+        pin.fire()
+
+    data = counter.readout()
+    assert data["count"] == 5
+    assert data["interval_min_us"] == 10000
+    assert data["interval_mean_us"] == pytest.approx(10000)
+    assert data["time_since_last_trigger"] == 0
+
+def test_cooldown(pin):
+
+    counter = IRQCounter(pin, hostsim.FakePin.IRQ_RISING, cooldown=50)
+    for _ in range(10):
+        clock.advance_ms(20)
+        pin.fire()
+
+    # events at 20, 40, ... 200 ms, the ones within 50 ms of the last
+    # accepted one are dropped
+    assert counter.readout()["count"] == 3
+
+def test_rates(pin):
+
+    counter = IRQCounter(pin, hostsim.FakePin.IRQ_RISING, cooldown=0)
+    counter.poll()
+    run(counter, pin, 290, 10)
+    run(counter, pin, 10, 100)
+
+    data = counter.readout()
+    assert data["events_per_second_10s"] == pytest.approx(100, rel=0.01)
+    assert data["events_per_second_60s"] == pytest.approx((50 * 10 + 10 * 100) / 60, rel=0.01)
+    assert data["events_per_second_300s"] == pytest.approx((290 * 10 + 10 * 100) / 300, rel=0.01)
+    assert data["interval_min_us"] == 10000
+
+def test_ticks_wraparound(pin):
+
+    clock.now_us = hostsim.TICKS_MAX - 500000
+    counter = IRQCounter(pin, hostsim.FakePin.IRQ_RISING, cooldown=1)
+    counter.poll()
+    run(counter, pin, 3, 1000)
+
+    data = counter.readout()
+    assert data["count"] == 3000
+    assert data["interval_min_us"] == 1000
+    assert data["events_per_second_10s"] == pytest.approx(1000, rel=0.01)
+
+def test_deinit(pin):
+
+    counter = IRQCounter(pin, hostsim.FakePin.IRQ_RISING, cooldown=0)
+    counter.deinit()
+    assert pin.handler is None
@@ -0,0 +1,155 @@
+import pytest
+
+import mhz19_sensor
+from mhz19_sensor import MHZ19Sensor
+
+def make_reply(concentration, temperature=21, status=0):
+    reply = bytearray([0xff, 0x86, concentration >> 8, concentration & 0xff, temperature + 40, status, 0, 0, 0])
+    reply[8] = (-sum(reply[1:8])) & 0xff
+    return bytes(reply)
+
+class FakeTime(object):
+
+    def __init__(self):
+        self.now = 0
+
+    def ticks_ms(self):
+        return self.now
+
+    def ticks_add(self, a, b):
+        return a + b
+
+    def ticks_diff(self, a, b):
+        return a - b
+
+    def sleep_ms(self, ms):
+        self.now += ms
+
+class FakeUART(object):
+    """ answers every read command with the next reply from the list, after
+    a latency of delay_ms. the reply then trickles in at one byte per
+    millisecond, like it would over a 9600 baud line. a reply of None means
+    the sensor doesn't answer. """
+
+    def __init__(self, fake_time, replies, delay_ms=5, noise=b""):
+
+        self.fake_time = fake_time
+        self.replies = list(replies)
+        self.delay_ms = delay_ms
+        self.pending = [(0, byte) for byte in noise]
+        self.commands = []
+
+    def init(self, **kwargs):
+        pass
+
+    def write(self, data):
+
+        self.commands.append(bytes(data))
+        if data[2] == 0x86:
+            reply = self.replies.pop(0)
+            if reply is not None:
+                start = self.fake_time.now + self.delay_ms
+                self.pending += [(start + i, byte) for i, byte in enumerate(reply)]
+
+    def readinto(self, buf, nbytes=None):
+
+        if nbytes is None:
+            nbytes = len(buf)
+
+        num_bytes = 0
+        while num_bytes < nbytes and self.pending and self.pending[0][0] <= self.fake_time.now:
+            buf[num_bytes] = self.pending.pop(0)[1]
+            num_bytes += 1
+
+        return num_bytes or None
+
+@pytest.fixture
+def fake_time(monkeypatch):
+    fake_time = FakeTime()
+    monkeypatch.setattr(mhz19_sensor, "time", fake_time)
+    return fake_time
+
+def test_command_format(fake_time):
+
+    uart = FakeUART(fake_time, [make_reply(400)])
+    sensor = MHZ19Sensor(uart)
+    sensor.readout()
+    assert uart.commands[-1] == bytes.fromhex("ff0186000000000079")
+
+def test_readout(fake_time):
+
+    sensor = MHZ19Sensor(FakeUART(fake_time, [make_reply(1234, temperature=23, status=0x40)]))
+    data = sensor.readout()
+    assert data["co2_concentration"] == 1234
+    assert data["temperature"] == 23
+    assert data["status"] == 0x40
+    assert data["read_errors"] == 0
+
+def test_split_request(fake_time):
+
+    sensor = MHZ19Sensor(FakeUART(fake_time, [make_reply(800)], delay_ms=10))
+    sensor.request()
+    assert sensor.collect() is False
+
+    # (other work happens here)
+    fake_time.now += 14
+    assert sensor.collect() is False
+
+    fake_time.now += 5
+    assert sensor.collect() is True
+    assert sensor.co2_concentration == 800
+
+def test_sample_doesnt_wait(fake_time):
+
+    sensor = MHZ19Sensor(FakeUART(fake_time, [make_reply(800), make_reply(900), make_reply(1000), make_reply(1100), make_reply(1200)]))
+
+    # the first call only sends a request, the next one picks up the reply
+    assert sensor.sample() is None
+    fake_time.now += 10000
+    assert sensor.sample() == {"co2_concentration": 800, "temperature": 21}
+    assert fake_time.now == 10000
+
+    # a readout in between drops the reply that sample() was waiting for
+    fake_time.now += 1000
+    assert sensor.readout()["co2_concentration"] == 1000
+    fake_time.now += 10000
+    assert sensor.sample() is None
+    assert sensor.read_errors == 0
+    fake_time.now += 10000
+    assert sensor.sample()["co2_concentration"] == 1100
+
+def test_stale_input_is_discarded(fake_time):
+
+    sensor = MHZ19Sensor(FakeUART(fake_time, [make_reply(600)], noise=make_reply(5000)))
+    assert sensor.readout()["co2_concentration"] == 600
+
+def test_no_reply_times_out(fake_time):
+
+    sensor = MHZ19Sensor(FakeUART(fake_time, [None]), timeout_ms=200)
+    with pytest.raises(RuntimeError):
+        sensor.readout()
+    assert fake_time.now <= 210
+    assert sensor.read_errors == 1
+
+def test_dropped_bytes_time_out(fake_time):
+
+    sensor = MHZ19Sensor(FakeUART(fake_time, [make_reply(700)[:6]]), timeout_ms=200)
+    with pytest.raises(RuntimeError):
+        sensor.readout()
+
+def test_corrupted_reply(fake_time):
+
+    reply = bytearray(make_reply(700))
+    reply[3] ^= 0x10
+    sensor = MHZ19Sensor(FakeUART(fake_time, [bytes(reply), make_reply(900)]), timeout_ms=200)
+    with pytest.raises(RuntimeError):
+        sensor.readout()
+
+    # the next readout works fine again
+    assert sensor.readout()["co2_concentration"] == 900
+
+def test_resync_after_garbage(fake_time):
+
+    uart = FakeUART(fake_time, [b"\x86\xff\x01" + make_reply(1000)])
+    sensor = MHZ19Sensor(uart)
+    assert sensor.readout()["co2_concentration"] == 1000
@@ -0,0 +1,132 @@
+import hashlib
+
+import pytest
+
+import hostsim
+clock = hostsim.install()
+
+import uos
+import ubinascii
+from ota import OTAHandler, listing_root
+from sparkle import SparkleKey
+
+glitter = bytes(range(32))
+
+class MockConnection:
+
+    def __init__(self):
+        self.sent = b""
+
+    def send(self, data):
+        self.sent += data
+        return len(data)
+
+    def status(self):
+        return int(self.sent.split(b" ")[1])
+
+    def body(self):
+        return self.sent.split(b"\r\n\r\n", 1)[1]
+
+def git_blob_hash(data):
+    """ like deploy.py does it """
+    return hashlib.sha1(b"blob " + str(len(data)).encode("ascii") + b"\0" + data).hexdigest()
+
+def make_listing_root(files):
+    """ like deploy.py does it """
+    listing = "\n".join(sorted(f"{filename} {checksum}" for filename, checksum in files.items()))
+    return hashlib.sha1(listing.encode("ascii")).hexdigest()
+
+def listing(handler, url=b"/ota-listing"):
+    connection = MockConnection()
+    handler.listing(connection, url)
+    return connection
+
+@pytest.fixture
+def ota_dir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    # the device lists "/", which is where it runs from
+    ilistdir = uos.ilistdir
+    monkeypatch.setattr(uos, "ilistdir", lambda path: ilistdir(str(tmp_path)))
+    files = {"boot.py": b"print('boot')\n", "aggregator.py": b"", "config.py": b"x = 1\n" * 1000}
+    for filename, content in files.items():
+        (tmp_path / filename).write_bytes(content)
+    (tmp_path / "glitter").write_bytes(glitter)
+    return {filename: git_blob_hash(content) for filename, content in files.items()}
+
+def test_listing(ota_dir):
+
+    connection = listing(OTAHandler(glitter))
+    assert connection.status() == 200
+    assert connection.body() == b"\n".join(f"{filename} {ota_dir[filename]}".encode("ascii") for filename in sorted(ota_dir))
+    assert b"X-Listing-Root: " + listing_root(connection.body()) in connection.sent
+
+def test_listing_root(ota_dir):
+
+    handler = OTAHandler(glitter)
+    root = make_listing_root(ota_dir).encode("ascii")
+
+    connection = listing(handler, b"/ota-listing?root=" + root)
+    assert connection.status() == 304
+    assert connection.body() == b""
+
+    # something else than what deploy.py has
+    del ota_dir["aggregator.py"]
+    connection = listing(handler, b"/ota-listing?root=" + make_listing_root(ota_dir).encode("ascii"))
+    assert connection.status() == 200
+    assert b"aggregator.py" in connection.body()
+
+def test_uploads_in_progress_arent_listed(ota_dir, tmp_path):
+
+    (tmp_path / "index.html.part").write_bytes(b"half of it")
+    handler = OTAHandler(glitter)
+    assert b".part" not in listing(handler).body()
+    assert listing(handler, b"/ota-listing?root=" + make_listing_root(ota_dir).encode("ascii")).status() == 304
+
+def test_hashes_are_kept_until_ota_changes_something(ota_dir, tmp_path):
+
+    handler = OTAHandler(glitter)
+    root = make_listing_root(ota_dir).encode("ascii")
+    assert listing(handler, b"/ota-listing?root=" + root).status() == 304
+
+    hashed = []
+    handler.collect_garbage = lambda: hashed.append(1)
+    assert listing(handler, b"/ota-listing?root=" + root).status() == 304
+    assert hashed == []
+
+    # a chunk of an upload is enough to forget the hashes
+    request = b"PUT /ota/boot.py?offset=0 HTTP/1.1\r\nContent-Length: 0\r\n\r\n"
+    handler.handle(MockConnection(), request, b"PUT", b"/ota/boot.py?offset=0", b"ota/boot.py?offset=0")
+    (tmp_path / "boot.py").write_bytes(b"print('new boot')\n")
+    assert listing(handler, b"/ota-listing?root=" + root).status() == 200
+    assert hashed != []
+
+def test_authorize(ota_dir):
+
+    handler = OTAHandler(glitter)
+    key = SparkleKey(glitter)
+
+    def url(command, timestamp):
+        sparkle = ubinascii.hexlify(key.sign(b"@" + timestamp + b" " + command))
+        return b"/reload?sparkle=" + sparkle + b"&ts=" + timestamp
+
+    connection = MockConnection()
+    assert handler.authorize(connection, url(b"reload", b"1000"), b"reload")
+    assert connection.sent == b""
+
+    # replayed
+    connection = MockConnection()
+    assert not handler.authorize(connection, url(b"reload", b"1000"), b"reload")
+    assert connection.status() == 403
+
+    # signed for something else
+    connection = MockConnection()
+    assert not handler.authorize(connection, url(b"reboot", b"1001"), b"reload")
+    assert connection.body() == b"your sparkle wasn't the right one, try again!"
+
+    connection = MockConnection()
+    assert not handler.authorize(connection, b"/reload", b"reload")
+    assert connection.status() == 403
+
+    connection = MockConnection()
+    assert not handler.authorize(connection, url(b"reload", b"later"), b"reload")
+    assert connection.body() == b"invalid timestamp"
@@ -0,0 +1,218 @@
+import binascii
+import hmac
+import itertools
+import os
+import random
+from urllib.parse import urlencode
+
+import pytest
+
+import hostsim
+clock = hostsim.install()
+
+from ota import OTAHandler, remove_stale_uploads
+from ota_client import upload_resumable, UploadError
+
+glitter = bytes(range(32))
+now = 1760000000
+
+class MockConnection:
+
+    def __init__(self, data):
+        self.data = data
+        self.sent = b""
+
+    def recv(self, size):
+        data, self.data = self.data[:size], self.data[size:]
+        return data
+
+    def send(self, data):
+        if type(data) == str:
+            data = data.encode("ascii")
+        self.sent += data
+        return len(data)
+
+class LossyLink:
+    """ delivers requests to an OTAHandler, like boot.py would. with the
+        given probability, the connection breaks somewhere in the request
+        body, or the response gets lost. """
+
+    def __init__(self, handler, filename, loss=0., seed=0):
+        self.handler = handler
+        self.filename = filename
+        self.loss = loss
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.failures = 0
+
+    def request(self, method, params, body):
+        self.requests += 1
+        method = method.encode("ascii")
+        url = "/ota/{}?{}".format(self.filename, urlencode(params)).encode("ascii")
+        head = method + b" " + url + b" HTTP/1.1\r\nContent-Length: " + str(len(body)).encode("ascii") + b"\r\n\r\n"
+        data = head + body
+
+        lose_response = False
+        if self.random.random() < self.loss:
+            self.failures += 1
+            if body and self.random.random() < 0.5:
+                data = data[:self.random.randrange(len(head), len(data))]
+            else:
+                lose_response = True
+
+        connection = MockConnection(data[400:])
+        try:
+            self.handler.handle(connection, data[:400], method, url, url[1:])
+        except OSError:
+            raise ConnectionResetError("connection broke while sending")
+
+        if lose_response:
+            raise ConnectionResetError("connection broke while receiving")
+
+        head, _, text = connection.sent.partition(b"\r\n\r\n")
+        return int(head.split(b" ")[1]), text.decode("ascii")
+
+# like deploy.py's, never the same twice
+timestamps = itertools.count(now * 1000)
+
+def make_params(data):
+    """ returns a function that makes fresh sparkle parameters for data,
+        like deploy.py does """
+
+    def make():
+        timestamp = next(timestamps)
+        signed = b"@" + str(timestamp).encode("ascii") + b" " + data
+        sparkle = binascii.hexlify(hmac.digest(glitter, signed, "sha256")).decode("ascii")
+        return {"sparkle": sparkle, "noop": "no", "ts": str(timestamp)}
+
+    return make
+
+def start_params(filename):
+    return make_params(b"start " + filename.encode("ascii"))
+
+def commit_params(filename, content):
+    return make_params(filename.encode("ascii") + b" " + content)
+
+@pytest.fixture
+def ota_dir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    clock.now_us = now * 1000000
+    return tmp_path
+
+content = bytes(random.Random(1).randrange(256) for _ in range(100000))
+
+@pytest.mark.parametrize("seed", range(5))
+def test_lossy_link(ota_dir, seed):
+
+    link = LossyLink(OTAHandler(glitter), "index.html", loss=0.3, seed=seed)
+    bytes_sent = upload_resumable(link.request, content, start_params("index.html"), commit_params("index.html", content),
+                                  chunk_size=8192, max_failures=100, retry_delay_s=0)
+
+    assert (ota_dir / "index.html").read_bytes() == content
+    assert not (ota_dir / "index.html.part").exists()
+    assert link.failures > 0
+    # only the chunks that broke are sent again
+    assert bytes_sent < len(content) + (link.failures + 1) * 8192
+
+def test_resume_earlier_upload(ota_dir):
+
+    (ota_dir / "index.html.part").write_bytes(content[:70000])
+
+    link = LossyLink(OTAHandler(glitter), "index.html")
+    bytes_sent = upload_resumable(link.request, content, start_params("index.html"), commit_params("index.html", content),
+                                  chunk_size=8192, retry_delay_s=0)
+
+    assert bytes_sent == 30000
+    assert (ota_dir / "index.html").read_bytes() == content
+
+def test_stale_part_file(ota_dir):
+
+    (ota_dir / "index.html.part").write_bytes(bytes(50000))
+
+    link = LossyLink(OTAHandler(glitter), "index.html")
+    bytes_sent = upload_resumable(link.request, content, start_params("index.html"), commit_params("index.html", content),
+                                  chunk_size=8192, retry_delay_s=0)
+
+    assert bytes_sent == 50000 + len(content)
+    assert (ota_dir / "index.html").read_bytes() == content
+
+def test_wrong_offset(ota_dir):
+
+    link = LossyLink(OTAHandler(glitter), "index.html")
+    assert link.request("PUT", dict(offset="0", **start_params("index.html")()), b"abc") == (200, "3")
+    assert link.request("PUT", {"offset": "2"}, b"xyz") == (409, "3")
+    assert link.request("PUT", {"offset": "3"}, b"def") == (200, "6")
+    assert link.request("GET", {"part": ""}, b"") == (200, "6")
+    assert (ota_dir / "index.html.part").read_bytes() == b"abcdef"
+
+def test_gives_up(ota_dir):
+
+    link = LossyLink(OTAHandler(glitter), "index.html", loss=1.)
+    with pytest.raises(UploadError):
+        upload_resumable(link.request, content, start_params("index.html"), commit_params("index.html", content),
+                         chunk_size=8192, max_failures=5, retry_delay_s=0)
+    assert not (ota_dir / "index.html").exists()
+
+def test_wrong_glitter(ota_dir):
+
+    link = LossyLink(OTAHandler(bytes(32)), "index.html")
+    with pytest.raises(UploadError):
+        upload_resumable(link.request, content, start_params("index.html"), commit_params("index.html", content),
+                         chunk_size=8192, retry_delay_s=0)
+    assert not (ota_dir / "index.html").exists()
+
+def test_lost_commit_response(ota_dir):
+
+    link = LossyLink(OTAHandler(glitter), "index.html")
+    request = link.request
+    lost = []
+
+    def lose_first_commit_response(method, params, body):
+        result = request(method, params, body)
+        if method == "POST" and not lost:
+            lost.append(result)
+            raise ConnectionResetError("connection broke while receiving")
+        return result
+
+    upload_resumable(lose_first_commit_response, content, start_params("index.html"), commit_params("index.html", content),
+                     chunk_size=8192, retry_delay_s=0)
+
+    assert lost == [(200, "update successful")]
+    assert (ota_dir / "index.html").read_bytes() == content
+    # it didn't upload the file again
+    assert link.requests == 1 + 13 + 1 + 1
+
+def test_unsigned_start(ota_dir):
+
+    link = LossyLink(OTAHandler(glitter), "boot.py")
+    assert link.request("PUT", {"offset": "0"}, b"evil")[0] == 403
+    # other ways of writing 0
+    assert link.request("PUT", {"offset": "00"}, b"evil")[0] == 400
+    assert link.request("PUT", {"offset": "-0"}, b"evil")[0] == 400
+    assert link.request("PUT", {"offset": "+0"}, b"evil")[0] == 400
+    # signed for another file
+    assert link.request("PUT", dict(offset="0", **start_params("config.py")()), b"evil")[0] == 403
+    assert not (ota_dir / "boot.py.part").exists()
+
+def test_chunks_leave_room_on_the_flash(ota_dir, monkeypatch):
+
+    import uos
+    # 100 blocks of 4k free, FLASH_RESERVE is 64k of that
+    monkeypatch.setattr(uos, "statvfs", lambda path: (4096, 4096, 1000, 100, 100, 0, 0, 0, 0, 255))
+
+    link = LossyLink(OTAHandler(glitter), "index.html")
+    assert link.request("PUT", dict(offset="0", **start_params("index.html")()), bytes(300 * 1024)) == (200, str(300 * 1024))
+    monkeypatch.setattr(uos, "statvfs", lambda path: (4096, 4096, 1000, 25, 25, 0, 0, 0, 0, 255))
+    assert link.request("PUT", {"offset": str(300 * 1024)}, bytes(36 * 1024 + 1))[0] == 413
+    assert link.request("PUT", {"offset": str(300 * 1024)}, bytes(36 * 1024)) == (200, str(336 * 1024))
+
+def test_remove_stale_uploads(ota_dir, monkeypatch):
+
+    import uos
+    ilistdir = uos.ilistdir
+    monkeypatch.setattr(uos, "ilistdir", lambda path: ilistdir(str(ota_dir)))
+    for filename in ("boot.py", "boot.py.part", "index.html.part"):
+        (ota_dir / filename).write_bytes(b"1")
+
+    remove_stale_uploads()
+    assert os.listdir(ota_dir) == ["boot.py"]
@@ -0,0 +1,88 @@
+import hmac
+import random
+import socket
+import threading
+
+import pytest
+
+import hostsim
+clock = hostsim.install()
+
+from ota import OTAHandler
+from sparkle import SparkleKey
+import ota_push
+
+glitter = bytes(range(32))
+now = 1760000000
+
+@pytest.fixture
+def ota_dir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(ota_push, "chunk_size", 1000)
+    clock.now_us = now * 1000000
+    return tmp_path
+
+def serve_once(handler):
+    """ a device that handles a single request, like boot.py does """
+
+    listener = socket.create_server(("127.0.0.1", 0))
+
+    def serve():
+        connection, peer = listener.accept()
+        with connection:
+            request = connection.recv(400)
+            method, url, protocol = request.split(b"\r\n", 1)[0].split(b" ")
+            handler.handle(connection, request, method, url, url[1:])
+        listener.close()
+
+    thread = threading.Thread(target=serve)
+    thread.start()
+    return listener.getsockname(), thread
+
+def push(filename, noop=False, key=glitter, timestamp=now * 1000):
+
+    params = ota_push.make_sparkle_params(SparkleKey(key), filename, timestamp, noop=noop)
+
+    address, thread = serve_once(OTAHandler(glitter))
+    with socket.create_connection(address) as sock:
+        result = ota_push.push_file(sock, filename, params)
+    thread.join()
+    return result
+
+content = bytes(random.Random(2).randrange(256) for _ in range(50000))
+
+def test_sparkle_is_the_same_as_deploys(ota_dir):
+
+    (ota_dir / "index.html").write_bytes(content)
+    params = dict(ota_push.make_sparkle_params(SparkleKey(glitter), "index.html", 1234, noop=True))
+
+    expected = hmac.digest(glitter, b"@1234 --noop index.html " + content, "sha256")
+    assert params == {"sparkle": expected.hex(), "noop": "yes", "ts": "1234"}
+
+def test_push(ota_dir):
+
+    (ota_dir / "upload").mkdir()
+    (ota_dir / "upload" / "index.html").write_bytes(content)
+
+    bytes_sent, duration, status, reason, body = push("upload/index.html")
+    assert (status, body) == (200, b"update successful")
+    assert bytes_sent == len(content)
+    assert (ota_dir / "index.html").read_bytes() == content
+
+def test_noop(ota_dir):
+
+    (ota_dir / "index.html").write_bytes(content)
+    (ota_dir / "index.html").rename(ota_dir / "new.html")
+
+    bytes_sent, duration, status, reason, body = push("new.html", noop=True)
+    assert status == 200
+    assert not (ota_dir / "new.html.part").exists()
+    assert (ota_dir / "new.html").read_bytes() == content
+
+def test_wrong_glitter(ota_dir):
+
+    (ota_dir / "index.html").write_bytes(content)
+
+    bytes_sent, duration, status, reason, body = push("index.html", key=bytes(32))
+    assert status == 400
+    assert b"sparkle" in body
@@ -0,0 +1,211 @@
+import socket
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+
+import hostsim
+clock = hostsim.install()
+
+from push_exporter import PushExporter, UDPTransport, HTTPTransport, format_line, make_transport
+
+class Collector(HTTPServer):
+    """ a local stand-in for influxdb's /write endpoint. fails every
+    request for which fail() returns True. """
+
+    def __init__(self, fail=lambda: False):
+
+        self.lines = []
+        self.requests = 0
+        self.fail = fail
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_POST(handler):
+                body = handler.rfile.read(int(handler.headers["Content-Length"]))
+                self.requests += 1
+                if self.fail():
+                    handler.send_response(503)
+                else:
+                    self.lines += body.decode("utf-8").splitlines()
+                    handler.send_response(204)
+                handler.end_headers()
+
+            def log_message(handler, *args):
+                pass
+
+        super().__init__(("127.0.0.1", 0), Handler)
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+
+@pytest.fixture
+def collector():
+    collector = Collector()
+    yield collector
+    collector.shutdown()
+
+def test_format_line():
+
+    line = format_line("humiditemp", (("host", "kitchen"), ("sensor", "a sensor,really")), {"temperature": 21.5, "count": 3}, 1600000000)
+    assert line == "humiditemp,host=kitchen,sensor=a\\ sensor\\,really temperature=21.5,count=3i 1600000000"
+
+def test_format_line_without_nan():
+
+    nan = float("nan")
+    line = format_line("humiditemp", (("host", "kitchen"),), {"wifi_rssi": nan, "memory_free": 1000, "x": float("inf")}, 1600000000)
+    assert line == "humiditemp,host=kitchen memory_free=1000i 1600000000"
+    assert format_line("humiditemp", (("host", "kitchen"),), {"wifi_rssi": nan}) is None
+
+    exporter = PushExporter(UDPTransport("127.0.0.1", 8089), "kitchen")
+    exporter.add("wifi", "device", {"wifi_rssi": nan})
+    assert exporter.push() is True
+    assert exporter.lines_sent == 0
+
+def test_make_transport():
+
+    transport = make_transport("http://127.0.0.1:8086/write?db=sensors&precision=s")
+    assert isinstance(transport, HTTPTransport)
+    assert transport.path == "/write?db=sensors&precision=s"
+    assert isinstance(make_transport("udp://127.0.0.1:8089"), UDPTransport)
+
+def test_make_transport_precision():
+
+    # the timestamps are in seconds, and influxdb defaults to nanoseconds
+    assert make_transport("http://127.0.0.1:8086").path == "/write?precision=s"
+    assert make_transport("http://127.0.0.1:8086/write").path == "/write?precision=s"
+    assert make_transport("http://127.0.0.1:8086/write?db=sensors").path == "/write?db=sensors&precision=s"
+    assert make_transport("http://127.0.0.1:8086/write?precision=ms").path == "/write?precision=ms"
+
+def test_http_partial_sends(monkeypatch):
+
+    class TrickleSocket:
+        """ send() takes at most 100 bytes at a time, like a busy tcp
+            stack """
+
+        sent = b""
+
+        def __init__(self, *args):
+            pass
+
+        def settimeout(self, timeout):
+            pass
+
+        def connect(self, address):
+            pass
+
+        def send(self, data):
+            TrickleSocket.sent += bytes(data[:100])
+            return min(len(data), 100)
+
+        def sendall(self, data):
+            while data:
+                data = data[self.send(data):]
+
+        def recv(self, size):
+            return b"HTTP/1.0 204 No Content\r\n\r\n"
+
+        def close(self):
+            pass
+
+    transport = HTTPTransport("127.0.0.1", 8086, "/write?precision=s")
+    monkeypatch.setattr(socket, "socket", TrickleSocket)
+    payload = b"x" * 1000
+    transport.send(payload)
+    assert TrickleSocket.sent.endswith(b"\r\n\r\n" + payload)
+
+def test_http_push(collector):
+
+    transport = HTTPTransport("127.0.0.1", collector.server_address[1], "/write?precision=s")
+    exporter = PushExporter(transport, "kitchen", interval_s=60)
+    exporter.add("bme", "bme", {"temperature": 21.0})
+    exporter.add("bme", "bme", {"temperature": 22.0})
+
+    exporter.poll()
+    assert collector.lines == []
+
+    clock.advance_ms(60000)
+    exporter.poll()
+    assert len(collector.lines) == 2
+    assert collector.lines[1].startswith("humiditemp,host=kitchen,sensor=bme,type=bme temperature=22.0 ")
+    assert exporter.lines_sent == 2
+
+def test_retry_when_unreachable(collector):
+
+    failing = [True, True, True]
+    collector.fail = lambda: failing.pop(0) if failing else False
+
+    transport = HTTPTransport("127.0.0.1", collector.server_address[1], "/write")
+    exporter = PushExporter(transport, "kitchen", max_lines=5)
+    for i in range(3):
+        exporter.add("co2", "mhz", {"co2_concentration": 400 + i})
+        assert exporter.push() is False
+
+    for i in range(3, 7):
+        exporter.add("co2", "mhz", {"co2_concentration": 400 + i})
+    assert exporter.push() is True
+
+    # only the newest five lines survived
+    assert [line.split(" ")[1] for line in collector.lines] == ["co2_concentration={}i".format(400 + i) for i in range(2, 7)]
+    assert exporter.lines_dropped == 2
+    assert exporter.push_errors == 3
+
+def test_unreachable_collector():
+
+    # nobody listens here
+    s = socket.socket()
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+
+    exporter = PushExporter(HTTPTransport("127.0.0.1", port, "/write"), "kitchen")
+    exporter.add("co2", "mhz", {"co2_concentration": 400})
+    assert exporter.push() is False
+    assert exporter.push_errors == 1
+
+def test_resolve_when_pushing(collector, monkeypatch):
+
+    getaddrinfo = socket.getaddrinfo
+    def no_dns(host, port, *args):
+        raise OSError("no wifi")
+    monkeypatch.setattr(socket, "getaddrinfo", no_dns)
+
+    # setting up works without wifi
+    http = make_transport("http://localhost:{}/write".format(collector.server_address[1]))
+    udp = make_transport("udp://localhost:8089")
+    for transport in (http, udp):
+        exporter = PushExporter(transport, "kitchen")
+        exporter.add("co2", "mhz", {"co2_concentration": 400})
+        assert exporter.push() is False
+        assert exporter.push_errors == 1
+
+    monkeypatch.setattr(socket, "getaddrinfo", getaddrinfo)
+    exporter = PushExporter(http, "kitchen")
+    exporter.add("co2", "mhz", {"co2_concentration": 400})
+    assert exporter.push() is True
+    assert len(collector.lines) == 1
+
+def test_udp_batches():
+
+    listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    listener.bind(("127.0.0.1", 0))
+    listener.settimeout(0.1)
+
+    exporter = PushExporter(UDPTransport(*listener.getsockname()), "kitchen")
+    for i in range(100):
+        exporter.add("particles", "sds", {"pm2_5_ug_m3": i / 10., "pm10_ug_m3": i / 5.})
+    assert exporter.push() is True
+
+    lines = []
+    datagrams = 0
+    while True:
+        try:
+            data = listener.recv(65536)
+        except socket.timeout:
+            break
+        assert len(data) <= UDPTransport.max_payload
+        lines += data.decode("utf-8").splitlines()
+        datagrams += 1
+
+    listener.close()
+    assert len(lines) == 100
+    assert 1 < datagrams < 20
@@ -0,0 +1,124 @@
+import asyncio
+
+from scrape_proxy import ScrapeProxy, add_instance_label
+
+kitchen_metrics = """# TYPE temperature gauge
+# TYPE humidity gauge
+
+temperature{label="bme", description="kitchen", type="bme"} 21.500
+humidity{label="bme", description="kitchen", type="bme"} 40.125
+
+# TYPE wifi_rssi gauge
+wifi_rssi -60
+"""
+
+bedroom_metrics = """# TYPE temperature gauge
+
+temperature{label="dht", description="bedroom", type="dht"} 19.000
+"""
+
+class FakeDevice(object):
+    """ answers every request with the given metrics, after a delay """
+
+    def __init__(self, body, delay=0):
+
+        self.body = body.encode("utf-8")
+        self.delay = delay
+        self.requests = 0
+
+    async def handle(self, reader, writer):
+
+        self.requests += 1
+        await reader.readuntil(b"\r\n\r\n")
+        await asyncio.sleep(self.delay)
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n" % len(self.body) + self.body)
+        await writer.drain()
+        writer.close()
+
+    async def start(self):
+
+        self.server = await asyncio.start_server(self.handle, "127.0.0.1", 0)
+        return self.server.sockets[0].getsockname()
+
+async def get(port, path):
+
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(f"GET {path} HTTP/1.1\r\nHost: proxy\r\n\r\n".encode("ascii"))
+    response = await reader.read()
+    writer.close()
+    head, _, body = response.partition(b"\r\n\r\n")
+    return int(head.split(b" ")[1]), body.decode("utf-8")
+
+def test_add_instance_label():
+
+    assert add_instance_label('temperature{label="bme"} 21.5', "kitchen") == ("temperature", 'temperature{instance="kitchen", label="bme"} 21.5')
+    assert add_instance_label("wifi_rssi -60", "kitchen") == ("wifi_rssi", 'wifi_rssi{instance="kitchen"} -60')
+
+def test_proxy():
+
+    async def run():
+        kitchen = FakeDevice(kitchen_metrics)
+        bedroom = FakeDevice(bedroom_metrics)
+        broken = FakeDevice("", delay=10)
+
+        proxy = ScrapeProxy({
+            "kitchen": await kitchen.start(),
+            "bedroom": await bedroom.start(),
+            "broken": await broken.start(),
+        }, timeout=0.2)
+        await proxy.scrape_all()
+
+        server = await asyncio.start_server(proxy.handle_client, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+
+        # any number of clients, but only one request per device
+        responses = await asyncio.gather(*(get(port, "/metrics") for _ in range(20)))
+        assert kitchen.requests == 1
+        assert bedroom.requests == 1
+
+        status, merged = responses[0]
+        assert status == 200
+        lines = merged.splitlines()
+        assert lines.count("# TYPE temperature gauge") == 1
+        temperature_index = lines.index("# TYPE temperature gauge")
+        assert lines[temperature_index + 1:temperature_index + 3] == [
+            'temperature{instance="kitchen", label="bme", description="kitchen", type="bme"} 21.500',
+            'temperature{instance="bedroom", label="dht", description="bedroom", type="dht"} 19.000',
+        ]
+        assert 'wifi_rssi{instance="kitchen"} -60' in lines
+        assert 'humiditemp_up{instance="kitchen"} 1' in lines
+        assert 'humiditemp_up{instance="broken"} 0' in lines
+        assert 'humiditemp_scrape_failures_total{instance="broken"} 1' in lines
+
+        status, body = await get(port, "/devices/bedroom/metrics")
+        assert status == 200
+        assert body == bedroom_metrics
+
+        status, body = await get(port, "/devices/broken/metrics")
+        assert status == 404
+
+        server.close()
+        for device in (kitchen, bedroom, broken):
+            device.server.close()
+
+    asyncio.run(run())
+
+def test_down_device_isnt_served():
+
+    async def run():
+        kitchen = FakeDevice(kitchen_metrics)
+        proxy = ScrapeProxy({"kitchen": await kitchen.start()}, timeout=0.2)
+        await proxy.scrape_all()
+        assert 'wifi_rssi{instance="kitchen"} -60' in proxy.merged
+
+        # the device hangs from now on
+        kitchen.delay = 10
+        await proxy.scrape_all()
+        lines = proxy.merged.splitlines()
+        assert 'humiditemp_up{instance="kitchen"} 0' in lines
+        assert not any(line.startswith(("temperature", "wifi_rssi")) for line in lines)
+        assert proxy.get_response("/devices/kitchen/metrics")[0] == 404
+
+        kitchen.server.close()
+
+    asyncio.run(run())
@@ -0,0 +1,225 @@
+import pytest
+
+from sds011_sensor import SDS011Sensor
+
+def make_frame(pm25, pm10, sensor_id=b"\x12\x34"):
+    data = bytes([pm25 & 0xff, pm25 >> 8, pm10 & 0xff, pm10 >> 8]) + sensor_id
+    return b"\xaa\xc0" + data + bytes([sum(data) & 0xff, 0xab])
+
+class MockUART(object):
+
+    def __init__(self, chunks=()):
+
+        self.chunks = list(chunks)
+
+    def init(self, **kwargs):
+        pass
+
+    def readinto(self, buf):
+
+        if not self.chunks:
+            return None
+
+        chunk = self.chunks.pop(0)
+        assert len(chunk) <= len(buf)
+        buf[:len(chunk)] = chunk
+        return len(chunk)
+
+def test_single_frame():
+
+    sensor = SDS011Sensor(MockUART([make_frame(123, 456)]))
+    data = sensor.readout()
+    assert data["pm2_5_ug_m3"] == pytest.approx(12.3)
+    assert data["pm10_ug_m3"] == pytest.approx(45.6)
+    assert data["frames"] == 1
+    assert data["frame_errors"] == 0
+
+def test_no_frame():
+
+    sensor = SDS011Sensor(MockUART([b"\xaa\xc0\x01"]))
+    with pytest.raises(RuntimeError):
+        sensor.readout()
+
+def test_readouts_within_a_second():
+
+    uart = MockUART([make_frame(123, 456)])
+    sensor = SDS011Sensor(uart)
+    sensor.readout()
+
+    # no new frame yet, so the last values are served again
+    data = sensor.readout()
+    assert data["pm2_5_ug_m3"] == pytest.approx(12.3)
+    assert data["frames"] == 0
+    assert data["sleeping"] == 0
+
+def test_frame_split_across_reads():
+
+    frame = make_frame(100, 200)
+    sensor = SDS011Sensor(MockUART([frame[:3], frame[3:7], frame[7:]]))
+    data = sensor.readout()
+    assert data["pm2_5_ug_m3"] == pytest.approx(10.0)
+    assert data["frames"] == 1
+
+def test_averaging():
+
+    uart = MockUART([make_frame(100, 200), make_frame(300, 600) + make_frame(200, 100)])
+    sensor = SDS011Sensor(uart)
+    data = sensor.readout()
+    assert data["frames"] == 3
+    assert data["pm2_5_ug_m3"] == pytest.approx(20.0)
+    assert data["pm2_5_ug_m3_min"] == pytest.approx(10.0)
+    assert data["pm2_5_ug_m3_max"] == pytest.approx(30.0)
+    assert data["pm10_ug_m3"] == pytest.approx(30.0)
+    assert data["pm10_ug_m3_min"] == pytest.approx(10.0)
+    assert data["pm10_ug_m3_max"] == pytest.approx(60.0)
+
+    # statistics are reset after every readout
+    uart.chunks.append(make_frame(50, 50))
+    data = sensor.readout()
+    assert data["frames"] == 1
+    assert data["pm2_5_ug_m3_max"] == pytest.approx(5.0)
+
+def test_sample_leaves_the_averages_alone():
+
+    uart = MockUART([make_frame(100, 200)])
+    sensor = SDS011Sensor(uart)
+    assert sensor.sample() == {"pm2_5_ug_m3": pytest.approx(10.0), "pm10_ug_m3": pytest.approx(20.0)}
+    # nothing new since
+    assert sensor.sample() is None
+
+    uart.chunks.append(make_frame(300, 400))
+    assert sensor.sample()["pm2_5_ug_m3"] == pytest.approx(30.0)
+
+    data = sensor.readout()
+    assert data["frames"] == 2
+    assert data["pm2_5_ug_m3"] == pytest.approx(20.0)
+
+def test_resync_after_noise():
+
+    sensor = SDS011Sensor(MockUART([b"\x00\xab\xaa\xaa", make_frame(10, 20), b"\xc0\x17"]))
+    data = sensor.readout()
+    assert data["frames"] == 1
+    assert data["pm10_ug_m3"] == pytest.approx(2.0)
+
+def test_resync_inside_broken_frame():
+
+    # a truncated frame directly followed by a valid one
+    broken = make_frame(1, 2)[:6]
+    sensor = SDS011Sensor(MockUART([broken + make_frame(30, 40)]))
+    data = sensor.readout()
+    assert data["frames"] == 1
+    assert data["frame_errors"] == 1
+    assert data["pm2_5_ug_m3"] == pytest.approx(3.0)
+
+def test_bad_checksum():
+
+    frame = bytearray(make_frame(30, 40))
+    frame[8] ^= 0xff
+    sensor = SDS011Sensor(MockUART([bytes(frame), make_frame(70, 80)]))
+    data = sensor.readout()
+    assert data["frames"] == 1
+    assert data["frame_errors"] == 1
+    assert data["pm2_5_ug_m3"] == pytest.approx(7.0)
+
+def make_command(command_id, value):
+    data = bytes([command_id, 1, value]) + bytes(10) + b"\xff\xff"
+    return b"\xaa\xb4" + data + bytes([sum(data) & 0xff, 0xab])
+
+def make_reply(command_id, value):
+    data = bytes([command_id, 1, value, 0]) + b"\x12\x34"
+    return b"\xaa\xc5" + data + bytes([sum(data) & 0xff, 0xab])
+
+class FakeTime(object):
+
+    def __init__(self):
+        self.now = 0
+
+    def ticks_ms(self):
+        return self.now
+
+    def ticks_diff(self, a, b):
+        return a - b
+
+class ScriptedUART(MockUART):
+    """ replays a script of (expected command, reply) pairs. the reply is
+    made available for reading as soon as the command has been written. """
+
+    def __init__(self, script):
+
+        super().__init__()
+        self.script = list(script)
+        self.written = []
+
+    def write(self, data):
+
+        data = bytes(data)
+        self.written.append(data)
+        expected, reply = self.script.pop(0)
+        assert data == expected
+        if reply:
+            self.chunks.append(reply)
+
+@pytest.fixture
+def fake_time(monkeypatch):
+    import sds011_sensor
+    fake_time = FakeTime()
+    monkeypatch.setattr(sds011_sensor, "time", fake_time)
+    return fake_time
+
+def run(sensor, fake_time, seconds, step_ms=100):
+    for _ in range(int(seconds * 1000 / step_ms)):
+        fake_time.now += step_ms
+        sensor.poll()
+
+def test_command_format():
+
+    # from the example in the protocol documentation (set sleep mode)
+    assert make_command(6, 0) == bytes.fromhex("aab406010000000000000000000000ffff05ab")
+
+def test_duty_cycle(fake_time):
+
+    uart = ScriptedUART([
+        (make_command(2, 1), make_reply(2, 1)),
+        (make_command(8, 0), make_reply(8, 0)),
+        (make_command(6, 1), make_reply(6, 1)),
+        (make_command(4, 0), make_frame(100, 200)),
+        (make_command(4, 0), make_frame(200, 300)),
+        (make_command(6, 0), make_reply(6, 0)),
+    ])
+    sensor = SDS011Sensor(uart, period_s=60, warmup_s=10, samples=2)
+
+    run(sensor, fake_time, 9)
+    assert len(uart.written) == 3
+
+    run(sensor, fake_time, 5)
+    assert not uart.script
+
+    data = sensor.readout()
+    assert data["frames"] == 2
+    assert data["sleeping"] == 1
+    assert data["pm2_5_ug_m3"] == pytest.approx(15.0)
+    assert data["command_errors"] == 0
+
+    # while the sensor sleeps, the last burst is reported again
+    run(sensor, fake_time, 30)
+    data = sensor.readout()
+    assert data["frames"] == 0
+    assert data["pm2_5_ug_m3"] == pytest.approx(15.0)
+
+    # and after the period is over, it is woken up again
+    uart.script.append((make_command(6, 1), make_reply(6, 1)))
+    run(sensor, fake_time, 20)
+    assert not uart.script
+    assert sensor.readout()["sleeping"] == 0
+
+def test_command_retry(fake_time):
+
+    uart = ScriptedUART([
+        (make_command(8, 5), None),
+        (make_command(8, 5), make_reply(8, 5)),
+    ])
+    sensor = SDS011Sensor(uart, working_period_min=5)
+
+    run(sensor, fake_time, 3)
+    assert not uart.script
+    assert sensor.command_errors == 1
@@ -0,0 +1,189 @@
+import binascii
+import hmac
+import os
+
+import pytest
+
+import hostsim
+clock = hostsim.install()
+
+from sparkle import Sparkle, SparkleKey
+from ota import OTAHandler
+
+glitter = bytes(range(32))
+now = 1760000000
+
+def test_sparkle_key():
+
+    key = SparkleKey(glitter)
+    data = b"boot.py " + bytes(range(256)) * 100
+
+    expected = hmac.digest(glitter, data, "sha256")
+    assert key.sign(data) == expected
+    assert Sparkle(glitter, data).make_sparkle() == expected
+
+    sparkle = key.start(data[:7])
+    for i in range(7, len(data), 1000):
+        sparkle.update(data[i:i + 1000])
+    assert key.verify(sparkle, expected)
+
+    assert not key.verify(key.start(data), expected[:-1] + b"\0")
+    assert not key.verify(key.start(data), expected[:16])
+    assert not key.verify(key.start(data), b"")
+
+class MockConnection:
+
+    def __init__(self, request, chunk_size=1000):
+        self.request = request
+        self.chunk_size = chunk_size
+        self.sent = b""
+
+    def recv(self, size):
+        size = min(size, self.chunk_size)
+        request, self.request = self.request[:size], self.request[size:]
+        return request
+
+    def send(self, data):
+        if type(data) == str:
+            data = data.encode("ascii")
+        self.sent += data
+        return len(data)
+
+    def status(self):
+        return int(self.sent.split(b" ")[1])
+
+@pytest.fixture
+def ota_dir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    clock.now_us = now * 1000000
+    return tmp_path
+
+def make_url(method, filename, data, timestamp=None, noop=False, key=glitter):
+    """ like deploy.py does it """
+
+    url = "/ota/{}?sparkle=".format(filename)
+    signed = (b"--noop " if noop else b"") + data
+    if timestamp is not None:
+        signed = b"@" + str(timestamp).encode("ascii") + b" " + signed
+    url += binascii.hexlify(hmac.digest(key, signed, "sha256")).decode("ascii")
+    url += "&noop={}".format("yes" if noop else "no")
+    if timestamp is not None:
+        url += "&ts={}".format(timestamp)
+    return url.encode("ascii")
+
+def request(handler, method, filename, content=b"", timestamp=None, **kwargs):
+
+    if method == b"PUT":
+        url = make_url(method, filename, filename.encode("ascii") + b" " + content, timestamp, **kwargs)
+        head = method + b" " + url + b" HTTP/1.1\r\nContent-Length: " + str(len(content)).encode("ascii") + b"\r\n\r\n"
+    else:
+        url = make_url(method, filename, filename.encode("ascii"), timestamp, **kwargs)
+        head = method + b" " + url + b" HTTP/1.1\r\n\r\n"
+
+    # like boot.py, the first 400 bytes arrive with the request head
+    data = head + content
+    connection = MockConnection(data[400:])
+    handler.handle(connection, data[:400], method, url, url[1:])
+    return connection
+
+def test_put(ota_dir):
+
+    handler = OTAHandler(glitter)
+    content = b"print('hi!')\n" * 1000
+
+    connection = request(handler, b"PUT", "hello.py", content, timestamp=now * 1000)
+    assert connection.status() == 200
+    assert (ota_dir / "hello.py").read_bytes() == content
+    assert not (ota_dir / "hello.py.part").exists()
+
+    # the same request again
+    (ota_dir / "hello.py").write_bytes(b"")
+    connection = request(handler, b"PUT", "hello.py", content, timestamp=now * 1000)
+    assert connection.status() == 400
+    assert (ota_dir / "hello.py").read_bytes() == b""
+
+    # the timestamp is remembered across reboots
+    handler = OTAHandler(glitter)
+    connection = request(handler, b"PUT", "hello.py", content, timestamp=now * 1000 - 1)
+    assert connection.status() == 400
+    connection = request(handler, b"PUT", "hello.py", content, timestamp=now * 1000 + 1)
+    assert connection.status() == 200
+
+def test_wrong_sparkle(ota_dir):
+
+    handler = OTAHandler(glitter)
+
+    connection = request(handler, b"PUT", "hello.py", b"evil", timestamp=now * 1000, key=bytes(32))
+    assert connection.status() == 400
+    assert os.listdir(ota_dir) == []
+
+    # a failed attempt doesn't use up the timestamp
+    connection = request(handler, b"PUT", "hello.py", b"good", timestamp=now * 1000)
+    assert connection.status() == 200
+
+def test_put_too_large(ota_dir, monkeypatch):
+
+    import uos
+    # 100 blocks of 4k free
+    monkeypatch.setattr(uos, "statvfs", lambda path: (4096, 4096, 1000, 100, 100, 0, 0, 0, 0, 255))
+    handler = OTAHandler(glitter)
+
+    # refused before anything is written, whatever the sparkle
+    connection = request(handler, b"PUT", "big.py", bytes(400 * 1024 - 64 * 1024 + 1), timestamp=now * 1000, key=bytes(32))
+    assert connection.status() == 413
+    assert os.listdir(ota_dir) == []
+
+    connection = request(handler, b"PUT", "big.py", bytes(400 * 1024 - 64 * 1024), timestamp=now * 1000)
+    assert connection.status() == 200
+
+def test_timestamp_window(ota_dir):
+
+    handler = OTAHandler(glitter, timestamp_window_s=300)
+
+    connection = request(handler, b"PUT", "a.py", b"", timestamp=(now - 301) * 1000)
+    assert connection.status() == 400
+    connection = request(handler, b"PUT", "a.py", b"", timestamp=(now + 301) * 1000)
+    assert connection.status() == 400
+    connection = request(handler, b"PUT", "a.py", b"", timestamp=(now - 299) * 1000)
+    assert connection.status() == 200
+
+    # without ntp, only the order matters
+    clock.now_us = 3600 * 1000000
+    connection = request(handler, b"PUT", "a.py", b"", timestamp=(now - 200) * 1000)
+    assert connection.status() == 200
+
+def test_invalid_timestamp(ota_dir):
+
+    handler = OTAHandler(glitter)
+    for timestamp in ("soon", "", "1e12"):
+        connection = request(handler, b"PUT", "a.py", b"1", timestamp=timestamp)
+        assert connection.status() == 400
+        assert connection.sent.endswith(b"invalid timestamp")
+    assert os.listdir(ota_dir) == []
+
+def test_unstamped(ota_dir):
+
+    connection = request(OTAHandler(glitter), b"PUT", "a.py", b"1")
+    assert connection.status() == 400
+
+    connection = request(OTAHandler(glitter, allow_unstamped=True), b"PUT", "a.py", b"1")
+    assert connection.status() == 200
+
+def test_delete(ota_dir):
+
+    handler = OTAHandler(glitter)
+    (ota_dir / "a.py").write_bytes(b"1")
+
+    connection = request(handler, b"DELETE", "a.py", timestamp=now * 1000, noop=True)
+    assert connection.status() == 200
+    assert (ota_dir / "a.py").exists()
+
+    connection = request(handler, b"DELETE", "a.py", timestamp=now * 1000 + 1)
+    assert connection.status() == 200
+    assert not (ota_dir / "a.py").exists()
+
+    # replaying the delete after the file has been pushed again
+    (ota_dir / "a.py").write_bytes(b"1")
+    connection = request(handler, b"DELETE", "a.py", timestamp=now * 1000 + 1)
+    assert connection.status() == 400
+    assert (ota_dir / "a.py").exists()
@@ -0,0 +1,209 @@
+import io
+import math
+
+import pytest
+
+import hostsim
+clock = hostsim.install()
+
+from tslog import TimeSeriesLog
+from tslog_decode import decode_segment, to_csv, to_openmetrics
+
+now = 1760000000
+
+metrics = [
+    ("temperature", "kitchen", {"label": "kitchen", "type": "bme"}),
+    ("humidity", "kitchen", {"label": "kitchen", "type": "bme"}),
+    ("pm25", "balcony", {"label": "balcony", "type": "sds"}),
+]
+
+class MockConnection:
+
+    def __init__(self):
+        self.sent = b""
+
+    def send(self, data):
+        self.sent += data
+        return len(data)
+
+    def status(self):
+        return int(self.sent.split(b" ")[1])
+
+    def body(self):
+        return self.sent.split(b"\r\n\r\n", 1)[1]
+
+@pytest.fixture
+def log_dir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    clock.now_us = now * 1000000
+    return tmp_path / "tslog"
+
+def read_segments(log_dir):
+    return [decode_segment(path.read_bytes()) for path in sorted(log_dir.iterdir())]
+
+def sample(log, i):
+    clock.advance_ms(10000)
+    log.add("kitchen", {"temperature": 21.5 + 0.01 * (i % 7), "humidity": 40 + i % 3})
+    if i % 2 == 0:
+        log.add("balcony", {"pm25": 3.2})
+    log.write_record()
+
+def test_records(log_dir):
+
+    log = TimeSeriesLog(metrics)
+    for i in range(10):
+        sample(log, i)
+    log.flush()
+
+    [(schema, records)] = read_segments(log_dir)
+    assert [name for name, labels in schema["metrics"]] == ["temperature", "humidity", "pm25"]
+    assert len(records) == 10
+    for i, (timestamp, values) in enumerate(records):
+        assert timestamp == now + 10 * (i + 1)
+        assert values[0] == pytest.approx(21.5 + 0.01 * (i % 7))
+        assert values[1] == 40 + i % 3
+        assert values[2] == (3.2 if i % 2 == 0 else None)
+
+def test_records_are_small(log_dir):
+
+    log = TimeSeriesLog(metrics)
+    for i in range(1000):
+        sample(log, i)
+    log.flush()
+
+    # 3 values in 4 bytes each (+ a timestamp) as floats, 1-2 bytes each as
+    # deltas
+    assert log.total_size < 1000 * 7
+
+def test_page_sized_writes(log_dir):
+
+    log = TimeSeriesLog(metrics, page_size=256)
+    header_size = log.total_size
+
+    sizes = set()
+    for i in range(200):
+        sample(log, i)
+        sizes.add(log.total_size)
+
+    # only a few writes, of almost a page each
+    assert len(sizes) < 200 * 7 / 256 + 2
+    assert all(size - header_size <= 256 * (len(sizes) - 1) for size in sizes)
+
+def test_flush_interval(log_dir):
+
+    log = TimeSeriesLog(metrics, flush_interval_s=60)
+    size = log.total_size
+    for i in range(5):
+        sample(log, i)
+    assert log.total_size == size
+    sample(log, 5)
+    sample(log, 6)
+    assert log.total_size > size
+
+def test_rotation(log_dir):
+
+    log = TimeSeriesLog(metrics, segment_size=1024, budget=4096, page_size=256)
+    for i in range(2000):
+        sample(log, i)
+    log.flush()
+
+    segments = read_segments(log_dir)
+    assert 3 <= len(segments) <= 5
+    assert sum(path.stat().st_size for path in log_dir.iterdir()) <= 4096
+    assert all(path.stat().st_size <= 1024 for path in log_dir.iterdir())
+
+    # the newest records are there, and every segment decodes on its own
+    timestamps = [timestamp for schema, records in segments for timestamp, values in records]
+    assert timestamps == sorted(timestamps)
+    assert timestamps[-1] == now + 10 * 2000
+    values = [values for schema, records in segments for timestamp, values in records]
+    assert values[-1][0] == pytest.approx(21.5 + 0.01 * (1999 % 7))
+
+def test_restart(log_dir):
+
+    log = TimeSeriesLog(metrics)
+    for i in range(10):
+        sample(log, i)
+    log.flush()
+
+    # after a reset, the log goes on in a new segment
+    log = TimeSeriesLog(metrics)
+    sample(log, 10)
+    log.flush()
+
+    assert [len(records) for schema, records in read_segments(log_dir)] == [10, 1]
+
+def test_cut_off_record(log_dir):
+
+    log = TimeSeriesLog(metrics)
+    for i in range(10):
+        sample(log, i)
+    log.flush()
+
+    path = next(log_dir.iterdir())
+    path.write_bytes(path.read_bytes()[:-2])
+    [(schema, records)] = read_segments(log_dir)
+    assert len(records) == 9
+
+def test_download(log_dir):
+
+    log = TimeSeriesLog(metrics)
+    for i in range(100):
+        sample(log, i)
+
+    connection = MockConnection()
+    log.handle(connection, b"GET /log HTTP/1.1\r\n\r\n", b"log")
+    name, size = connection.body().decode("ascii").split()
+    size = int(size)
+    data = (log_dir / name).read_bytes()
+    assert size == len(data)
+
+    connection = MockConnection()
+    log.handle(connection, b"GET /log/" + name.encode("ascii") + b" HTTP/1.1\r\n\r\n", b"log/" + name.encode("ascii"))
+    assert connection.status() == 200
+    assert connection.body() == data
+
+    connection = MockConnection()
+    log.handle(connection, b"GET /log/" + name.encode("ascii") + b" HTTP/1.1\r\nRange: bytes=100-\r\n\r\n", b"log/" + name.encode("ascii"))
+    assert connection.status() == 206
+    assert "Content-Range: bytes 100-{}/{}".format(size - 1, size).encode("ascii") in connection.sent
+    assert connection.body() == data[100:]
+
+    connection = MockConnection()
+    log.handle(connection, b"GET /log/" + name.encode("ascii") + b" HTTP/1.1\r\nrange: bytes=10-19\r\n\r\n", b"log/" + name.encode("ascii"))
+    assert connection.body() == data[10:20]
+
+    connection = MockConnection()
+    log.handle(connection, b"GET /log/" + name.encode("ascii") + b" HTTP/1.1\r\nRange: bytes=-10\r\n\r\n", b"log/" + name.encode("ascii"))
+    assert connection.body() == data[-10:]
+
+    connection = MockConnection()
+    log.handle(connection, b"GET /log/" + name.encode("ascii") + b" HTTP/1.1\r\nRange: bytes=100000-\r\n\r\n", b"log/" + name.encode("ascii"))
+    assert connection.status() == 416
+
+    connection = MockConnection()
+    log.handle(connection, b"GET /log/nope.seg HTTP/1.1\r\n\r\n", b"log/nope.seg")
+    assert connection.status() == 404
+
+def test_output_formats(log_dir):
+
+    log = TimeSeriesLog(metrics)
+    for i in range(3):
+        sample(log, i)
+    log.flush()
+    segments = read_segments(log_dir)
+
+    out = io.StringIO()
+    to_csv(segments, out)
+    lines = out.getvalue().splitlines()
+    assert lines[0] == 'timestamp,"temperature{label=""kitchen"",type=""bme""}","humidity{label=""kitchen"",type=""bme""}","pm25{label=""balcony"",type=""sds""}"'
+    assert lines[1] == "{},21.5,40.0,3.2".format(now + 10)
+    assert lines[2] == "{},21.51,41.0,".format(now + 20)
+
+    out = io.StringIO()
+    to_openmetrics(segments, out)
+    lines = out.getvalue().splitlines()
+    assert lines[0] == "# TYPE temperature gauge"
+    assert lines[1] == 'temperature{{label="kitchen",type="bme"}} 21.5 {}'.format(now + 10)
+    assert 'pm25{{label="balcony",type="sds"}} 3.2 {}'.format(now + 30) in lines
+    assert lines[-1] == "# EOF"
@@ -0,0 +1,208 @@
+import json
+
+import pytest
+
+import hostsim
+clock = hostsim.install()
+
+import machine
+import fallback
+from watchdog import Watchdog
+
+@pytest.fixture
+def state_file(tmp_path):
+    clock.now_us = 0
+    machine.last_reset_cause = machine.PWRON_RESET
+    hostsim.FakeRTC._memory = b""
+    return str(tmp_path / "watchdog_state")
+
+def reboot(state_file, reset_cause, **kwargs):
+    machine.last_reset_cause = reset_cause
+    watchdog = Watchdog(state_file=state_file, **kwargs)
+    watchdog.start()
+    return watchdog
+
+def run(watchdog, seconds):
+    """ time passes, and the check timer gets to run """
+    for _ in range(seconds):
+        clock.advance_ms(1000)
+        watchdog._timer.fire()
+
+def hang(seconds):
+    """ time passes, but not even the timer gets to run """
+    clock.advance_ms(seconds * 1000)
+
+def test_feeds_while_on_time(state_file):
+
+    watchdog = reboot(state_file, machine.PWRON_RESET)
+
+    for _ in range(20):
+        watchdog.stage(b"accept", 5000)
+        run(watchdog, 1)
+        watchdog.stage(b"send", 60000)
+        run(watchdog, 3)
+
+    assert watchdog._wdt.feeds == 80
+    assert not watchdog._wdt.expired()
+
+def test_stalled_stage(state_file):
+
+    watchdog = reboot(state_file, machine.PWRON_RESET)
+    watchdog.stage(b"loop", 10000)
+    run(watchdog, 1)
+
+    # the co2 sensor doesn't answer, and the driver loops forever
+    watchdog.nested_stage(b"readout co2", 5000)
+    with pytest.raises(hostsim.Reset):
+        run(watchdog, 10)
+    assert clock.now_us == 7000000
+
+    with open(state_file) as f:
+        assert json.load(f)["stall"] == "readout co2"
+
+    watchdog = reboot(state_file, machine.SOFT_RESET)
+    assert watchdog.last_stall == "readout co2"
+    assert watchdog.crash_count == 1
+    assert 'watchdog_last_stall{stage="readout co2"} 1' in watchdog.render_text()
+
+    # it's only reported once
+    watchdog = reboot(state_file, machine.SOFT_RESET)
+    assert watchdog.last_stall is None
+    assert watchdog.crash_count == 2
+
+def test_nested_stage_keeps_deadline(state_file):
+
+    watchdog = reboot(state_file, machine.PWRON_RESET)
+    watchdog.stage(b"send", 10000)
+    for _ in range(3):
+        watchdog.nested_stage(b"readout kitchen", 5000)
+        run(watchdog, 3)
+        watchdog.end_nested_stage()
+
+    # the nested stages were fine, but the request as a whole takes too long
+    with pytest.raises(hostsim.Reset):
+        run(watchdog, 2)
+
+    with open(state_file) as f:
+        assert json.load(f)["stall"] == "send"
+
+def test_hardware_reset(state_file):
+
+    watchdog = reboot(state_file, machine.PWRON_RESET, timeout_ms=10000)
+    watchdog.stage(b"accept", 5000)
+    run(watchdog, 1)
+    watchdog.stage(b"recv", 10000)
+
+    # stuck somewhere the timer can't run either
+    hang(11)
+    assert watchdog._wdt.expired()
+
+    watchdog = reboot(state_file, machine.WDT_RESET)
+    assert watchdog.last_stall == "recv"
+    assert watchdog.crash_count == 1
+
+def test_crash_loop(state_file):
+
+    watchdog = reboot(state_file, machine.PWRON_RESET, max_crashes=3)
+    assert watchdog.crash_count == 0
+
+    for crash_count in range(1, 4):
+        watchdog = reboot(state_file, machine.WDT_RESET, max_crashes=3)
+        assert watchdog.crash_count == crash_count
+    assert watchdog.fallback
+    assert "watchdog_fallback 1" in watchdog.render_text()
+
+    # a power cycle gives it another chance
+    watchdog = reboot(state_file, machine.PWRON_RESET, max_crashes=3)
+    assert not watchdog.fallback
+
+def test_deep_sleep_isnt_a_crash(state_file):
+
+    # in the duty cycle mode, every cycle ends with a wakeup from deep
+    # sleep, without ever being marked healthy
+    for _ in range(5):
+        watchdog = reboot(state_file, machine.DEEPSLEEP_RESET, max_crashes=3)
+        assert watchdog.crash_count == 0
+
+    watchdog = reboot(state_file, machine.WDT_RESET, max_crashes=3)
+    assert watchdog.crash_count == 1
+
+def test_healthy_after_a_while(state_file):
+
+    watchdog = reboot(state_file, machine.PWRON_RESET, healthy_after_s=120)
+    watchdog = reboot(state_file, machine.SOFT_RESET, healthy_after_s=120)
+    assert watchdog.crash_count == 1
+
+    watchdog.stage(b"loop", 10000)
+    for _ in range(12):
+        run(watchdog, 10)
+        watchdog.stage(b"loop", 10000)
+        watchdog.poll()
+    assert watchdog.crash_count == 0
+
+    watchdog = reboot(state_file, machine.SOFT_RESET, healthy_after_s=120)
+    assert watchdog.crash_count == 0
+
+class MockConnection:
+
+    def __init__(self, request):
+        self.request = request
+        self.sent = b""
+
+    def recv(self, size):
+        request, self.request = self.request[:size], self.request[size:]
+        return request
+
+    def send(self, data):
+        self.sent += data
+        return len(data)
+
+class MockOTAHandler:
+
+    def __init__(self):
+        self.requests = []
+
+    def listing(self, connection, url):
+        self.requests.append("listing")
+        connection.send(b"HTTP/1.1 200 OK\r\n\r\n")
+
+    def handle(self, connection, request, method, url, path):
+        self.requests.append((method, path))
+        connection.send(b"HTTP/1.1 200 OK\r\n\r\n")
+
+class MockLogger:
+
+    def info(self, message):
+        pass
+
+    def flush(self):
+        pass
+
+def test_fallback_mode(state_file):
+
+    for reset_cause in (machine.PWRON_RESET, machine.WDT_RESET, machine.WDT_RESET, machine.WDT_RESET):
+        watchdog = reboot(state_file, reset_cause)
+    assert watchdog.fallback
+
+    ota_handler = MockOTAHandler()
+
+    connection = MockConnection(b"GET /ota-listing HTTP/1.1\r\n\r\n")
+    fallback.handle_request(connection, ota_handler, watchdog, MockLogger())
+    assert connection.sent.startswith(b"HTTP/1.1 200")
+
+    connection = MockConnection(b"PUT /ota/sds011_sensor.py?sparkle=00 HTTP/1.1\r\nContent-Length: 0\r\n\r\n")
+    fallback.handle_request(connection, ota_handler, watchdog, MockLogger())
+    assert ota_handler.requests == ["listing", (b"PUT", b"ota/sds011_sensor.py?sparkle=00")]
+
+    connection = MockConnection(b"GET /metrics HTTP/1.1\r\n\r\n")
+    fallback.handle_request(connection, ota_handler, watchdog, MockLogger())
+    assert connection.sent.startswith(b"HTTP/1.1 503")
+
+    connection = MockConnection(b"GET /reboot HTTP/1.1\r\n\r\n")
+    with pytest.raises(hostsim.Reset):
+        fallback.handle_request(connection, ota_handler, watchdog, MockLogger())
+    assert connection.sent.startswith(b"HTTP/1.1 202")
+
+    # the reboot leaves the fallback mode
+    watchdog = reboot(state_file, machine.SOFT_RESET)
+    assert not watchdog.fallback
@@ -0,0 +1,118 @@
+import pytest
+
+import hostsim
+clock = hostsim.install()
+
+from wifi_manager import WifiManager, CONNECTED
+
+class ScriptedWLAN:
+    """ a network.WLAN that connects (or doesn't) as the test says. script
+        is a list with the number of ms every connect() takes until the
+        association is up, or None for attempts that never succeed. """
+
+    def __init__(self, script, connected=False):
+        self.script = list(script)
+        self.connected_at = None
+        self.connected = connected
+        self.connects = []
+        self.disconnects = 0
+
+    def isconnected(self):
+        if self.connected_at is not None and clock.now_us >= self.connected_at:
+            self.connected = True
+            self.connected_at = None
+        return self.connected
+
+    def connect(self, ssid, passphrase):
+        self.connects.append(clock.now_us // 1000)
+        duration_ms = self.script.pop(0)
+        if duration_ms is not None:
+            self.connected_at = clock.now_us + duration_ms * 1000
+
+    def disconnect(self):
+        self.disconnects += 1
+        self.connected_at = None
+        self.connected = False
+
+    def drop(self):
+        """ the access point goes away """
+        self.connected = False
+
+def run(manager, seconds, step_ms=100):
+    for _ in range(seconds * 1000 // step_ms):
+        clock.advance_ms(step_ms)
+        manager.poll()
+
+@pytest.fixture(autouse=True)
+def reset_clock():
+    clock.now_us = 0
+
+def test_connect_at_boot():
+
+    wlan = ScriptedWLAN([2000])
+    manager = WifiManager(wlan, "ssid", "passphrase")
+
+    assert manager.connect(30000)
+    assert manager.state == CONNECTED
+    assert 2000 <= clock.now_us // 1000 <= 2200
+    assert manager.last_connect_ms == pytest.approx(2000, abs=200)
+    assert manager.reconnects == 0
+    assert "wifi_connected 1" in manager.render_text()
+
+def test_backoff():
+
+    wlan = ScriptedWLAN([None, None, None, None, 500], connected=False)
+    manager = WifiManager(wlan, "ssid", "passphrase", connect_timeout_ms=10000, min_backoff_ms=1000, max_backoff_ms=4000)
+
+    assert manager.connect(120000)
+    # attempts at 0, then after each timeout of 10 s, a backoff of 1, 2, 4, 4 s
+    assert wlan.connects == [0, 11000, 23000, 37000, 51000]
+    assert manager.failed_attempts == 4
+    assert wlan.disconnects == 4
+
+def test_connect_deadline():
+
+    wlan = ScriptedWLAN([None] * 10)
+    manager = WifiManager(wlan, "ssid", "passphrase", connect_timeout_ms=10000)
+
+    assert not manager.connect(25000)
+    assert clock.now_us // 1000 == 25000
+    assert "wifi_connected 0" in manager.render_text()
+
+    # it goes on in the background
+    run(manager, 60)
+    assert len(wlan.connects) > 3
+
+def test_reconnect():
+
+    wlan = ScriptedWLAN([1000, None, 3000])
+    manager = WifiManager(wlan, "ssid", "passphrase", connect_timeout_ms=10000, min_backoff_ms=1000)
+    assert manager.connect(30000)
+    run(manager, 60)
+
+    wlan.drop()
+    clock.advance_ms(100)
+    assert not manager.poll()
+    # the first attempt is right away, and fails
+    assert len(wlan.connects) == 2
+    assert manager.disconnected_for_ms() == 0
+
+    reconnected = False
+    for _ in range(200):
+        clock.advance_ms(100)
+        reconnected = manager.poll() or reconnected
+    assert reconnected
+    assert manager.state == CONNECTED
+    assert manager.reconnects == 1
+    assert manager.last_connect_ms == pytest.approx(3000, abs=100)
+    # 1 s at boot, then 10 s for the failed attempt, 1 s backoff, 3 s for
+    # the successful one
+    assert manager.disconnected_ms == pytest.approx(15000, abs=200)
+    assert "wifi_reconnects 1" in manager.render_text()
+
+def test_still_connected_after_soft_reset():
+
+    wlan = ScriptedWLAN([], connected=True)
+    manager = WifiManager(wlan, "ssid", "passphrase")
+    assert manager.connect(1000)
+    assert wlan.connects == []
@@ -0,0 +1,270 @@
+import json
+import struct
+import uos
+import utime
+from array import array
+from gelf import EPOCH_OFFSET
+
+# an append-only log of sensor readings on flash, so that they survive wifi
+# or prometheus outages. tslog_decode.py reads it back on the host.
+#
+# the log is a series of segment files in its own directory (which ota
+# doesn't touch). every segment starts with a header:
+#
+#   magic "TL", format version (u8), reserved (u8), base time (u32, unix
+#   seconds), schema length (u16), schema (json)
+#
+# followed by records, each of which is its length (varint) and then
+#
+#   time since the previous record (zigzag varint, seconds), and for every
+#   metric in the schema: 0 if there's no value, otherwise 1 + the change
+#   since the last value (zigzag varint, in 1/SCALE)
+#
+# the first record of a segment is relative to the base time and zero, so
+# every segment can be decoded on its own. records are collected in a page
+# sized buffer and written in one go, to save write cycles.
+
+MAGIC = b"TL"
+FORMAT_VERSION = 1
+HEADER_FORMAT = "<2sBBIH"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+
+# values are stored with this resolution
+SCALE = 100
+
+NAN = float("nan")
+
+def _zigzag(value):
+    return (value << 1) if value >= 0 else ((-value << 1) - 1)
+
+def _put_varint(buf, pos, value):
+    """ returns the position after the varint """
+    while value >= 0x80:
+        buf[pos] = (value & 0x7f) | 0x80
+        value >>= 7
+        pos += 1
+    buf[pos] = value
+    return pos + 1
+
+def _send(connection, data):
+    connection.send(data)
+
+class TimeSeriesLog:
+    """ Readings are collected with add(), and become a record with
+        write_record(). Segments are rotated at segment_size bytes, and the
+        oldest ones are removed to stay within budget bytes. """
+
+    def __init__(self, metrics, directory="tslog", segment_size=32768, budget=262144,
+                 page_size=4096, flush_interval_s=900, send=_send):
+        """ metrics is a list of (name, sensor label, labels), as for
+            BinaryMetrics """
+
+        self.directory = directory
+        self.segment_size = segment_size
+        self.budget = budget
+        self.flush_interval_ms = flush_interval_s * 1000
+        self.send = send
+
+        # sensor label -> metric name -> slot
+        self._slots = {}
+        entries = []
+        for slot, (name, sensor_label, labels) in enumerate(metrics):
+            if sensor_label not in self._slots:
+                self._slots[sensor_label] = {}
+            self._slots[sensor_label][name] = slot
+            entries.append([name, labels])
+        self._schema = json.dumps({"scale": SCALE, "metrics": entries}).encode("utf-8")
+
+        num_values = len(entries)
+        self._row = array("f", [NAN] * num_values)
+        self._last_values = [0] * num_values
+        self._last_time = 0
+
+        self._page = bytearray(page_size)
+        self._page_fill = 0
+        # the longest possible record, with a 64 bit varint for everything
+        self._record = bytearray(10 + 10 * num_values)
+        self._record_view = memoryview(self._record)
+        self._last_flush = utime.ticks_ms()
+
+        # [number, size] of every segment, oldest first
+        try:
+            uos.mkdir(directory)
+        except OSError:
+            pass
+        self._segments = []
+        for name in uos.listdir(directory):
+            if name.endswith(".seg"):
+                self._segments.append([int(name[:-4]), uos.stat(self._path(int(name[:-4])))[6]])
+        self._segments.sort()
+        self.total_size = sum(size for number, size in self._segments)
+
+        self.records = 0
+        self.write_errors = 0
+
+        # always start a new segment, so that we don't need the delta
+        # state of the last one
+        self._start_segment()
+
+    def _path(self, number):
+        return "{}/{:08d}.seg".format(self.directory, number)
+
+    def _start_segment(self):
+
+        number = self._segments[-1][0] + 1 if self._segments else 0
+        self._last_time = utime.time() + EPOCH_OFFSET
+        for i in range(len(self._last_values)):
+            self._last_values[i] = 0
+
+        header = struct.pack(HEADER_FORMAT, MAGIC, FORMAT_VERSION, 0, self._last_time, len(self._schema)) + self._schema
+        self._segments.append([number, 0])
+        self._append(header)
+
+    def _append(self, data):
+        try:
+            with open(self._path(self._segments[-1][0]), "ab") as f:
+                f.write(data)
+        except OSError:
+            # most likely, the flash is full. the data is lost, but at least
+            # the sampling goes on.
+            self.write_errors += 1
+            return
+
+        self._segments[-1][1] += len(data)
+        self.total_size += len(data)
+
+        while self.total_size > self.budget and len(self._segments) > 1:
+            number, size = self._segments.pop(0)
+            try:
+                uos.remove(self._path(number))
+            except OSError:
+                pass
+            self.total_size -= size
+
+    def add(self, sensor_label, values):
+        """ adds the readings of a sensor to the next record """
+
+        slots = self._slots.get(sensor_label)
+        if slots is None:
+            return
+        for name, value in values.items():
+            slot = slots.get(name)
+            if slot is not None and value is not None:
+                self._row[slot] = value
+
+    def write_record(self):
+        """ makes a record of everything that was added since the last one """
+
+        # the length prefix is at most 3 bytes for any sensible schema
+        if self._segments[-1][1] + self._page_fill + len(self._record) + 3 > self.segment_size:
+            self.flush()
+            self._start_segment()
+
+        now = utime.time() + EPOCH_OFFSET
+        record = self._record
+        pos = _put_varint(record, 0, _zigzag(now - self._last_time))
+
+        for i in range(len(self._row)):
+            value = self._row[i]
+            if value != value:
+                # nan, no reading
+                record[pos] = 0
+                pos += 1
+                continue
+            value = int(round(value * SCALE))
+            pos = _put_varint(record, pos, _zigzag(value - self._last_values[i]) + 1)
+            self._last_values[i] = value
+            self._row[i] = NAN
+
+        self._last_time = now
+        self.records += 1
+
+        if self._page_fill + pos + 3 > len(self._page):
+            self.flush()
+
+        self._page_fill = _put_varint(self._page, self._page_fill, pos)
+        self._page[self._page_fill:self._page_fill + pos] = self._record_view[:pos]
+        self._page_fill += pos
+
+        if utime.ticks_diff(utime.ticks_ms(), self._last_flush) > self.flush_interval_ms:
+            self.flush()
+
+    def flush(self):
+        """ writes out the records that were collected so far """
+
+        self._last_flush = utime.ticks_ms()
+        if self._page_fill == 0:
+            return
+        self._append(memoryview(self._page)[:self._page_fill])
+        self._page_fill = 0
+
+    def handle(self, connection, request, path):
+        """ GET /log lists the segments, GET /log/<name> serves one, with
+            support for range requests. path is without the leading
+            slash. """
+
+        path = path.split(b"?")[0]
+        self.flush()
+
+        if path == b"log":
+            body = "".join("{:08d}.seg {}\n".format(number, size) for number, size in self._segments).encode("ascii")
+            self.send(connection, "HTTP/1.1 200 OK\r\nContent-Length: {}\r\nContent-Type: text/plain\r\n\r\n".format(len(body)).encode("ascii") + body)
+            return
+
+        name = path[4:].decode("ascii")
+        size = None
+        for number, segment_size in self._segments:
+            if name == "{:08d}.seg".format(number):
+                size = segment_size
+        if size is None:
+            body = b"no such segment"
+            self.send(connection, "HTTP/1.1 404 not found\r\nContent-Length: {}\r\n\r\n".format(len(body)).encode("ascii") + body)
+            return
+
+        start, end = 0, size - 1
+        status = "200 OK"
+        content_range = ""
+        head = request.split(b"\r\n\r\n", 1)[0].decode("ascii").lower()
+        for line in head.split("\r\n"):
+            if line.startswith("range:"):
+                range_spec = line[6:].strip()
+                try:
+                    if not range_spec.startswith("bytes=") or "," in range_spec:
+                        raise ValueError
+                    first, last = range_spec[6:].split("-")
+                    if first:
+                        start = int(first)
+                        end = min(int(last), size - 1) if last else size - 1
+                    else:
+                        start = max(size - int(last), 0)
+                except ValueError:
+                    # not something we understand, so it's ignored
+                    start, end = 0, size - 1
+                    break
+                if start > end:
+                    self.send(connection, "HTTP/1.1 416 range not satisfiable\r\nContent-Range: bytes */{}\r\nContent-Length: 0\r\n\r\n".format(size).encode("ascii"))
+                    return
+                status = "206 partial content"
+                content_range = "Content-Range: bytes {}-{}/{}\r\n".format(start, end, size)
+
+        self.send(connection, "HTTP/1.1 {}\r\nContent-Length: {}\r\nContent-Type: application/octet-stream\r\n{}\r\n".format(
+            status, end - start + 1, content_range).encode("ascii"))
+
+        with open(self._path(int(name[:-4])), "rb") as f:
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = f.read(min(remaining, 4096))
+                if not chunk:
+                    break
+                self.send(connection, chunk)
+                remaining -= len(chunk)
+
+    def render_text(self):
+        """ prometheus text exposition """
+
+        text = "# TYPE tslog_records counter\ntslog_records {}\n".format(self.records)
+        text += "# TYPE tslog_bytes gauge\ntslog_bytes {}\n".format(self.total_size + self._page_fill)
+        text += "# TYPE tslog_segments gauge\ntslog_segments {}\n".format(len(self._segments))
+        text += "# TYPE tslog_write_errors counter\ntslog_write_errors {}\n".format(self.write_errors)
+        return text
@@ -0,0 +1,184 @@
+import argparse
+import csv
+import json
+import math
+import os
+import struct
+import sys
+import urllib.request
+
+# reads the on-flash log of a device (see tslog.py for the format). segments
+# are kept in a local directory, and only the part that's new is fetched.
+
+MAGIC = b"TL"
+FORMAT_VERSION = 1
+HEADER_FORMAT = "<2sBBIH"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+
+
+def make_argument_parser():
+
+    parser = argparse.ArgumentParser(description="fetch the on-flash log of a device and print it as csv or as openmetrics, for prometheus backfilling")
+    parser.add_argument("device", type=str,
+                        help="device name; it has to resolve to the IP of the device.")
+    parser.add_argument("--format", choices=("csv", "openmetrics"), default="csv",
+                        help="output format (default: csv). openmetrics can be fed to promtool tsdb create-blocks-from openmetrics.")
+    parser.add_argument("--segment-dir", type=str, default=None,
+                        help="directory to keep the segments in (default: .<device>.tslog)")
+    parser.add_argument("--offline", action="store_true",
+                        help="only decode the segments that have been fetched before")
+
+    return parser
+
+
+def read_varint(data, pos):
+    """ returns the value and the position after it """
+
+    value = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            return value, pos
+
+
+def unzigzag(value):
+    return (value >> 1) if not value & 1 else -((value + 1) >> 1)
+
+
+def decode_segment(data):
+    """ returns the schema and a list of (timestamp, values) records, where
+        missing values are None. a record that was cut off at the end (by
+        a reset during a write) is left out. """
+
+    magic, version, _, base_time, schema_length = struct.unpack_from(HEADER_FORMAT, data)
+    if magic != MAGIC or version != FORMAT_VERSION:
+        raise RuntimeError("not a log segment, or an unsupported version")
+
+    schema = json.loads(data[HEADER_SIZE:HEADER_SIZE + schema_length])
+    scale = schema["scale"]
+    num_values = len(schema["metrics"])
+
+    records = []
+    timestamp = base_time
+    last_values = [0] * num_values
+    pos = HEADER_SIZE + schema_length
+
+    while pos < len(data):
+        try:
+            length, start = read_varint(data, pos)
+            if start + length > len(data):
+                break
+            delta, record_pos = read_varint(data, start)
+            timestamp += unzigzag(delta)
+
+            values = [None] * num_values
+            for i in range(num_values):
+                code, record_pos = read_varint(data, record_pos)
+                if code:
+                    last_values[i] += unzigzag(code - 1)
+                    values[i] = last_values[i] / scale
+
+        except IndexError:
+            break
+
+        pos = start + length
+        records.append((timestamp, values))
+
+    return schema, records
+
+
+def to_csv(segments, out):
+    """ segments is a list of (schema, records). there's a new header line
+        whenever the schema changes. """
+
+    writer = csv.writer(out)
+    last_schema = None
+    for schema, records in segments:
+        if schema != last_schema:
+            writer.writerow(["timestamp"] + [
+                name + ("{" + ",".join(f'{key}="{value}"' for key, value in labels.items() if key != "description") + "}" if labels else "")
+                for name, labels in schema["metrics"]])
+            last_schema = schema
+        for timestamp, values in records:
+            writer.writerow([timestamp] + ["" if value is None else value for value in values])
+
+
+def to_openmetrics(segments, out):
+    """ segments is a list of (schema, records). samples of a metric have to
+        be together in openmetrics, so this goes through the records once
+        per metric name. """
+
+    names = []
+    for schema, records in segments:
+        for name, labels in schema["metrics"]:
+            if name not in names:
+                names.append(name)
+
+    for name in names:
+        out.write(f"# TYPE {name} gauge\n")
+        for schema, records in segments:
+            for i, (metric_name, labels) in enumerate(schema["metrics"]):
+                if metric_name != name:
+                    continue
+                label_string = ",".join(f'{key}="{value}"' for key, value in labels.items())
+                series = f"{name}{{{label_string}}}" if label_string else name
+                for timestamp, values in records:
+                    if values[i] is not None and not math.isnan(values[i]):
+                        out.write(f"{series} {values[i]} {timestamp}\n")
+
+    out.write("# EOF\n")
+
+
+def fetch_segments(device, segment_dir):
+    """ fetches whatever is new since the last time, returns the names of
+        the segments the device has """
+
+    os.makedirs(segment_dir, exist_ok=True)
+
+    with urllib.request.urlopen(f"http://{device}:5000/log") as response:
+        listing = response.read().decode("ascii")
+
+    names = []
+    for line in listing.splitlines():
+        name, size = line.split(" ")
+        names.append(name)
+
+        filename = os.path.join(segment_dir, name)
+        have = os.path.getsize(filename) if os.path.exists(filename) else 0
+        if have >= int(size):
+            continue
+
+        request = urllib.request.Request(f"http://{device}:5000/log/{name}", headers={"Range": f"bytes={have}-"})
+        with urllib.request.urlopen(request) as response:
+            data = response.read()
+            # a device that ignores the range sends everything
+            mode = "ab" if response.status == 206 else "wb"
+
+        with open(filename, mode) as f:
+            f.write(data)
+
+    return names
+
+
+if __name__ == "__main__":
+
+    parser = make_argument_parser()
+    args = parser.parse_args()
+
+    segment_dir = args.segment_dir or f".{args.device}.tslog"
+    if not args.offline:
+        fetch_segments(args.device, segment_dir)
+
+    segments = []
+    for name in sorted(os.listdir(segment_dir)):
+        with open(os.path.join(segment_dir, name), "rb") as f:
+            segments.append(decode_segment(f.read()))
+
+    if args.format == "openmetrics":
+        to_openmetrics(segments, sys.stdout)
+    else:
+        to_csv(segments, sys.stdout)
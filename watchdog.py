@@ -0,0 +1,142 @@
+import json
+import machine
+import utime
+
+STATE_FILE = "watchdog_state"
+
+class Watchdog:
+    """ Resets the device when the main loop gets stuck, and remembers
+        where it got stuck.
+
+        The main loop announces what it's doing with stage(name,
+        deadline_ms). A timer checks every check_interval_ms that the
+        current stage is within its deadline and only then feeds the
+        hardware watchdog. If a stage overruns, the timer writes the stage
+        to the state file and resets the device. If even the timer can't
+        run anymore, the hardware watchdog resets the device after
+        timeout_ms, and the stage is taken from rtc memory (which survives
+        the reset, and which is written on every stage change instead of
+        the flash).
+
+        Every boot counts as a crash until the device has been running for
+        healthy_after_s, or until mark_healthy() is called. After
+        max_crashes of them in a row, fallback is set, and boot.py starts
+        in fallback mode. A power cycle (or waking up from deep sleep, in
+        the duty cycle mode) starts counting from zero.
+    """
+
+    def __init__(self, state_file=STATE_FILE, timeout_ms=10000, check_interval_ms=1000,
+                 max_crashes=3, healthy_after_s=120, timer_id=0):
+
+        self.state_file = state_file
+        self.timeout_ms = timeout_ms
+        self.check_interval_ms = check_interval_ms
+        self.max_crashes = max_crashes
+        self.healthy_after_ms = healthy_after_s * 1000
+        self.timer_id = timer_id
+
+        self._rtc = machine.RTC()
+        self._wdt = None
+        self._timer = None
+
+        self._stage = b"boot"
+        self._deadline_ms = 0
+        self._stage_start = utime.ticks_ms()
+        # the stage that a nested stage interrupted
+        self._outer_stage = None
+        self._outer_deadline_ms = 0
+        self._outer_stage_start = 0
+
+        self._boot_time = utime.ticks_ms()
+        self._healthy = False
+        self._stalled = False
+
+        state = self._load_state()
+
+        self.reset_cause = machine.reset_cause()
+        # set by the timer before it resets the device
+        self.last_stall = state.get("stall")
+        if self.reset_cause == machine.WDT_RESET and self.last_stall is None:
+            # the timer didn't get to run, so it's wherever we were
+            self.last_stall = bytes(self._rtc.memory()).decode() or "unknown"
+
+        boots = 0 if self.reset_cause in (machine.PWRON_RESET, machine.DEEPSLEEP_RESET) else state.get("boots", 0)
+        self.crash_count = boots
+        self.fallback = self.crash_count >= max_crashes
+
+        # the stall has been reported now, so it's not saved again
+        self._save_state(boots + 1, None)
+
+    def _load_state(self):
+        try:
+            with open(self.state_file) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_state(self, boots, stall):
+        with open(self.state_file, "w") as f:
+            json.dump({"boots": boots, "stall": stall}, f)
+
+    def start(self):
+        """ starts the hardware watchdog. there's no way to stop it
+            again. """
+
+        self._wdt = machine.WDT(timeout=self.timeout_ms)
+        self._timer = machine.Timer(self.timer_id)
+        self._timer.init(mode=machine.Timer.PERIODIC, period=self.check_interval_ms, callback=self._check)
+
+    def _check(self, timer):
+        if self._stalled:
+            return
+
+        if self._deadline_ms > 0 and utime.ticks_diff(utime.ticks_ms(), self._stage_start) > self._deadline_ms:
+            self._stalled = True
+            self._save_state(self.crash_count + 1, self._stage.decode())
+            machine.reset()
+
+        self._wdt.feed()
+
+    def stage(self, name, deadline_ms):
+        """ name is bytes, so that it can go to rtc memory as it is. a
+            deadline of 0 means no deadline. """
+
+        self._stage = name
+        self._deadline_ms = deadline_ms
+        self._stage_start = utime.ticks_ms()
+        self._rtc.memory(name)
+
+    def nested_stage(self, name, deadline_ms):
+        """ like stage(), but end_nested_stage() goes back to the current
+            stage, which keeps its deadline """
+
+        self._outer_stage = self._stage
+        self._outer_deadline_ms = self._deadline_ms
+        self._outer_stage_start = self._stage_start
+        self.stage(name, deadline_ms)
+
+    def end_nested_stage(self):
+        self._stage = self._outer_stage
+        self._deadline_ms = self._outer_deadline_ms
+        self._stage_start = self._outer_stage_start
+        self._rtc.memory(self._stage)
+
+    def poll(self):
+        if not self._healthy and utime.ticks_diff(utime.ticks_ms(), self._boot_time) >= self.healthy_after_ms:
+            self.mark_healthy()
+
+    def mark_healthy(self):
+        """ this boot wasn't a crash after all """
+        self._healthy = True
+        self.crash_count = 0
+        self._save_state(0, None)
+
+    def render_text(self):
+        """ prometheus text exposition """
+
+        text = "# TYPE watchdog_crash_count gauge\nwatchdog_crash_count {}\n".format(self.crash_count)
+        text += "# TYPE watchdog_reset_cause gauge\nwatchdog_reset_cause {}\n".format(self.reset_cause)
+        text += "# TYPE watchdog_fallback gauge\nwatchdog_fallback {}\n".format(int(self.fallback))
+        if self.last_stall:
+            text += '# TYPE watchdog_last_stall gauge\nwatchdog_last_stall{{stage="{}"}} 1\n'.format(self.last_stall)
+        return text
@@ -0,0 +1,132 @@
+import utime
+
+# states of the connection
+CONNECTED = 0
+CONNECTING = 1
+BACKING_OFF = 2
+
+class WifiManager:
+    """ Keeps the station interface associated. Every attempt to connect
+        gets connect_timeout_ms, and failed attempts are retried after a
+        backoff that doubles up to max_backoff_ms. poll() has to be called
+        regularly (from the main loop), it notices a dropped association
+        and connects again, without rebooting.
+    """
+
+    def __init__(self, wlan, ssid, passphrase, connect_timeout_ms=15000,
+                 min_backoff_ms=1000, max_backoff_ms=60000):
+
+        self.wlan = wlan
+        self.ssid = ssid
+        self.passphrase = passphrase
+        self.connect_timeout_ms = connect_timeout_ms
+        self.min_backoff_ms = min_backoff_ms
+        self.max_backoff_ms = max_backoff_ms
+
+        self._backoff_ms = min_backoff_ms
+        # when the current attempt (or backoff) started, or when we got
+        # connected
+        self._since = utime.ticks_ms()
+        # since when we're without a connection
+        self._disconnected_since = self._since
+
+        self.state = BACKING_OFF
+        self._was_connected = False
+        self.attempts = 0
+        self.failed_attempts = 0
+        self.reconnects = 0
+        self.last_connect_ms = 0
+        # time without a connection, not counting the current outage
+        self.disconnected_ms = 0
+
+        if wlan.isconnected():
+            # still associated from before a soft reset
+            self.state = CONNECTED
+            self._was_connected = True
+        else:
+            # try right away
+            self._backoff_ms = 0
+
+    def _start_attempt(self, now):
+        self.attempts += 1
+        self.state = CONNECTING
+        self._since = now
+        try:
+            self.wlan.connect(self.ssid, self.passphrase)
+        except OSError:
+            # e.g. "wifi internal error", when it's still busy with the
+            # last attempt. the attempt times out like any other.
+            pass
+
+    def poll(self):
+        """ returns True if the connection was just (re)established """
+
+        now = utime.ticks_ms()
+        connected = self.wlan.isconnected()
+
+        if self.state == CONNECTED:
+            if not connected:
+                self.state = BACKING_OFF
+                self._since = now
+                self._disconnected_since = now
+                self._backoff_ms = 0
+            else:
+                return False
+
+        if connected:
+            # whatever we were doing, it worked
+            if self.state == CONNECTING:
+                self.last_connect_ms = utime.ticks_diff(now, self._since)
+            self.disconnected_ms += utime.ticks_diff(now, self._disconnected_since)
+            if self._was_connected:
+                self.reconnects += 1
+            self._was_connected = True
+            self.state = CONNECTED
+            self._since = now
+            self._backoff_ms = self.min_backoff_ms
+            return True
+
+        if self.state == CONNECTING and utime.ticks_diff(now, self._since) >= self.connect_timeout_ms:
+            self.failed_attempts += 1
+            try:
+                self.wlan.disconnect()
+            except OSError:
+                pass
+            self.state = BACKING_OFF
+            self._since = now
+            self._backoff_ms = max(self._backoff_ms, self.min_backoff_ms)
+
+        elif self.state == BACKING_OFF and utime.ticks_diff(now, self._since) >= self._backoff_ms:
+            self._start_attempt(now)
+            # the next backoff, should this one fail
+            self._backoff_ms = min(self._backoff_ms * 2, self.max_backoff_ms)
+
+        return False
+
+    def connect(self, timeout_ms, poll_interval_ms=100):
+        """ blocks until connected, or until timeout_ms have passed.
+            returns whether we're connected. """
+
+        start = utime.ticks_ms()
+        while not self.poll() and self.state != CONNECTED:
+            if utime.ticks_diff(utime.ticks_ms(), start) >= timeout_ms:
+                return False
+            utime.sleep_ms(poll_interval_ms)
+        return True
+
+    def disconnected_for_ms(self):
+        """ how long the current outage has lasted, 0 while connected """
+        if self.state == CONNECTED:
+            return 0
+        return utime.ticks_diff(utime.ticks_ms(), self._disconnected_since)
+
+    def render_text(self):
+        """ prometheus text exposition """
+
+        text = "# TYPE wifi_connected gauge\nwifi_connected {}\n".format(int(self.state == CONNECTED))
+        text += "# TYPE wifi_reconnects counter\nwifi_reconnects {}\n".format(self.reconnects)
+        text += "# TYPE wifi_connect_attempts counter\nwifi_connect_attempts {}\n".format(self.attempts)
+        text += "# TYPE wifi_failed_connect_attempts counter\nwifi_failed_connect_attempts {}\n".format(self.failed_attempts)
+        text += "# TYPE wifi_last_connect_ms gauge\nwifi_last_connect_ms {}\n".format(self.last_connect_ms)
+        text += "# TYPE wifi_disconnected_ms counter\nwifi_disconnected_ms {}\n".format(self.disconnected_ms + self.disconnected_for_ms())
+        return text